@@ -5,7 +5,8 @@ from . import time_machine
 from .stats import Stats
 from .chunk_player import ChunkPlayer
 from .packetizer import Packetizer
-from .chunk_queue import ChunkQueue
+from .chunk_queue import ChunkQueue, ChunkFanOut
 from .receiver import Receiver
+from .silence import SilenceDetector
 from .sample_reader import SampleReader
 from . import cli
@@ -21,10 +21,12 @@ class AudioConfig:
         # System latency (distributed buffer size)
         self.latency_ms = latency_ms
         self.latency_s = latency_ms / 1000.0
+        self.latency_ns = int(latency_ms * 1000000)
 
         # Audio output latency
         self.sink_latency_ms = sink_latency_ms
         self.sink_latency_s = sink_latency_ms / 1000.0
+        self.sink_latency_ns = int(sink_latency_ms * 1000000)
 
         assert 1 <= channels <= 20
         assert sample in [24, 16]
@@ -1,12 +1,27 @@
+import asyncio
+
+from libwavesync.ring_buffer import FrameRing
+
+
 class AudioOutput:
     """
     Output abstraction - wraps all methods of sound card required to work.
+
+    In the callback mode PortAudio pulls the audio from a FrameRing filled by
+    the player - from its own thread, independently of the event loop load.
+    Silence is played when the ring runs empty.
     """
-    def __init__(self, config, device_index, buffer_size):
-        # Import pyaudio only if really needed.
-        # pylint: disable=import-outside-toplevel
-        import pyaudio
 
+    # Ring size in chunks (at least) in the callback mode
+    RING_CHUNKS = 4
+
+    # Give up waiting for space in the ring after this many tries
+    MAX_SPACE_WAITS = 20
+
+    # pyaudio.paContinue
+    PA_CONTINUE = 0
+
+    def __init__(self, config, device_index, buffer_size, callback=False):
         self.stream = None
         self.pyaudio = None
         self.config = config
@@ -16,10 +31,22 @@ class AudioOutput:
 
         self.chunk_frames = config.chunk_size / config.frame_size
 
+        self.callback = callback
+        self.ring = None
+        self.max_buffer = None
+        if callback:
+            capacity = max(self.RING_CHUNKS * config.chunk_size,
+                           2 * buffer_size * config.frame_size)
+            self.ring = FrameRing(capacity, config.frame_size)
+
         if device_index == -1:
             # We are tested. Don't open stream (stop at calculation of chunk_frames).
             return
 
+        # Import pyaudio only if really needed.
+        # pylint: disable=import-outside-toplevel
+        import pyaudio
+
         assert self.stream is None
         self.pyaudio = pyaudio.PyAudio()
 
@@ -33,12 +60,16 @@ class AudioOutput:
             if config.sample == 24
             else pyaudio.paInt16
         )
+        if callback:
+            # PortAudio buffer is filled from the ring - keep it small.
+            buffer_size = min(buffer_size, int(self.chunk_frames))
         self.stream = self.pyaudio.open(output=True,
                                         channels=config.channels,
                                         rate=config.rate,
                                         format=audio_format,
                                         frames_per_buffer=buffer_size,
-                                        output_device_index=device_index)
+                                        output_device_index=device_index,
+                                        stream_callback=self._callback if callback else None)
 
         self.max_buffer = self.get_write_available()
 
@@ -55,12 +86,60 @@ class AudioOutput:
             self.pyaudio.terminate()
             self.pyaudio = None
 
+    def _callback(self, in_data, frame_count, time_info, status):
+        "Called by PortAudio from its thread, must not block"
+        return self.ring.read(frame_count * self.config.frame_size), self.PA_CONTINUE
+
     def get_write_available(self):
+        "Number of frames which can be written without blocking"
+        if self.ring is not None:
+            return self.ring.space() // self.config.frame_size
         return self.stream.get_write_available()
 
     def write(self, data):
+        if self.ring is not None:
+            return self.ring.write(data)
         return self.stream.write(data)
 
+    async def wait_space(self, size):
+        """
+        Callback mode: wait until size bytes can be written to the ring.
+
+        Sleeps until the output should have played enough of the ring,
+        instead of polling. Returns number of sleeps, or None if the output
+        doesn't seem to play at all.
+        """
+        byte_rate = self.config.rate * self.config.frame_size
+        for waits in range(self.MAX_SPACE_WAITS):
+            missing = size - self.ring.space()
+            if missing <= 0:
+                return waits
+            await asyncio.sleep(missing / byte_rate)
+        return None
+
+    def buffered_ns(self):
+        "Time it takes to play the audio already written (ns)"
+        if self.ring is not None:
+            frames = self.ring.available() // self.config.frame_size
+        elif self.max_buffer is not None:
+            frames = max(0, self.max_buffer - self.get_write_available())
+        else:
+            frames = 0
+        return frames * 1000000000 // self.config.rate
+
+    def clear(self):
+        "Drop the buffered audio - in the callback mode"
+        if self.ring is not None:
+            self.ring.clear()
+
+    @property
+    def underruns_ms(self):
+        "Total time of silence played because the ring was empty"
+        if self.ring is None:
+            return 0
+        frames = self.ring.underrun_bytes // self.config.frame_size
+        return 1000 * frames / self.config.rate
+
     def get_silent_chunk(self):
         "Generate and cache silent chunks"
         if self.silence_cache is not None:
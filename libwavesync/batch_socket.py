@@ -0,0 +1,334 @@
+"""
+Batched UDP sending and receiving.
+
+Sending: one datagram to many destinations in a single syscall. Datagrams
+are given as a list of parts (header, mark, payload) which are gathered by
+the kernel, so the payload is never concatenated in Python.
+
+Receiving: drain the socket in batches into preallocated buffers.
+
+On Linux sendmmsg(2) and recvmmsg(2) are called through ctypes; elsewhere it
+falls back to a sendmsg()/recvfrom_into() per datagram.
+"""
+
+import os
+import sys
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IoVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def _load_libc_function(name):
+    "Return libc function or None if not available on this platform"
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        return getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+
+
+_sendmmsg = _load_libc_function('sendmmsg')
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                          ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+_recvmmsg = _load_libc_function('recvmmsg')
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                          ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+# Linux flag marking a datagram truncated to the buffer size
+MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0x20)
+
+
+# Resolved destinations: (host, port) -> raw sockaddr_in
+_sockaddr_cache = {}
+
+
+def _sockaddr_in(address, port):
+    """
+    Binary struct sockaddr_in for an IPv4 destination. Host names are
+    resolved once, like sendto() would resolve them.
+    """
+    raw = _sockaddr_cache.get((address, port))
+    if raw is None:
+        info = socket.getaddrinfo(address, port, socket.AF_INET,
+                                  socket.SOCK_DGRAM)
+        ip = info[0][4][0]
+        raw = (struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) +
+               socket.inet_aton(ip) + bytes(8))
+        if len(_sockaddr_cache) > 1024:
+            _sockaddr_cache.clear()
+        _sockaddr_cache[(address, port)] = raw
+    return ctypes.create_string_buffer(raw, len(raw))
+
+
+def _address_of(buf):
+    """
+    Address of the buffer memory - without copying it.
+
+    Returns (address, object keeping the memory alive).
+    """
+    if isinstance(buf, bytes):
+        ptr = ctypes.c_char_p(buf)
+        return ctypes.cast(ptr, ctypes.c_void_p).value, ptr
+    try:
+        # Writable buffers - eg. views of the reader's ring.
+        obj = ctypes.c_char.from_buffer(buf)
+        return ctypes.addressof(obj), obj
+    except (TypeError, ValueError):
+        # Read-only or empty buffer
+        buf = bytes(buf)
+        ptr = ctypes.c_char_p(buf)
+        return ctypes.cast(ptr, ctypes.c_void_p).value, (ptr, buf)
+
+
+class BatchSender:
+    """
+    Send the same datagram to all destinations at once.
+    """
+
+    # Max total size of the datagram parts preceding the payload
+    MAX_PREFIX = 64
+
+    # sendmmsg has a higher fixed cost than a single sendmsg call
+    MIN_BATCH = 8
+
+    def __init__(self, sock, destinations):
+        self.sock = sock
+        self.destinations = list(destinations)
+
+        # Fall back on mocked sockets, non-Linux platforms or IPv6.
+        fileno = sock.fileno()
+        self.batched = (_sendmmsg is not None and
+                        isinstance(fileno, int) and
+                        sock.family == socket.AF_INET and
+                        len(self.destinations) >= self.MIN_BATCH)
+        self.scatter = hasattr(sock, 'sendmsg')
+
+        if self.batched:
+            self._setup_batch(fileno)
+
+    def _setup_batch(self, fileno):
+        """
+        Preallocate the message headers.
+
+        All messages share the same two iovecs: a prefix buffer to which the
+        small header parts are copied, and the payload.
+        """
+        count = len(self.destinations)
+        self._fileno = fileno
+
+        self._prefix = bytearray(self.MAX_PREFIX)
+        self._prefix_view = memoryview(self._prefix)
+        self._prefix_ptr = ctypes.c_char.from_buffer(self._prefix)
+
+        self._iov = (_IoVec * 2)()
+        self._iov[0].iov_base = ctypes.addressof(self._prefix_ptr)
+
+        self._addrs = [_sockaddr_in(address, port)
+                       for address, port in self.destinations]
+        self._msgs = (_MMsgHdr * count)()
+        for msg, addr in zip(self._msgs, self._addrs):
+            msg.msg_hdr.msg_name = ctypes.cast(addr, ctypes.c_void_p)
+            msg.msg_hdr.msg_namelen = ctypes.sizeof(addr)
+            msg.msg_hdr.msg_iov = self._iov
+            msg.msg_hdr.msg_iovlen = 2
+        self._msg_size = ctypes.sizeof(_MMsgHdr)
+
+    def _send_batch(self, parts):
+        "Send with sendmmsg, return failures"
+        pos = 0
+        for part in parts[:-1]:
+            size = len(part)
+            self._prefix_view[pos:pos + size] = part
+            pos += size
+        self._iov[0].iov_len = pos
+
+        payload = parts[-1]
+        address, keep = _address_of(payload)
+        self._iov[1].iov_base = address
+        self._iov[1].iov_len = len(payload)
+
+        failures = []
+        count = len(self.destinations)
+        offset = 0
+        base = ctypes.addressof(self._msgs)
+        while offset < count:
+            msgs = ctypes.cast(base + offset * self._msg_size,
+                               ctypes.POINTER(_MMsgHdr))
+            sent = _sendmmsg(self._fileno, msgs, count - offset, 0)
+            if sent < 0:
+                # The first remaining message has failed - skip it.
+                err = ctypes.get_errno()
+                failures.append((self.destinations[offset],
+                                 OSError(err, os.strerror(err))))
+                offset += 1
+            else:
+                offset += sent
+        del keep
+        return failures
+
+    def send(self, parts):
+        """
+        Send datagram composed of parts to all destinations.
+
+        Returns list of (destination, OSError) for failed sends.
+        """
+        if self.batched:
+            return self._send_batch(parts)
+
+        failures = []
+        if not self.scatter:
+            parts = [b''.join(parts)]
+
+        for destination in self.destinations:
+            try:
+                if self.scatter:
+                    self.sock.sendmsg(parts, [], 0, destination)
+                else:
+                    self.sock.sendto(parts[0], destination)
+            except OSError as ex:
+                failures.append((destination, ex))
+        return failures
+
+
+class BatchReceiver:
+    """
+    Drain a non-blocking UDP socket into preallocated buffers.
+
+    Received datagrams are memoryviews of the slab and are valid only until
+    the next call to receive().
+    """
+
+    def __init__(self, sock, batch=32, slot_size=9216):
+        self.sock = sock
+        self.batch = batch
+        self.slot_size = slot_size
+
+        self.slab = bytearray(batch * slot_size)
+        self.view = memoryview(self.slab)
+        self.slots = [self.view[i * slot_size:(i + 1) * slot_size]
+                      for i in range(batch)]
+
+        # Cached source addresses: raw sockaddr -> (address, port)
+        self._addr_cache = {}
+
+        # Datagrams dropped as too big for a slot
+        self.truncated = 0
+
+        fileno = sock.fileno()
+        self.batched = (_recvmmsg is not None and
+                        isinstance(fileno, int) and
+                        sock.family == socket.AF_INET)
+        if self.batched:
+            self._setup_batch(fileno)
+
+    def _setup_batch(self, fileno):
+        "Preallocate message headers pointing at the slab slots"
+        self._fileno = fileno
+        self._slab_ptr = ctypes.c_char.from_buffer(self.slab)
+        base = ctypes.addressof(self._slab_ptr)
+
+        self._iov = (_IoVec * self.batch)()
+        self._names = (ctypes.c_char * (16 * self.batch))()
+        self._names_view = memoryview(self._names).cast('B')
+        self._msgs = (_MMsgHdr * self.batch)()
+        names = ctypes.addressof(self._names)
+        for i, msg in enumerate(self._msgs):
+            self._iov[i].iov_base = base + i * self.slot_size
+            self._iov[i].iov_len = self.slot_size
+            msg.msg_hdr.msg_name = names + i * 16
+            msg.msg_hdr.msg_iov = ctypes.pointer(self._iov[i])
+            msg.msg_hdr.msg_iovlen = 1
+            msg.msg_hdr.msg_namelen = 16
+        # Messages filled by the last call - only their address length
+        # needs to be reset
+        self._filled = 0
+
+    def _address(self, raw):
+        "Decode (cached) sockaddr_in"
+        addr = self._addr_cache.get(raw)
+        if addr is None:
+            port = struct.unpack('!H', raw[2:4])[0]
+            addr = (socket.inet_ntoa(raw[4:8]), port)
+            if len(self._addr_cache) > 1024:
+                self._addr_cache.clear()
+            self._addr_cache[raw] = addr
+        return addr
+
+    def _receive_batch(self):
+        "Receive using a single recvmmsg call"
+        msgs = self._msgs
+        for i in range(self._filled):
+            msgs[i].msg_hdr.msg_namelen = 16
+        self._filled = 0
+        count = _recvmmsg(self._fileno, self._msgs, self.batch,
+                          socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        self._filled = count
+
+        datagrams = []
+        for i in range(count):
+            msg = self._msgs[i]
+            if msg.msg_hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+                continue
+            addr = self._address(bytes(self._names_view[i * 16:i * 16 + 8]))
+            datagrams.append((self.slots[i][:msg.msg_len], addr))
+        return datagrams
+
+    def receive(self):
+        "Return list of received (datagram, address) - possibly empty"
+        if self.batched:
+            return self._receive_batch()
+
+        datagrams = []
+        for slot in self.slots:
+            try:
+                size, addr = self.sock.recvfrom_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            if size == self.slot_size:
+                # Might have been truncated
+                self.truncated += 1
+                continue
+            datagrams.append((slot[:size], addr))
+        return datagrams
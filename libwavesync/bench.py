@@ -0,0 +1,822 @@
+"""
+Micro-benchmarks of the WaveSync pipeline stages.
+
+Run with:
+  python -m libwavesync.bench [--json PATH] [benchmark ...]
+
+Each result is printed and, with --json, saved along with the machine
+description - to compare versions on the same hardware.
+"""
+
+import io
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import contextlib
+import socket
+import asyncio
+import struct
+from time import perf_counter, process_time, time
+
+from libwavesync import (
+    AudioConfig,
+    SampleReader,
+    SilenceDetector,
+    ChunkQueue,
+    ChunkPlayer,
+    Packetizer,
+    Receiver,
+    Stats,
+    VERSION,
+    time_machine,
+)
+from libwavesync.batch_socket import BatchSender
+from libwavesync.send_scheduler import SendScheduler
+from libwavesync.encode_pool import EncodePool
+from libwavesync.relay import Relay
+from libwavesync.resampler import Resampler
+from libwavesync import codec, pcm
+
+
+# Configurations of the pipeline benchmarks: rate, sample, channels, payload.
+# (The status datagram carries the rate in 16 bits - up to 65535Hz.)
+CONFIGS = [
+    (32000, 16, 1, 1000),
+    (44100, 16, 2, 1472),
+    (48000, 24, 2, 1472),
+    (48000, 24, 8, 1472),
+]
+
+
+def _result(benchmark, text, **values):
+    "Benchmark result: printed text and values for the JSON output"
+    result = {'benchmark': benchmark}
+    result.update(values)
+    result['text'] = text
+    return result
+
+
+def _audio_config(rate, sample, channels):
+    "Create configuration used in benchmarks"
+    return AudioConfig(rate=rate,
+                       sample=sample,
+                       channels=channels,
+                       latency_ms=1000,
+                       sink_latency_ms=0)
+
+
+def _test_signal(size):
+    "Non-silent, repeatable audio data"
+    pattern = bytes(range(1, 256))
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def bench_sample_reader(total_mb=32):
+    "SampleReader chunking throughput"
+    results = []
+    setups = [config + (read_size,)
+              for config in CONFIGS
+              for read_size in (4096, 65536)]
+    for rate, sample, channels, payload, read_size in setups:
+        reader = SampleReader(_audio_config(rate, sample, channels))
+        reader.payload_size = payload
+        reader.connection_made(None)
+
+        data = _test_signal(read_size)
+        reads = total_mb * 1024 * 1024 // read_size
+
+        start = perf_counter()
+        for _ in range(reads):
+            reader.data_received(data)
+            # Drain as the packetizer would
+            while True:
+                try:
+                    reader.sample_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+        took = perf_counter() - start
+
+        mb_s = reads * read_size / took / 1e6
+        s = "sample_reader: %dHz %dbit %dch payload=%d read=%-6d %8.1f MB/s"
+        results.append(_result('sample_reader',
+                               s % (rate, sample, channels, payload,
+                                    read_size, mb_s),
+                               rate=rate, sample=sample, channels=channels,
+                               payload=payload, read_size=read_size,
+                               mb_s=mb_s))
+    return results
+
+
+def _timeit(func, arg, repeat):
+    "Average microseconds per call"
+    start = perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (perf_counter() - start) / repeat * 1e6
+
+
+def bench_silence(repeat=20000):
+    "Per-chunk cost of silence detection"
+    results = []
+    for sample, channels in [(16, 2), (24, 8)]:
+        config = _audio_config(48000, sample, channels)
+        config.chunk_size = 1468
+        size = config.chunk_size
+        zeroes = bytes(size)
+
+        # Dither noise of +-1 LSB of the 16-bit range
+        rnd = random.Random(1)
+        if sample == 16:
+            dither = struct.pack('<%dh' % (size // 2),
+                                 *(rnd.randint(-1, 1) for _ in range(size // 2)))
+        else:
+            dither = b''.join(struct.pack('<i', rnd.randint(-256, 256))[:3]
+                              for _ in range(size // 3))
+
+        # Legacy check scanned the whole chunk with any()
+        legacy = _timeit(any, zeroes, repeat)
+        for metric in SilenceDetector.METRICS:
+            detector = SilenceDetector(config, metric=metric)
+            zero_us = _timeit(detector.update, zeroes, repeat)
+            dither_us = _timeit(detector.update, dither, repeat)
+            s = ("silence: %dbit %dch %-4s any()=%.2fus detector: "
+                 "zeroes=%.2fus dither=%.2fus dither_detected=%s")
+            results.append(_result('silence',
+                                   s % (sample, channels, metric, legacy,
+                                        zero_us, dither_us, detector.silent),
+                                   sample=sample, channels=channels,
+                                   metric=metric, any_us=legacy,
+                                   zeroes_us=zero_us, dither_us=dither_us,
+                                   dither_detected=detector.silent))
+    return results
+
+
+def _music_signal(config, frames):
+    """
+    Synthetic "music": few harmonics, a slow tremolo and noise at about
+    -70dBFS, different on each channel. Requires NumPy.
+    """
+    np = pcm.numpy
+    rnd = np.random.default_rng(1)
+    t = np.arange(frames)[:, None] / config.rate
+    channel = np.arange(config.channels)[None, :]
+    top = 2 ** (config.sample - 1)
+    signal = sum(np.sin(2 * np.pi * freq * (1 + 0.01 * channel) * t) / (i + 1)
+                 for i, freq in enumerate([110, 220, 330, 880, 2500]))
+    signal *= 0.25 * top * (1 + 0.5 * np.sin(2 * np.pi * 0.5 * t))
+    signal += rnd.normal(0, top * 10 ** (-70 / 20), signal.shape)
+    return pcm.from_array(signal.astype(np.int32), config.sample)
+
+
+def bench_codecs(chunks=500):
+    "Compression ratio and encode/decode time per chunk of the codecs"
+    if pcm.numpy is None:
+        return [_result('codecs', "codecs: requires NumPy")]
+    results = []
+    for sample, channels in [(16, 2), (24, 8)]:
+        config = _audio_config(48000, sample, channels)
+        config.chunk_size = 1466
+        size = config.chunk_size
+        signal = _music_signal(config, chunks * size // config.frame_size)
+        data = [signal[i * size:(i + 1) * size] for i in range(chunks)]
+
+        codecs = [codec.ZlibCodec(config, level) for level in (1, 6, 9)]
+        codecs.append(codec.RiceCodec(config))
+        for chunk_codec in codecs:
+            start = perf_counter()
+            encoded = [chunk_codec.encode(chunk) for chunk in data]
+            encode_us = (perf_counter() - start) / chunks * 1e6
+
+            start = perf_counter()
+            for payload in encoded:
+                if payload is not None:
+                    chunk_codec.decode(payload)
+            decode_us = (perf_counter() - start) / chunks * 1e6
+
+            # Packetizer sends raw chunks if they don't compress
+            sent = sum(size if payload is None else min(len(payload), size)
+                       for payload in encoded)
+            name = chunk_codec.NAME
+            if isinstance(chunk_codec, codec.ZlibCodec):
+                name += '-%d' % chunk_codec.level
+            s = "codecs: %dbit %dch %-6s ratio=%.3f encode=%6.1fus decode=%6.1fus"
+            ratio = sent / (chunks * size)
+            results.append(_result('codecs',
+                                   s % (sample, channels, name, ratio,
+                                        encode_us, decode_us),
+                                   sample=sample, channels=channels,
+                                   codec=name, ratio=ratio,
+                                   encode_us=encode_us, decode_us=decode_us))
+    return results
+
+
+def bench_resampler(chunks=500):
+    "Drift compensating resampler CPU time per chunk"
+    if pcm.numpy is None:
+        return [_result('resampler', "resampler: requires NumPy")]
+    results = []
+    for sample, channels in [(16, 2), (24, 8)]:
+        config = _audio_config(48000, sample, channels)
+        config.chunk_size = 1466 - 1466 % config.frame_size
+        size = config.chunk_size
+        signal = _music_signal(config, chunks * size // config.frame_size)
+        data = [signal[i * size:(i + 1) * size] for i in range(chunks)]
+
+        for ppm in (0, 100):
+            resampler = Resampler(config)
+            resampler.ratio = 1 + ppm * 1e-6
+            start = perf_counter()
+            for chunk in data:
+                resampler.process(chunk)
+            took_us = (perf_counter() - start) / chunks * 1e6
+            s = "resampler: %dbit %dch %d frames/chunk ratio=1%+.4f %6.1fus/chunk (%.2f%% of chunk time)"
+            results.append(_result('resampler',
+                                   s % (sample, channels, size // config.frame_size,
+                                        ppm * 1e-6, took_us,
+                                        100 * took_us / 1e6 / config.chunk_time),
+                                   sample=sample, channels=channels,
+                                   frames=size // config.frame_size,
+                                   drift_ppm=ppm, chunk_us=took_us))
+    return results
+
+
+class _ChunkSource:
+    "Reader handing out prepared chunks as fast as possible"
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.position = 0
+
+    async def get_next_chunk(self):
+        chunk = self.chunks[self.position % len(self.chunks)]
+        self.position += 1
+        return self.position, chunk
+
+
+async def _drain_pool(pool, count):
+    "Get count encoded chunks from the pool"
+    for _ in range(count):
+        await pool.get_next_chunk()
+
+
+def bench_encode_pool(chunks=4000):
+    """
+    Encoding throughput by the number of worker processes.
+
+    Besides the throughput on this machine, the CPU time the main process
+    spends per chunk (feeding the ring, pipes, the event loop) is measured.
+    The pool helps only when it's lower than the inline encode time. With a
+    core per worker and one for the main process the throughput is limited
+    by the slower of the two: the main process, or the workers encoding in
+    parallel - shown as `projected`.
+    """
+    config = _audio_config(48000, 24, 8)
+    config.chunk_size = 1466
+    if pcm.numpy is not None:
+        chunk_codec = codec.RiceCodec(config)
+        data = _music_signal(config, 100 * config.chunk_size // config.frame_size)
+    else:
+        chunk_codec = codec.ZlibCodec(config, 9)
+        data = _test_signal(100 * config.chunk_size)
+    size = config.chunk_size
+    data = [data[i * size:(i + 1) * size] for i in range(100)]
+
+    results = []
+    start = perf_counter()
+    for i in range(chunks):
+        chunk_codec.encode(data[i % len(data)])
+    took = perf_counter() - start
+    encode_us = took / chunks * 1e6
+    s = ("encode_pool: %s 24bit 8ch cpus=%d workers=%s chunks/s=%7.0f MB/s=%6.1f "
+         "main cpu/chunk=%6.1fus")
+    results.append(_result('encode_pool',
+                           s % (chunk_codec.NAME, os.cpu_count(), 'inline',
+                                chunks / took, chunks * size / took / 1e6,
+                                encode_us),
+                           codec=chunk_codec.NAME, workers=0,
+                           chunks_s=chunks / took,
+                           main_cpu_chunk_us=encode_us))
+
+    for workers in [1, 2, 4, 8]:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        pool = EncodePool(_ChunkSource(data), chunk_codec, workers)
+        pool.start(size)
+        # Warm up - workers are starting
+        loop.run_until_complete(_drain_pool(pool, 100))
+        start = perf_counter()
+        cpu_start = process_time()
+        loop.run_until_complete(_drain_pool(pool, chunks))
+        cpu = process_time() - cpu_start
+        took = perf_counter() - start
+        pool.stop()
+        # Let the cancelled feeder finish
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+        main_us = cpu / chunks * 1e6
+        projected = min(1e6 / main_us, workers * 1e6 / encode_us)
+        results.append(_result('encode_pool',
+                               s % (chunk_codec.NAME, os.cpu_count(), workers,
+                                    chunks / took, chunks * size / took / 1e6,
+                                    main_us) +
+                               " projected on %d cpus=%7.0f" % (workers + 1,
+                                                                projected),
+                               codec=chunk_codec.NAME, workers=workers,
+                               chunks_s=chunks / took,
+                               main_cpu_chunk_us=main_us,
+                               projected_chunks_s=projected))
+    return results
+
+
+def _udp_sinks(count):
+    "Bound, never read, loopback sockets to send the datagrams to"
+    sinks = []
+    for _ in range(count):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sinks.append(sink)
+    return sinks
+
+
+def bench_send(chunks=2000):
+    "Sending one chunk to a growing number of destinations"
+    results = []
+    header, mark = b'\x00\x00', b'\x12\x34'
+    ring = bytearray(_test_signal(1468))
+    chunk = memoryview(ring)
+
+    for count in [1, 5, 10, 30, 50]:
+        sinks = _udp_sinks(count)
+        destinations = [sink.getsockname() for sink in sinks]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        def legacy():
+            dgram = header + mark + chunk
+            for destination in destinations:
+                sock.sendto(dgram, destination)
+
+        scatter = BatchSender(sock, destinations)
+        scatter.batched = False
+        batched = BatchSender(sock, destinations)
+        # Broadcast without SO_BROADCAST fails every time (EACCES) - like
+        # an unreachable receiver
+        failing = destinations + [('255.255.255.255', 9)]
+        batched_failing = BatchSender(sock, failing)
+        scheduler = SendScheduler(sock, destinations)
+        scheduler_failing = SendScheduler(sock, failing)
+
+        methods = [
+            ('sendto', legacy),
+            ('sendmsg', lambda: scatter.send([header, mark, chunk])),
+        ]
+        if batched.batched:
+            methods.append(('sendmmsg', lambda: batched.send([header, mark, chunk])))
+        methods += [
+            ('+failing', lambda: batched_failing.send([header, mark, chunk])),
+            ('sched', lambda: scheduler.send([header, mark, chunk])),
+            ('sched+failing', lambda: scheduler_failing.send([header, mark, chunk])),
+        ]
+
+        for name, method in methods:
+            cpu_start = process_time()
+            start = perf_counter()
+            for _ in range(chunks):
+                method()
+            took = perf_counter() - start
+            cpu = process_time() - cpu_start
+            s = "send: dsts=%-2d %-13s pkts/s=%9.0f cpu/chunk=%6.1fus"
+            results.append(_result('send',
+                                   s % (count, name, chunks * count / took,
+                                        cpu / chunks * 1e6),
+                                   destinations=count, method=name,
+                                   packets_s=chunks * count / took,
+                                   cpu_chunk_us=cpu / chunks * 1e6))
+
+        sock.close()
+        for sink in sinks:
+            sink.close()
+    return results
+
+
+async def _wait_settled(queue, count):
+    "Wait until count chunks are queued or nothing more arrives"
+    idle = 0
+    while len(queue.chunk_list) < count and idle < 100:
+        before = len(queue.chunk_list)
+        await asyncio.sleep(0)
+        idle = idle + 1 if len(queue.chunk_list) == before else 0
+
+
+def _receive_rounds(loop, sock, receiver, rounds, burst):
+    "Send bursts of datagrams and wait until receiver queues them"
+    queue = receiver.chunk_queue
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    destination = sock.getsockname()
+    dgram = b'\x00\x00\x12\x34' + _test_signal(1464)
+
+    received = 0
+    cpu_start = process_time()
+    start = perf_counter()
+    for _ in range(rounds):
+        for _ in range(burst):
+            sender.sendto(dgram, destination)
+        # Some might be dropped by the kernel if the socket buffer is small
+        loop.run_until_complete(_wait_settled(queue, burst))
+        received += len(queue.chunk_list)
+        queue.chunk_list.clear()
+    took = perf_counter() - start
+    cpu = process_time() - cpu_start
+    sender.close()
+    return received, took, cpu
+
+
+def bench_receive(rounds=300, burst=48):
+    "Receiver datagrams/s with the datagram protocol and batched receiving"
+    results = []
+    for batch in [0, 8, 32]:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        receiver = Receiver(ChunkQueue(), channel=('127.0.0.1', 0),
+                            sink_latency_ms=0, stats=Stats())
+        if batch:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            receiver.start_batched(sock, batch)
+        else:
+            endpoint = loop.create_datagram_endpoint(lambda: receiver,
+                                                     local_addr=('127.0.0.1', 0))
+            transport, _ = loop.run_until_complete(endpoint)
+            sock = transport.get_extra_info('socket')
+
+        received, took, cpu = _receive_rounds(loop, sock, receiver, rounds, burst)
+        s = "receive: %-9s dgrams/s=%8.0f cpu/dgram=%5.1fus received=%d/%d"
+        results.append(_result('receive',
+                               s % ("batch=%d" % batch if batch else "protocol",
+                                    received / took, cpu / max(received, 1) * 1e6,
+                                    received, rounds * burst),
+                               batch=batch, datagrams_s=received / took,
+                               cpu_datagram_us=cpu / max(received, 1) * 1e6,
+                               received=received, sent=rounds * burst))
+        if batch:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        else:
+            # Don't let connection_lost stop the loop
+            transport.abort()
+        loop.close()
+    return results
+
+
+class _TimedSource:
+    "Reader handing out prepared chunks timed for immediate sending"
+
+    def __init__(self, chunks, count, packetizer):
+        self.chunks = chunks
+        self.count = count
+        self.position = 0
+        self.packetizer = packetizer
+
+    async def get_next_chunk(self):
+        chunk = self.chunks[self.position % len(self.chunks)]
+        self.position += 1
+        if self.position >= self.count:
+            self.packetizer.stop = True
+        return time_machine.now_ns(), chunk
+
+
+def _chunk_data(config, count):
+    "List of count chunks of the signal in the configuration"
+    size = config.chunk_size
+    if pcm.numpy is not None:
+        data = _music_signal(config, count * size // config.frame_size)
+    else:
+        data = _test_signal(count * size)
+    return [data[i * size:(i + 1) * size] for i in range(count)]
+
+
+def _sized_config(rate, sample, channels, payload, header_version):
+    "Configuration with the chunk size of the datagram payload size"
+    config = _audio_config(rate, sample, channels)
+    reader = SampleReader(config)
+    reader.header_size = Packetizer.HEADER_SIZES[header_version]
+    reader.payload_size = payload
+    return config
+
+
+def bench_packetizer(chunks=3000):
+    "Packetizer datagrams/s by configuration, compression and destinations"
+    results = []
+    for rate, sample, channels, payload in CONFIGS:
+        config = _sized_config(rate, sample, channels, payload, 1)
+        data = _chunk_data(config, 100)
+
+        codecs = [('raw', None)]
+        codecs += [('zlib-%d' % level, codec.ZlibCodec(config, level))
+                   for level in (1, 6)]
+        if pcm.numpy is not None:
+            codecs.append(('rice', codec.RiceCodec(config)))
+
+        for name, chunk_codec in codecs:
+            for count in [1, 10]:
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                packetizer = Packetizer(None, None, config, codec=chunk_codec)
+                packetizer.reader = _TimedSource(data, chunks, packetizer)
+                sinks = _udp_sinks(count)
+                packetizer.create_socket([sink.getsockname() for sink in sinks],
+                                         ttl=1, multicast_loop=False,
+                                         broadcast=False)
+
+                # Silence the status lines
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cpu_start = process_time()
+                    start = perf_counter()
+                    loop.run_until_complete(packetizer.packetize())
+                    took = perf_counter() - start
+                    cpu = process_time() - cpu_start
+
+                loop.remove_reader(packetizer.sock.fileno())
+                packetizer.sock.close()
+                for sink in sinks:
+                    sink.close()
+                loop.close()
+
+                ratio = packetizer.bytes_sent / packetizer.bytes_raw
+                s = ("packetizer: %dHz %dbit %dch payload=%d %-7s dsts=%-2d "
+                     "dgrams/s=%8.0f cpu/chunk=%6.1fus ratio=%.3f")
+                results.append(_result(
+                    'packetizer',
+                    s % (rate, sample, channels, payload, name, count,
+                         packetizer.packets_sent / took, cpu / chunks * 1e6,
+                         ratio),
+                    rate=rate, sample=sample, channels=channels,
+                    payload=payload, codec=name, destinations=count,
+                    datagrams_s=packetizer.packets_sent / took,
+                    cpu_chunk_us=cpu / chunks * 1e6, ratio=ratio))
+    return results
+
+
+async def _play_chunks(player, data, chunks):
+    "Pass chunks due now to the player, drain the output as a device would"
+    ring = player.audio_output.ring
+    for i in range(chunks):
+        await player._handle_cmd_audio((time_machine.now_ns(), data[i % len(data)]))
+        ring.read(ring.available())
+
+
+def bench_player(chunks=3000):
+    "ChunkPlayer CPU time per chunk, with and without resampling"
+    results = []
+    for rate, sample, channels, payload in CONFIGS:
+        config = _sized_config(rate, sample, channels, payload, 1)
+        data = _chunk_data(config, 100)
+
+        variants = [('plain', 0)]
+        if pcm.numpy is not None:
+            variants.append(('resample', 50e-6))
+        for name, drift in variants:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            player = ChunkPlayer(ChunkQueue(), Stats(), tolerance_ms=5,
+                                 buffer_size=512, device_index=-1,
+                                 callback=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                player._handle_cmd_cfg(config)
+                player.drift.drift = drift
+                cpu_start = process_time()
+                loop.run_until_complete(_play_chunks(player, data, chunks))
+                cpu = process_time() - cpu_start
+            loop.close()
+
+            chunk_us = cpu / chunks * 1e6
+            s = ("player: %dHz %dbit %dch payload=%d %-8s cpu/chunk=%6.1fus "
+                 "(%.2f%% of chunk time) drops=%d")
+            results.append(_result(
+                'player',
+                s % (rate, sample, channels, payload, name, chunk_us,
+                     100 * chunk_us / 1e6 / config.chunk_time,
+                     player.stats.time_drops),
+                rate=rate, sample=sample, channels=channels, payload=payload,
+                variant=name, cpu_chunk_us=chunk_us,
+                drops=player.stats.time_drops))
+    return results
+
+
+async def _feed_zone(reader, packetizer, data, duration):
+    "Feed the reader at the real time rate of its configuration"
+    config = reader.audio_config
+    reader.connection_made(None)
+    start = perf_counter()
+    fed = 0
+    position = 0
+    while True:
+        elapsed = perf_counter() - start
+        due = int(elapsed * config.rate) * config.frame_size
+        while fed < due:
+            size = min(due - fed, len(data) - position)
+            reader.data_received(data[position:position + size])
+            position = (position + size) % len(data)
+            fed += size
+        if elapsed >= duration:
+            break
+        await asyncio.sleep(0.005)
+    # Wake the packetizer up to notice the stop
+    packetizer.stop = True
+    reader.data_received(data[:config.chunk_size])
+
+
+def bench_zones(duration=3):
+    "Sender CPU time per zone with several zones on one event loop"
+    rate, sample, channels, payload = CONFIGS[1]
+    results = []
+    for count in [1, 2, 4]:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        zones = []
+        for number in range(count):
+            config = _sized_config(rate, sample, channels, payload, 1)
+            data = b''.join(_chunk_data(config, 100))
+            reader = SampleReader(config)
+            reader.header_size = Packetizer.HEADER_SIZES[1]
+            reader.payload_size = payload
+            packetizer = Packetizer(reader, None, config,
+                                    name='zone%d' % number)
+            sinks = _udp_sinks(2)
+            packetizer.create_socket([sink.getsockname() for sink in sinks],
+                                     ttl=1, multicast_loop=False,
+                                     broadcast=False)
+            zones.append((reader, packetizer, data, sinks))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            cpu_start = process_time()
+            start = perf_counter()
+            tasks = []
+            for reader, packetizer, data, _ in zones:
+                tasks.append(_feed_zone(reader, packetizer, data, duration))
+                tasks.append(packetizer.packetize())
+            loop.run_until_complete(asyncio.gather(*tasks))
+            took = perf_counter() - start
+            cpu = process_time() - cpu_start
+
+        chunks = 0
+        for _, packetizer, _, sinks in zones:
+            chunks += packetizer.chunks_sent
+            loop.remove_reader(packetizer.sock.fileno())
+            packetizer.sock.close()
+            for sink in sinks:
+                sink.close()
+        loop.close()
+
+        s = ("zones: %d x %dHz %dbit %dch 2 dsts chunks/s=%6.0f "
+             "cpu=%5.2f%% cpu/zone=%5.2f%%")
+        results.append(_result(
+            'zones', s % (count, rate, sample, channels, chunks / took,
+                          100 * cpu / took, 100 * cpu / took / count),
+            zones=count, chunks_s=chunks / took, cpu_percent=100 * cpu / took,
+            cpu_zone_percent=100 * cpu / took / count))
+    return results
+
+
+def _one_way(loop, sender, destination, sink, dgram, rounds):
+    "One-way latencies (us) of datagrams sent to the destination until the sink"
+    waiter = [None]
+
+    def arrived():
+        while True:
+            try:
+                sink.recv(2048)
+            except BlockingIOError:
+                break
+        if waiter[0] is not None and not waiter[0].done():
+            waiter[0].set_result(perf_counter())
+
+    sink.setblocking(False)
+    loop.add_reader(sink.fileno(), arrived)
+    latencies = []
+    for _ in range(rounds):
+        waiter[0] = loop.create_future()
+        start = perf_counter()
+        sender.sendto(dgram, destination)
+        arrival = loop.run_until_complete(asyncio.wait_for(waiter[0], 1))
+        latencies.append((arrival - start) * 1e6)
+    loop.remove_reader(sink.fileno())
+    latencies.sort()
+    return latencies
+
+
+def bench_relay(rounds=2000):
+    """
+    Relay forwarding latency: one-way latency of the relayed datagrams minus
+    the latency of datagrams sent directly, over loopback.
+    """
+    results = []
+    dgram = b'\x00\x01\x12\x34\x00\x01' + _test_signal(1466)
+    for count in [1, 4, 16]:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        sinks = _udp_sinks(count)
+        relay = Relay(('127.0.0.1', 0), [sink.getsockname() for sink in sinks])
+        with contextlib.redirect_stdout(io.StringIO()):
+            relay.create_sockets(ttl=1, multicast_loop=False)
+        relay.start(loop)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Last destination gets the datagram last
+        sink = sinks[-1]
+        direct = _one_way(loop, sender, sink.getsockname(), sink, dgram, rounds)
+        relayed = _one_way(loop, sender, relay.sock.getsockname(), sink, dgram,
+                           rounds)
+
+        def percentile(values, percent):
+            return values[int(len(values) * percent / 100)]
+
+        added_p50 = percentile(relayed, 50) - percentile(direct, 50)
+        added_p99 = percentile(relayed, 99) - percentile(direct, 99)
+        # Time spent in the relay, without the event loop wakeup
+        inside_p99 = relay.forward_us.percentile(99)
+        s = ("relay: dsts=%-2d direct p50=%5.1fus relayed p50=%5.1fus "
+             "added: p50=%5.1fus p99=%5.1fus inside p99=%4.0fus %s")
+        results.append(_result(
+            'relay', s % (count, percentile(direct, 50),
+                          percentile(relayed, 50), added_p50, added_p99,
+                          inside_p99,
+                          'OK' if added_p50 < 100 else 'OVER 100us'),
+            destinations=count, direct_p50_us=percentile(direct, 50),
+            relayed_p50_us=percentile(relayed, 50),
+            relayed_p99_us=percentile(relayed, 99),
+            added_p50_us=added_p50, added_p99_us=added_p99,
+            inside_p99_us=inside_p99))
+
+        relay.close(loop)
+        sender.close()
+        for sink in sinks:
+            sink.close()
+        loop.close()
+    return results
+
+
+BENCHMARKS = {
+    'sample_reader': bench_sample_reader,
+    'silence': bench_silence,
+    'send': bench_send,
+    'receive': bench_receive,
+    'codecs': bench_codecs,
+    'encode_pool': bench_encode_pool,
+    'resampler': bench_resampler,
+    'packetizer': bench_packetizer,
+    'player': bench_player,
+    'zones': bench_zones,
+    'relay': bench_relay,
+}
+
+
+def machine_info():
+    "Description of the machine the results were measured on"
+    return {
+        'version': VERSION,
+        'time': time(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': pcm.numpy.__version__ if pcm.numpy is not None else None,
+    }
+
+
+def main(argv=None):
+    "Run selected (or all) benchmarks"
+    parser = argparse.ArgumentParser(prog='python3 -m libwavesync.bench',
+                                     description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', metavar='benchmark', nargs='*',
+                        help="benchmarks to run, default: all of %s" % ", ".join(BENCHMARKS))
+    parser.add_argument('--json', metavar='PATH', dest='json_path',
+                        help="save the results with the machine description as JSON")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    names = args.names or list(BENCHMARKS)
+
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark %s, available: %s" % (name, ", ".join(BENCHMARKS)))
+            return 1
+
+    results = []
+    for name in names:
+        for result in BENCHMARKS[name]():
+            print(result['text'])
+            results.append(result)
+
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as json_file:
+            json.dump({'machine': machine_info(), 'results': results},
+                      json_file, indent=1)
+        print("Results written to", args.json_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Channel map - sending subsets of the input channels to separate destinations.
+
+Each group of channels (eg. front left+right, centre or subwoofer) is sent
+as a separate stream to its own addresses: with its own audio configuration
+(channel count), status packets and FEC. A receiver listening on a group
+address sees an ordinary stream with fewer channels - so it needs nothing
+special and opens its output with the group's channel count.
+
+All groups are cut from the same input chunk and share the time marks and
+sequence numbers.
+"""
+
+import copy
+
+from libwavesync import AudioConfig
+
+
+class ChannelGroup:
+    "Input channels sent as a separate stream to the destinations"
+
+    def __init__(self, channels, destinations):
+        assert channels and len(set(channels)) == len(channels)
+        self.channels = tuple(channels)
+        self.destinations = list(destinations)
+
+        # Set by configure()
+        self.audio_config = None
+        self.codec = None
+        self._frame_size = None
+        self._lanes = None
+
+        # Set up by the Packetizer
+        self.header_codec = None
+        self.fec = None
+        self.sender = None
+
+    def __repr__(self):
+        return "<ChannelGroup channels=%s destinations=%s>" % (
+            ",".join(str(channel) for channel in self.channels),
+            ", ".join('%s:%d' % destination for destination in self.destinations))
+
+    def configure(self, audio_config, chunk_codec=None):
+        "Prepare to split chunks of the input configuration"
+        assert max(self.channels) < audio_config.channels
+        self.audio_config = AudioConfig(audio_config.rate,
+                                        audio_config.sample,
+                                        len(self.channels),
+                                        audio_config.latency_ms,
+                                        audio_config.sink_latency_ms)
+        self._frame_size = audio_config.frame_size
+        if audio_config.chunk_size is not None:
+            frames = audio_config.chunk_size // audio_config.frame_size
+            self.audio_config.chunk_size = frames * self.audio_config.frame_size
+
+        # Codec instance configured for the group's channel count
+        if chunk_codec is not None:
+            chunk_codec = copy.copy(chunk_codec)
+            chunk_codec.audio_config = self.audio_config
+        self.codec = chunk_codec
+
+        # Chunks are split with a strided slice copy per byte of the group's
+        # frame: (output offset, input offset)
+        sample_bytes = audio_config.sample // 8
+        self._lanes = [
+            (position * sample_bytes + byte, channel * sample_bytes + byte)
+            for position, channel in enumerate(self.channels)
+            for byte in range(sample_bytes)
+        ]
+
+    def split(self, chunk):
+        "Cut the group's channels out of an interleaved chunk"
+        data = bytes(chunk)
+        frames = len(data) // self._frame_size
+        group_frame = self.audio_config.frame_size
+        part = bytearray(frames * group_frame)
+        for output, source in self._lanes:
+            part[output::group_frame] = data[source::self._frame_size]
+
+        # Input chunk shrinks on MTU detection
+        if len(part) != self.audio_config.chunk_size:
+            self.audio_config.chunk_size = len(part)
+        return part
+
+
+def parse_channel_map(text, channels):
+    """
+    Parse "CHANNELS=ADDRESS:PORT", eg. "0,1=224.0.0.58:45300", channels
+    counted from 0. Returns (channels tuple, (address, port)) or raises
+    ValueError.
+    """
+    group, separator, destination = text.partition('=')
+    if not separator:
+        raise ValueError("Channel map not in format CHANNELS=IP_ADDRESS:PORT: " + text)
+    try:
+        group = tuple(int(channel) for channel in group.split(','))
+    except ValueError:
+        raise ValueError("Channels are not numbers in channel map: " + text)
+    if len(set(group)) != len(group):
+        raise ValueError("Channel repeated in channel map: " + text)
+    for channel in group:
+        if not 0 <= channel < channels:
+            raise ValueError("Channel %d out of range 0-%d in channel map: %s" % (
+                channel, channels - 1, text))
+
+    address, separator, port = destination.rpartition(':')
+    if not separator:
+        raise ValueError("Channel map not in format CHANNELS=IP_ADDRESS:PORT: " + text)
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError("Port is not a number in channel map: " + text)
+    return group, (address, port)
+
+
+def create_groups(channel_map):
+    "Group the parsed channel map entries by the channels, keeping the order"
+    groups = {}
+    for channels, destination in channel_map:
+        group = groups.get(channels)
+        if group is None:
+            group = groups[channels] = ChannelGroup(channels, [])
+        group.destinations.append(destination)
+    return list(groups.values())
+
+
+def reader_payload_size(payload_size, header_size, audio_config, groups,
+                        full_stream=True):
+    """
+    Payload size of the input chunks so that the largest sent datagram fits
+    in payload_size. Without the full stream destinations it's the largest
+    group's datagram - input chunks can be larger than a datagram.
+    """
+    if full_stream or not groups:
+        return payload_size
+    largest = max(len(group.channels) for group in groups)
+    group_frame = largest * audio_config.sample // 8
+    frames = (payload_size - header_size) // group_frame
+    return header_size + frames * audio_config.frame_size
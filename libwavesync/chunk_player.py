@@ -1,16 +1,25 @@
 import asyncio
-import random
+from time import perf_counter
 from libwavesync import (
     time_machine,
-    AudioOutput
+    AudioOutput,
+    pcm,
+    trace,
 )
+from libwavesync.sync_correction import SyncController, FrameCorrector
+from libwavesync.drift import DriftEstimator
+from libwavesync.resampler import Resampler
 
 
 class ChunkPlayer:
     "Play received audio and keep sync"
 
+    # Max number of lost chunks replaced by silence before the next chunk.
+    # Larger gaps are left to the sync correction.
+    MAX_GAP_CHUNKS = 2
+
     def __init__(self, chunk_queue, stats, tolerance_ms,
-                 buffer_size, device_index):
+                 buffer_size, device_index, callback=False, resample=True):
         # Our data source
         self.chunk_queue = chunk_queue
 
@@ -23,11 +32,21 @@ class ChunkPlayer:
         # Audio state
         self.buffer_size = buffer_size
         self.device_index = device_index
+        self.callback = callback
         self.audio_output = None
-        self.max_delay = 5
+        self.max_delay_ns = 5000000000
+
+        # Sync correction - created along the output
+        self.controller = None
+        self.corrector = None
 
-        # Number of silent frames that need to be inserted to get in sync
-        self.silence_to_insert = 0
+        # Clock drift compensation. Resampling requires NumPy, without it
+        # the drift is left to the frame corrections.
+        self.resample = resample and pcm.numpy is not None
+        self.drift = DriftEstimator()
+        self.resampler = None
+        # Frames added (removed if negative) by the corrections since resync
+        self.added_frames = 0
 
         # Used to quit main loop
         self.stop = False
@@ -37,7 +56,12 @@ class ChunkPlayer:
 
     def clear_state(self):
         "Clear player queue"
-        self.silence_to_insert = 0
+        if self.controller is not None:
+            self.controller.reset()
+        if self.resampler is not None:
+            self.resampler.reset()
+        self.drift.reset()
+        self.added_frames = 0
 
         # Clear the chunk list, but preserve CFG commands
         cfg = None
@@ -52,25 +76,32 @@ class ChunkPlayer:
 
         self.chunk_queue.do_recovery()
 
+        if self.audio_output is not None:
+            self.audio_output.clear()
+
     def _handle_cmd_drops(self, item):
         "Handle drops-detected command"
         if item > 200:
             print("Recovering after a huge packet loss of %d packets" % item)
             self.clear_state()
-        else:
-            # Just slowly resync
-            self.silence_to_insert += item
+        # Otherwise the next chunk will simply wait for its time
 
     def _handle_cmd_cfg(self, audio_config):
         "Handle configuration command"
         print("Got new configuration - opening audio stream")
         self.clear_state()
         del self.audio_output
-        self.audio_output = AudioOutput(audio_config, self.device_index, self.buffer_size)
+        self.audio_output = AudioOutput(audio_config, self.device_index, self.buffer_size,
+                                        callback=self.callback)
+        self.corrector = FrameCorrector(audio_config)
+        self.controller = SyncController(audio_config, self.corrector.max_frames)
+        self.drift = DriftEstimator()
+        if self.resample:
+            self.resampler = Resampler(audio_config)
         # Calculate maximum sensible delay in given configuration
-        self.max_delay = (2000 + self.audio_output.config.sink_latency_ms +
-                          self.audio_output.config.latency_ms) / 1000
-        print("Assuming maximum chunk delay of %.2fms in this setup" % (self.max_delay * 1000))
+        self.max_delay_ns = int((2000 + self.audio_output.config.sink_latency_ms +
+                                 self.audio_output.config.latency_ms) * 1000000)
+        print("Assuming maximum chunk delay of %.2fms in this setup" % (self.max_delay_ns / 1e6))
 
     async def _handle_empty_queue(self):
         "Handle case with the empty input queue"
@@ -79,6 +110,7 @@ class ChunkPlayer:
 
         self.chunk_queue.chunk_available.clear()
         # FIXME: This blocks. But instead we should be pumping data into output buffer.
+        # (In the callback mode the output plays silence on its own)
         await self.chunk_queue.chunk_available.wait()
 
         if self.audio_output is not None:
@@ -86,56 +118,118 @@ class ChunkPlayer:
             print("Got stream flowing. q_len=%d" % len(self.chunk_queue.chunk_list))
 
     async def _handle_cmd_audio(self, item):
-        "Handle chunk playback"
-        mid_tolerance_s = self.tolerance_ms / 2 / 1000
+        """
+        Handle chunk playback.
+
+        Chunk is written when the audio already buffered in the output ends
+        at its desired time. Clock drift, estimated from the error, is
+        compensated by resampling. Remaining error is corrected by adding or
+        removing a few frames. Only chunks late by more than the tolerance
+        are dropped whole.
+
+        Times are integer nanoseconds. Only the error, a small difference, is
+        passed in seconds to the controller and the drift estimator.
+        """
+        tolerance_ns = int(self.tolerance_ms * 1000000)
         one_ms = 1/1000.0
+        output = self.audio_output
+        frame_size = output.config.frame_size
 
         mark, chunk = item
-        desired_time = mark - self.audio_output.config.sink_latency_s
+        if trace.tracer:
+            trace.tracer.record(trace.DEQUEUED, mark)
+        desired_time = mark - output.config.sink_latency_ns
 
         # 0) We got the next chunk to be played
-        now = time_machine.now()
+        now = time_machine.now_ns()
 
         # Negative when we're lagging behind.
         delay = desired_time - now
 
-        self.stats.total_delay += delay
+        self.stats.total_delay_ns += delay
         self.stats.total_chunks += 1
+        if delay >= 0:
+            self.stats.delay_us.record(delay // 1000)
+        else:
+            self.stats.late_us.record(-delay // 1000)
 
-        # Probabilistic drop of lagging chunks to get back on track.
-        # Probability of drop is higher, the more chunk lags behind current
-        # time. Similar to the RED algorithm in TCP congestion.
-        if delay < -mid_tolerance_s:
-            over = -delay - mid_tolerance_s
-            prob = over / mid_tolerance_s
-            if random.random() < prob:
-                s = "Drop chunk: q_len=%2d delay=%.1fms < 0. tolerance=%.1fms: P=%.2f"
-                s = s % (len(self.chunk_queue.chunk_list),
-                         delay * 1000, self.tolerance_ms, prob)
-                print(s)
-                self.stats.time_drops += 1
-                return
-
-        elif delay > self.max_delay:
+        if delay > self.max_delay_ns:
             # Probably we hanged for so long time that the time recovering
             # mechanism rolled over. Recover
             print("Huge recovery - delay of %.2f exceeds the max delay of %.2f" % (
-                delay, self.max_delay))
+                delay / 1e9, self.max_delay_ns / 1e9))
             self.clear_state()
             return
 
-        # If chunk is in the future - wait until it's within the tolerance
-        elif delay > one_ms:
-            to_wait = max(one_ms, delay - one_ms)
-            await asyncio.sleep(to_wait)
+        # If chunk is in the future - wait until the buffered audio ends
+        # within a millisecond from its desired time.
+        early = delay - output.buffered_ns()
+        if early > 1000000:
+            await asyncio.sleep((early - 1000000) / 1e9)
+            now = time_machine.now_ns()
+
+        # Positive: chunk would be played too early.
+        error = desired_time - now - output.buffered_ns()
+
+        if error < -tolerance_ns:
+            # Too late to catch up smoothly.
+            s = "Drop chunk: q_len=%2d error=%.1fms < 0. tolerance=%.1fms"
+            s = s % (len(self.chunk_queue.chunk_list),
+                     error / 1e6, self.tolerance_ms)
+            print(s)
+            self.stats.time_drops += 1
+            self.controller.reset()
+            # Dropped audio shifts the error like removed frames
+            self.added_frames -= len(chunk) // frame_size
+            return
+
+        # A chunk lost while the output still had audio buffered leaves its
+        # slot empty - this chunk would follow the buffered audio directly
+        # and play early. Keep the slots of the missing chunks silent.
+        chunk_time_ns = len(chunk) // frame_size * 1000000000 // output.config.rate
+        gap = min((error + chunk_time_ns // 2) // chunk_time_ns, self.MAX_GAP_CHUNKS)
+        if gap > 0:
+            error -= gap * chunk_time_ns
+            self.stats.gap_chunks += gap
+
+        # Drift shows in the error as if no frames were added or removed.
+        size = len(chunk)
+        error = error / 1e9
+        self.drift.update(now / 1e9, error + self.added_frames / output.config.rate)
+        if self.resampler is not None and self.drift.drift:
+            self.resampler.ratio = self.drift.ratio
+            chunk = self.resampler.process(chunk)
+            self.stats.drift_ppm = self.drift.drift * 1e6
+
+        frames = self.controller.update(error)
+        if frames:
+            chunk = self.corrector.apply(chunk, frames)
+            self.stats.frames_corrected += abs(frames)
+        self.added_frames += (len(chunk) - size) // frame_size
+        if gap > 0:
+            chunk = bytes(gap * size) + chunk
 
         # Wait until we can write chunk into output buffer. This might
-        # delay us too much - the probabilistic dropping mechanism will kick
-        # in.
+        # delay us too much - the controller or dropping will kick in.
+        wait_start = perf_counter()
+        if output.callback:
+            waits = await output.wait_space(len(chunk))
+            if waits is None:
+                print("Hey, the output is STUCK!")
+                return
+            self.stats.output_delays += waits
+            self.stats.output_wait_us.record((perf_counter() - wait_start) * 1000000)
+            output.write(chunk)
+            if trace.tracer:
+                trace.tracer.record(trace.WRITTEN, mark)
+            self.stats.output_underruns_ms = output.underruns_ms
+            return
+
+        chunk_frames = len(chunk) // frame_size
         times = 0
         while True:
-            buffer_space = self.audio_output.get_write_available()
-            if buffer_space < self.audio_output.chunk_frames:
+            buffer_space = output.get_write_available()
+            if buffer_space < chunk_frames:
                 self.stats.output_delays += 1
                 await asyncio.sleep(one_ms)
                 times += 1
@@ -144,7 +238,10 @@ class ChunkPlayer:
                     await asyncio.sleep(1)
                     break
                 continue
-            self.audio_output.write(chunk)
+            self.stats.output_wait_us.record((perf_counter() - wait_start) * 1000000)
+            output.write(chunk)
+            if trace.tracer:
+                trace.tracer.record(trace.WRITTEN, mark)
             return
 
     async def chunk_player(self):
@@ -152,6 +249,11 @@ class ChunkPlayer:
 
         while not self.stop:
             if not self.chunk_queue.chunk_list:
+                # Don't wait for reordered chunks when there's nothing to play
+                lost = self.chunk_queue.flush_pending()
+                if lost:
+                    self.stats.network_drops += lost
+                    continue
                 await self._handle_empty_queue()
                 continue
 
@@ -174,6 +276,8 @@ class ChunkPlayer:
             await self._handle_cmd_audio(item)
 
             # Main status line
-            self.stats.chunk(queue_length=len(self.chunk_queue.chunk_list))
+            queue_length = len(self.chunk_queue.chunk_list)
+            self.stats.queue_length.record(queue_length)
+            self.stats.chunk(queue_length=queue_length)
 
         print("- Finishing chunk player")
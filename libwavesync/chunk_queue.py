@@ -1,17 +1,34 @@
+import copy
 import asyncio
 from collections import deque
 
 
 class ChunkQueue:
-    "Queue of packets"
+    """
+    Queue of packets
+
+    Audio chunks carrying a sequence number pass through a small reorder
+    window: duplicates are dropped, reordered chunks are put back in order and
+    gaps are detected immediately. Chunks without a sequence number (older
+    senders) are queued as they come.
+    """
 
     CMD_AUDIO = 1
     CMD_DROPS = 2
     CMD_CFG = 3
 
-    def __init__(self):
-        # NOTE: On LAN an unsorted deque works for me. Might need
-        # a packet ordering based on time mark eventually.
+    # Sequence numbers are 16 bit and wrap around
+    SEQUENCE_MOD = 0x10000
+
+    # Number of chunks held while waiting for a missing one
+    REORDER_WINDOW = 8
+
+    # Number of recently given up sequences remembered to tell their late
+    # arrival from a duplicate
+    MAX_SKIPPED = 256
+
+    def __init__(self, reorder_window=REORDER_WINDOW):
+        # Ordered by the reorder window, when the sender numbers the chunks.
         self.chunk_list = deque()
 
         self.chunk_available = asyncio.Event()
@@ -22,9 +39,31 @@ class ChunkQueue:
         self.chunk_no = 0
         self.last_sender_chunk_no = None
 
+        # Reordering state
+        self.reorder_window = reorder_window
+        self.sequenced = False
+        self.next_sequence = None
+        self.pending = {}
+        self.stale_run = 0
+        # Given up sequences, oldest first (dict as an ordered set)
+        self.skipped = {}
+
+        # Counters
+        self.duplicates = 0
+        self.reordered = 0
+        self.late = 0
+
     def init_queue(self):
         self.chunk_no = 0
         self.last_sender_chunk_no = None
+        self.sequenced = False
+        self._reset_sequence()
+
+    def _reset_sequence(self):
+        self.next_sequence = None
+        self.pending.clear()
+        self.stale_run = 0
+        self.skipped.clear()
 
     def do_recovery(self):
         "Flush the incoming, and probably stale, UDP buffer"
@@ -32,3 +71,165 @@ class ChunkQueue:
         self.ignore_audio_packets = 60
         self.last_sender_chunk_no = None
         self.chunk_no = 0
+        self._reset_sequence()
+
+    def _distance(self, sequence):
+        "Signed distance of the sequence from the next expected one"
+        half = self.SEQUENCE_MOD // 2
+        return (sequence - self.next_sequence + half) % self.SEQUENCE_MOD - half
+
+    def _release(self):
+        "Move pending chunks which are next in sequence to the chunk list"
+        while self.next_sequence in self.pending:
+            item = self.pending.pop(self.next_sequence)
+            self.chunk_list.append((self.CMD_AUDIO, item))
+            self.next_sequence = (self.next_sequence + 1) % self.SEQUENCE_MOD
+
+    def _skip_gap(self):
+        "Give up on the missing chunks and return their count"
+        lost = min(self._distance(sequence) for sequence in self.pending)
+        self.chunk_list.append((self.CMD_DROPS, lost))
+        for offset in range(max(0, lost - self.MAX_SKIPPED), lost):
+            self.skipped[(self.next_sequence + offset) % self.SEQUENCE_MOD] = None
+        while len(self.skipped) > self.MAX_SKIPPED:
+            del self.skipped[next(iter(self.skipped))]
+        self.next_sequence = (self.next_sequence + lost) % self.SEQUENCE_MOD
+        self._release()
+        return lost
+
+    def flush_pending(self):
+        """
+        Release all pending chunks, declaring the missing ones lost.
+
+        Used when the player has nothing else to play. Returns lost count.
+        """
+        lost = 0
+        while self.pending:
+            lost += self._skip_gap()
+        return lost
+
+    def put_audio(self, item, sequence=None):
+        """
+        Queue audio chunk, ordering it by the sequence number if given.
+
+        Returns number of chunks detected as lost on the network.
+        """
+        self.chunk_no += 1
+        if sequence is None:
+            self.chunk_list.append((self.CMD_AUDIO, item))
+            return 0
+
+        self.sequenced = True
+        if self.next_sequence is None:
+            self.next_sequence = sequence
+
+        distance = self._distance(sequence)
+        if distance < 0 and sequence in self.skipped:
+            # Arrived after giving up on it - too late to be played
+            del self.skipped[sequence]
+            self.late += 1
+            return 0
+
+        if distance < 0 or sequence in self.pending:
+            # Duplicated, or jumped back.
+            self.duplicates += 1
+            self.stale_run += 1
+            if self.stale_run > 2 * self.reorder_window:
+                # Rather a restarted sender - start over
+                print("Sequence numbers jumped back - resynchronising")
+                self._reset_sequence()
+            return 0
+
+        self.stale_run = 0
+        if distance == 0:
+            if self.pending:
+                # Filled a gap - came out of order
+                self.reordered += 1
+            self.pending[sequence] = item
+            self._release()
+            return 0
+
+        # Hold until the gap is filled or the window is exceeded
+        self.pending[sequence] = item
+        lost = 0
+        while self.pending:
+            newest = max(self._distance(pending) for pending in self.pending)
+            if newest < self.reorder_window:
+                break
+            lost += self._skip_gap()
+        return lost
+
+
+class OutputQueue(ChunkQueue):
+    """
+    Queue of a single output device fed by the ChunkFanOut.
+
+    Keeps the player interface of the ChunkQueue, but the reordering is done
+    once - in the shared queue. Configuration gets the device's sink latency.
+    """
+
+    def __init__(self, fan_out, sink_latency_ms):
+        super().__init__()
+        self.fan_out = fan_out
+        self.sink_latency_ms = sink_latency_ms
+
+    def put(self, cmd, item):
+        "Queue a command of the shared queue"
+        if cmd == self.CMD_CFG:
+            item = copy.copy(item)
+            item.sink_latency_ms = self.sink_latency_ms
+            item.sink_latency_s = self.sink_latency_ms / 1000.0
+            item.sink_latency_ns = int(self.sink_latency_ms * 1000000)
+        elif cmd == self.CMD_AUDIO and self.ignore_audio_packets:
+            self.ignore_audio_packets -= 1
+            return
+        self.chunk_list.append((cmd, item))
+        self.chunk_available.set()
+
+    def do_recovery(self):
+        "Skip the stale chunks of this output only"
+        self.ignore_audio_packets = 60
+
+    def flush_pending(self):
+        "Release chunks held by the shared queue for all outputs"
+        lost = self.fan_out.chunk_queue.flush_pending()
+        if lost:
+            self.fan_out.distribute()
+        return lost
+
+
+class ChunkFanOut:
+    """
+    Feed several output devices from a single receiver.
+
+    Commands of the shared queue are passed to the queue of each device, so
+    the network receive and decoding is done once, while each device is
+    played by its own ChunkPlayer - with its own sync loop.
+    """
+
+    def __init__(self, chunk_queue):
+        self.chunk_queue = chunk_queue
+        self.outputs = []
+        self.stop = False
+
+    def add_output(self, sink_latency_ms):
+        "Create queue of the next output device"
+        output = OutputQueue(self, sink_latency_ms)
+        self.outputs.append(output)
+        return output
+
+    def distribute(self):
+        "Move the commands of the shared queue to the outputs"
+        chunk_list = self.chunk_queue.chunk_list
+        while chunk_list:
+            cmd, item = chunk_list.popleft()
+            for output in self.outputs:
+                output.put(cmd, item)
+
+    async def run(self):
+        "Distribute the commands as they come"
+        chunk_available = self.chunk_queue.chunk_available
+        while not self.stop:
+            await chunk_available.wait()
+            chunk_available.clear()
+            self.distribute()
@@ -10,9 +10,19 @@ Socket
   ---  UDP datagrams  ---> [Receiver]
   --- chunks/commands ---> [ChunkPlayer]
   ---> pyaudio sink stream
+
+With several output devices the commands pass through [ChunkFanOut] to a
+ChunkPlayer per device.
+
+Relay:
+Socket
+  ---  UDP datagrams  ---> [Relay]
+  ---> Uni/Multicast UDP
 """
 
+import copy
 import asyncio
+import signal
 import socket
 
 from . import (
@@ -20,16 +30,40 @@ from . import (
     Packetizer,
     ChunkPlayer,
     ChunkQueue,
+    ChunkFanOut,
     SampleReader,
+    SilenceDetector,
     Receiver,
     Stats
 )
 
+from . import fec
+from . import trace
+from . import codec
+from .compression import AdaptiveCompression
+from .encode_pool import EncodePool
+from .clock_sync import ClockSync
+from .feedback import Reporter, FleetTable
+from .metrics import Metrics
+from .channel_map import create_groups, reader_payload_size
+from .relay import Relay
 from .cli_args import parse
 
 
-def start_tx(args, loop):
-    "Initialize sender"
+def start_metrics(args, metrics):
+    "Export metrics if requested"
+    if args.metrics_port:
+        print("Serving metrics on http://127.0.0.1:%d/metrics" % args.metrics_port)
+        asyncio.ensure_future(metrics.serve(args.metrics_port))
+    if args.metrics_file:
+        asyncio.ensure_future(metrics.write_periodically(args.metrics_file))
+
+
+def create_zone(args, loop, fleet, metrics, name=None):
+    """
+    Initialize sender of a single zone: input socket, audio configuration and
+    destinations. Returns (packetizer, encode pool or None).
+    """
 
     # Transmitted configuration
     audio_config = AudioConfig(rate=args.audio_rate,
@@ -38,9 +72,22 @@ def start_tx(args, loop):
                                latency_ms=args.latency_ms,
                                sink_latency_ms=args.sink_latency_ms)
 
+    silence_detector = SilenceDetector(audio_config,
+                                       threshold_db=args.silence_threshold_db,
+                                       hysteresis_db=args.silence_hysteresis_db,
+                                       metric=args.silence_metric)
+
     # Sound sample reader
-    sample_reader = SampleReader(audio_config)
-    sample_reader.payload_size = args.payload_size
+    sample_reader = SampleReader(audio_config, silence_detector)
+    sample_reader.header_size = Packetizer.HEADER_SIZES[args.header_version]
+    if args.fec:
+        # Parity datagram is slightly larger than the audio one
+        sample_reader.header_size += fec.OVERHEAD
+    groups = create_groups(args.channel_map)
+    sample_reader.payload_size = reader_payload_size(args.payload_size,
+                                                     sample_reader.header_size,
+                                                     audio_config, groups,
+                                                     full_stream=bool(args.ip_list))
 
     if args.local_play:
         chunk_queue = ChunkQueue()
@@ -49,17 +96,52 @@ def start_tx(args, loop):
                              stats,
                              tolerance_ms=args.tolerance_ms,
                              buffer_size=args.buffer_size,
-                             device_index=args.device_index)
+                             device_index=args.device_index,
+                             callback=args.callback_output,
+                             resample=args.resample)
         play = player.chunk_player()
         asyncio.ensure_future(play)
+        stats.register_metrics(metrics)
     else:
         chunk_queue = None
 
+    if args.codec == 'rice':
+        chunk_codec = codec.RiceCodec(audio_config)
+    elif args.codec == 'zlib' or args.compress is not False:
+        level = 6 if args.compress is False else args.compress
+        chunk_codec = codec.ZlibCodec(audio_config, level)
+    else:
+        chunk_codec = None
+
+    if args.adaptive_compression:
+        if args.codec == 'rice':
+            ladder = [chunk_codec]
+        else:
+            max_level = 9 if args.compress is False else args.compress
+            ladder = AdaptiveCompression.zlib_ladder(audio_config, max_level)
+        adaptive = AdaptiveCompression(audio_config, ladder,
+                                       budget=args.compress_budget / 100)
+    else:
+        adaptive = None
+
+    if args.encode_workers:
+        pool = EncodePool(sample_reader, chunk_codec, args.encode_workers)
+    else:
+        pool = None
+
     # Packet splitter / sender
     packetizer = Packetizer(sample_reader,
                             chunk_queue,
                             audio_config,
-                            compress=args.compress)
+                            compress=args.compress,
+                            header_version=args.header_version,
+                            fec=args.fec,
+                            codec=chunk_codec,
+                            adaptive=adaptive,
+                            pool=pool,
+                            fleet=fleet,
+                            groups=groups,
+                            name=name)
 
     packetizer.create_socket(args.ip_list,
                              args.ttl,
@@ -69,10 +151,46 @@ def start_tx(args, loop):
 
     connection = loop.create_unix_connection(lambda: sample_reader, args.tx)
 
-    # Start loop
+    if name is None:
+        packetizer.register_metrics(metrics)
+    else:
+        packetizer.register_metrics(metrics, prefix='zone_%s_' % name)
+
+    if pool is not None:
+        pool.start(audio_config.chunk_size)
     asyncio.ensure_future(packetizer.packetize())
     asyncio.ensure_future(connection)
-    loop.run_forever()
+    return packetizer, pool
+
+
+def start_tx(args, loop):
+    "Initialize sender - the main zone and the additional ones"
+
+    # Receiver reports of all zones
+    fleet = FleetTable(args.fleet_snapshot)
+    metrics = Metrics()
+
+    zones = [create_zone(args, loop, fleet, metrics)]
+    for zone in args.zones:
+        # Zone settings override the main ones
+        zone_args = copy.copy(args)
+        vars(zone_args).update(zone)
+        name = zone_args.name
+        print("Zone %s: %s -> %s" % (name, zone_args.tx,
+                                     ", ".join('%s:%d' % destination
+                                               for destination in zone_args.ip_list)))
+        zones.append(create_zone(zone_args, loop, fleet, metrics, name=name))
+
+    start_metrics(args, metrics)
+
+    # Start loop
+    asyncio.ensure_future(fleet.run())
+    try:
+        loop.run_forever()
+    finally:
+        for _, pool in zones:
+            if pool is not None:
+                pool.stop()
 
 
 def start_rx(args, loop):
@@ -83,27 +201,101 @@ def start_rx(args, loop):
     chunk_queue = ChunkQueue()
     stats = Stats()
 
+    # Output devices with their sink latencies
+    outputs = args.outputs or [(args.device_index, args.sink_latency_ms)]
+
+    if args.clock_sync:
+        clock_sync = ClockSync(stats)
+    else:
+        clock_sync = None
+
     receiver = Receiver(chunk_queue,
                         channel=channel,
-                        sink_latency_ms=args.sink_latency_ms,
+                        sink_latency_ms=outputs[0][1],
                         stats=stats)
 
-    connection = loop.create_datagram_endpoint(lambda: receiver,
-                                               family=socket.AF_INET,
-                                               local_addr=channel)
+    if args.rx_batch:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(channel)
+        sock.setblocking(False)
+        receiver.start_batched(sock, args.rx_batch)
+        connection = asyncio.sleep(0)
+    else:
+        connection = loop.create_datagram_endpoint(lambda: receiver,
+                                                   family=socket.AF_INET,
+                                                   local_addr=channel)
+
+    metrics = Metrics()
+    stats.register_metrics(metrics)
+
+    if len(outputs) > 1:
+        # Several devices fed from a single receiver
+        fan_out = ChunkFanOut(chunk_queue)
+        plays = [fan_out.run()]
+        for number, (device_index, sink_latency_ms) in enumerate(outputs):
+            output_queue = fan_out.add_output(sink_latency_ms)
+            if number == 0:
+                # First device shares the reported statistics
+                report_queue = output_queue
+                output_stats = stats
+            else:
+                output_stats = Stats(name='device%d' % device_index)
+                output_stats.register_metrics(metrics,
+                                              prefix='device%d_' % device_index)
+            player = ChunkPlayer(output_queue, output_stats,
+                                 tolerance_ms=args.tolerance_ms,
+                                 buffer_size=args.buffer_size,
+                                 device_index=device_index,
+                                 callback=args.callback_output,
+                                 resample=args.resample)
+            plays.append(player.chunk_player())
+    else:
+        # Coroutine pumping audio into PA
+        player = ChunkPlayer(chunk_queue, stats,
+                             tolerance_ms=args.tolerance_ms,
+                             buffer_size=args.buffer_size,
+                             device_index=outputs[0][0],
+                             callback=args.callback_output,
+                             resample=args.resample)
+        plays = [player.chunk_player()]
+        report_queue = chunk_queue
 
-    # Coroutine pumping audio into PA
-    player = ChunkPlayer(chunk_queue, stats,
-                         tolerance_ms=args.tolerance_ms,
-                         buffer_size=args.buffer_size,
-                         device_index=args.device_index)
+    start_metrics(args, metrics)
 
-    play = player.chunk_player()
+    if clock_sync is not None:
+        clock_sync.open(loop)
+        asyncio.ensure_future(clock_sync.run(lambda: receiver.sender_address))
 
-    tasks = asyncio.gather(connection, play)
+    if args.report_interval:
+        reporter = Reporter(stats, report_queue, args.report_interval)
+        asyncio.ensure_future(reporter.run(receiver.send_to_sender))
+
+    tasks = asyncio.gather(connection, *plays)
     loop.run_until_complete(tasks)
 
 
+def start_relay(args, loop):
+    "Initialize relay"
+    channel = args.ip_list[0]
+    relay = Relay(channel, args.relay_list, batch=args.rx_batch or 32)
+    relay.create_sockets(args.ttl, args.multicast_loop, args.source_address)
+    print("Relaying %s:%d -> %s" % (channel[0], channel[1],
+                                   ", ".join('%s:%d' % destination
+                                             for destination in args.relay_list)))
+
+    metrics = Metrics()
+    relay.register_metrics(metrics)
+    start_metrics(args, metrics)
+
+    relay.start(loop)
+    asyncio.ensure_future(relay.run())
+    try:
+        loop.run_forever()
+    finally:
+        relay.close(loop)
+
+
 def main():
     "Parse arguments and start the event loop"
     args = parse()
@@ -113,11 +305,18 @@ def main():
     if args.debug:
         loop.set_debug(True)
 
+    if args.trace:
+        tracer = trace.enable(args.trace, args.trace_size)
+        loop.add_signal_handler(signal.SIGUSR1, tracer.dump)
 
     try:
         if args.tx is not None:
             start_tx(args, loop)
         elif args.rx:
             start_rx(args, loop)
+        elif args.relay_list:
+            start_relay(args, loop)
     finally:
+        if trace.tracer:
+            trace.tracer.dump()
         loop.close()
@@ -1,6 +1,57 @@
 import os
 import argparse
 from . import VERSION
+from . import pcm
+from .channel_map import parse_channel_map
+
+
+def parse_zone(text, number):
+    """
+    Parse additional zone specification:
+    "input=PATH,channel=ADDRESS:PORT[,channel=...][,name=NAME][,rate=HZ]
+    [,channels=N][,24bits]". Returns dict of the options overriding the main
+    ones or raises ValueError.
+    """
+    zone = {
+        'name': 'zone%d' % number,
+        'tx': None,
+        'ip_list': [],
+        # Not supported in the additional zones
+        'local_play': False,
+        'channel_map': [],
+    }
+    for option in text.split(','):
+        key, separator, value = option.partition('=')
+        if key == '24bits' and not separator:
+            zone['audio_sample'] = True
+        elif not separator or not value:
+            raise ValueError("Zone option not in format KEY=VALUE: " + option)
+        elif key == 'input':
+            zone['tx'] = value
+        elif key == 'name':
+            if not value.replace('_', '').isalnum():
+                raise ValueError("Zone name can contain only letters, digits "
+                                 "and underscores: " + value)
+            zone['name'] = value
+        elif key == 'channel':
+            address, separator, port = value.rpartition(':')
+            if not separator:
+                raise ValueError("Zone channel not in format IP_ADDRESS:PORT: " + value)
+            try:
+                zone['ip_list'].append((address, int(port)))
+            except ValueError:
+                raise ValueError("Port is not a number in zone channel: " + value)
+        elif key in ('rate', 'channels'):
+            try:
+                zone['audio_' + key] = int(value)
+            except ValueError:
+                raise ValueError("Zone %s is not a number: %s" % (key, value))
+        else:
+            raise ValueError("Unknown zone option: " + key)
+
+    if zone['tx'] is None or not zone['ip_list']:
+        raise ValueError("Zone requires an input and at least one channel: " + text)
+    return zone
 
 
 def args_sender(snd):
@@ -39,6 +90,109 @@ def args_sender(snd):
                      type=int,
                      help="enable compression (level 1-9)")
 
+    snd.add_argument("--codec",
+                     choices=['zlib', 'rice'],
+                     default=None,
+                     help="compression codec: zlib (generic, level set by "
+                          "--compress, default 6) or rice (lossless audio "
+                          "codec, compresses music better but costs more "
+                          "CPU than zlib, requires NumPy)")
+
+    snd.add_argument("--adaptive-compression",
+                     action="store_true",
+                     default=False,
+                     help="select compression level (up to --compress) or "
+                          "turn it off depending on the measured CPU time "
+                          "and compression ratio")
+
+    snd.add_argument("--compress-budget",
+                     metavar="PERCENT",
+                     action="store",
+                     type=float,
+                     default=20,
+                     help="max part of the chunk time spent on compression "
+                          "in the adaptive mode (default 20%%)")
+
+    snd.add_argument("--encode-workers",
+                     metavar="PROCESSES",
+                     action="store",
+                     type=int,
+                     default=0,
+                     help="compress in separate worker processes - for high "
+                          "channel counts on multi-core machines "
+                          "(default 0 - compress in the main process)")
+
+    snd.add_argument("--silence-threshold",
+                     dest="silence_threshold_db",
+                     metavar="DBFS",
+                     action="store",
+                     type=float,
+                     default=-70,
+                     help="level below which input is treated as silence and "
+                          "not transmitted (default -70dBFS, requires NumPy)")
+
+    snd.add_argument("--silence-metric",
+                     choices=['peak', 'rms'],
+                     default='peak',
+                     help="level used for silence detection (default peak)")
+
+    snd.add_argument("--silence-hysteresis",
+                     dest="silence_hysteresis_db",
+                     metavar="DB",
+                     action="store",
+                     type=float,
+                     default=6,
+                     help="level increase over threshold required to end "
+                          "the silence (default 6dB)")
+
+    snd.add_argument("--header-version",
+                     metavar="VERSION",
+                     action="store",
+                     type=int,
+                     choices=[0, 1, 2],
+                     default=1,
+                     help="audio header format: 1 - with sequence numbers "
+                          "(default), 2 - microsecond time marks and latency "
+                          "up to 65s (newer receivers only), "
+                          "0 - compatible with older receivers")
+
+    snd.add_argument("--fec",
+                     metavar="CHUNKS",
+                     action="store",
+                     type=int,
+                     default=0,
+                     help="send a parity datagram every CHUNKS chunks to "
+                          "rebuild a lost one (2-255, bandwidth overhead "
+                          "1/CHUNKS, default 0 - disabled)")
+
+    snd.add_argument("--channel-map",
+                     metavar="CHANNELS=ADDRESS:PORT",
+                     action="append",
+                     default=[],
+                     help="send only the CHANNELS (comma separated, counted "
+                          "from 0) to the address, eg. 2,3=224.0.0.58:45300. "
+                          "Can be repeated. Receivers of the group play only "
+                          "its channels. Addresses given with --channel get "
+                          "all channels")
+
+    snd.add_argument("--zone",
+                     dest="zones",
+                     metavar="input=PATH,channel=ADDRESS:PORT[,...]",
+                     action="append",
+                     default=[],
+                     help="serve an additional zone with its own input socket "
+                          "and channels from the same process. Options: "
+                          "input, channel (repeatable), name, rate, channels "
+                          "and 24bits - unset ones are taken from the main "
+                          "zone. Can be repeated")
+
+    snd.add_argument("--fleet-snapshot",
+                     metavar="PATH",
+                     action="store",
+                     default=None,
+                     help="periodically write reports of the receivers to "
+                          "a JSON file (table is printed anyway)")
+
     snd.add_argument("--no-loop",
                      dest="multicast_loop",
                      action="store_false",
@@ -78,7 +232,9 @@ def args_receiver(rcv):
                      action="store",
                      type=int,
                      default=15,
-                     help="play error tolerance (default 15ms)")
+                     help="play error tolerance - later chunks are dropped, "
+                          "smaller errors are corrected by adding or removing "
+                          "single frames (default 15ms)")
 
     rcv.add_argument("--sink-latency",
                      dest="sink_latency_ms",
@@ -95,12 +251,60 @@ def args_receiver(rcv):
                      default=8192,
                      help="size of local output buffer in frames (default 8192)")
 
+    rcv.add_argument("--callback-output",
+                     action="store_true",
+                     default=False,
+                     help="feed the sound card from its own thread using a "
+                          "ring buffer - timing independent of the event "
+                          "loop load, silence is played on underruns")
+
+    rcv.add_argument("--no-resample",
+                     dest="resample",
+                     action="store_false",
+                     default=True,
+                     help="don't compensate the sound card clock drift by "
+                          "resampling (requires NumPy), leave it to the frame "
+                          "corrections")
+
+    rcv.add_argument("--clock-sync",
+                     action="store_true",
+                     default=False,
+                     help="synchronise the clock with the sender instead of "
+                          "relying on NTP - for networks where ntpd can't be "
+                          "used")
+
+    rcv.add_argument("--report-interval",
+                     metavar="SECONDS",
+                     action="store",
+                     type=float,
+                     default=2,
+                     help="send statistics to the sender this often "
+                          "(default 2s, 0 - disabled)")
+
+    rcv.add_argument("--rx-batch",
+                     metavar="DATAGRAMS",
+                     action="store",
+                     type=int,
+                     default=0,
+                     help="drain the socket in batches of given size using "
+                          "preallocated buffers (default 0 - disabled)")
+
     rcv.add_argument("--device-index",
                      metavar="NUMBER",
                      action="store",
                      type=int,
                      help="audio device index for playback")
 
+    rcv.add_argument("--output",
+                     dest="outputs",
+                     metavar="DEVICE_INDEX[:SINK_LATENCY_MS]",
+                     action="append",
+                     default=[],
+                     help="play on the given audio device, with its own sink "
+                          "latency (default --sink-latency). Can be repeated "
+                          "to play on several devices in sync - each is "
+                          "synchronised separately, stream is received once")
+
 
 def args_actions(act):
     "Define actions"
@@ -115,6 +319,17 @@ def args_actions(act):
                      default=False,
                      help="receive sound and play it")
 
+    act.add_argument("--relay",
+                     dest="relay_list",
+                     metavar="ADDRESS:PORT",
+                     action="append",
+                     default=[],
+                     help="forward the stream received on the --channel "
+                          "unchanged to the multicast group or unicast "
+                          "address - eg. to another subnet. May be given "
+                          "multiple times. --source-address selects the "
+                          "interface of the forwarded multicast")
+
 
 def args_common(opt):
     "Define common options"
@@ -132,11 +347,57 @@ def args_common(opt):
                      action="store",
                      help="source address for packets, needed for proper multicast routing")
 
+    opt.add_argument("--metrics-port",
+                     metavar="PORT",
+                     action="store",
+                     type=int,
+                     default=None,
+                     help="serve metrics with latency histograms on "
+                          "http://127.0.0.1:PORT/metrics (Prometheus format) "
+                          "and /metrics.json")
+
+    opt.add_argument("--metrics-file",
+                     metavar="PATH",
+                     action="store",
+                     default=None,
+                     help="write the metrics as JSON to a file every 10s")
+
+    opt.add_argument("--trace",
+                     metavar="PATH",
+                     action="store",
+                     default=None,
+                     help="record timestamps of each chunk on each stage and "
+                          "dump them to PATH.N when the buffer is full, on "
+                          "SIGUSR1 and on exit. Analyse with: "
+                          "python3 -m libwavesync.trace PATH.*")
+
+    opt.add_argument("--trace-size",
+                     metavar="EVENTS",
+                     action="store",
+                     type=int,
+                     default=65536,
+                     help="trace buffer size (default 65536 events, 17 bytes each)")
+
     opt.add_argument("--debug",
                      action="store_true",
                      help="enable debugging code")
 
 
+def parse_channel(parser, arg):
+    "Parse ADDRESS:PORT argument"
+    tmp = arg.split(':')
+    if len(tmp) != 2:
+        parser.error('TX/RX channel not in format IP_ADDRESS:PORT: ' + arg)
+    address, port = tmp
+
+    try:
+        port = int(port)
+    except ValueError:
+        parser.error('Port is not a number in channel: ' + arg)
+
+    return (address, port)
+
+
 def parse():
     "Parse program arguments"
     version = ".".join(str(p) for p in VERSION)
@@ -160,45 +421,129 @@ def parse():
 
     args = parser.parse_args()
 
-    if (args.tx is None) == (args.rx is False):
-        parser.error('Exactly one action: --tx or --rx must be specified')
+    actions = [args.tx is not None, args.rx, bool(args.relay_list)]
+    if actions.count(True) != 1:
+        parser.error('Exactly one action: --tx, --rx or --relay must be specified')
 
     if args.tx is not None:
         if not os.path.exists(args.tx):
             parser.error("--tx argument must point to a valid UNIX socket")
 
+    zones = []
+    for number, arg in enumerate(args.zones, 1):
+        try:
+            zone = parse_zone(arg, number)
+        except ValueError as ex:
+            parser.error(str(ex))
+        if not os.path.exists(zone['tx']):
+            parser.error("Zone input must point to a valid UNIX socket: " + zone['tx'])
+        zones.append(zone)
+    args.zones = zones
+
+    if zones and args.tx is None:
+        parser.error("Zones can be served only with --tx")
+
+    names = [zone['name'] for zone in zones]
+    if len(set(names)) != len(names):
+        parser.error("Zone names must be unique")
 
     if args.sink_latency_ms > args.latency_ms:
         parser.error("Sink latency cannot exceed system latency! Leave some margin too.")
 
-    if args.latency_ms >= 5000:
+    if args.header_version < 2 and args.latency_ms >= 29000:
+        parser.error("Latency shouldn't exceed 29s (in fact, it should work with latency < 5000). "
+                     "Use --header-version 2 for larger latencies.")
+    elif args.latency_ms > 0xffff:
+        # Limited by the status packet
+        parser.error("Latency can't exceed 65535ms")
+    elif args.latency_ms >= 5000:
         print("WARNING: You seem to be using large latency")
-    elif args.latency_ms >= 29000:
-        parser.error("Latency shouldn't exceed 29s (in fact, it should work with latency < 5000).")
+
+    if args.silence_threshold_db > 0 or args.silence_hysteresis_db < 0:
+        parser.error("Silence threshold must be <= 0dBFS and hysteresis >= 0dB")
+
+    if not 0 < args.compress_budget <= 100:
+        parser.error("Compression budget must be within 0-100%")
+
+    if args.encode_workers < 0:
+        parser.error("Number of encode workers can't be negative")
+
+    if args.encode_workers and args.compress is False and args.codec is None:
+        parser.error("Encode workers require compression (--compress or --codec)")
+
+    if args.encode_workers and args.adaptive_compression:
+        parser.error("Encode workers can't be used with adaptive compression")
+
+    if args.codec == 'rice' and pcm.numpy is None:
+        parser.error("Rice codec requires NumPy")
+
+    if args.fec and not 2 <= args.fec <= 255:
+        parser.error("FEC group must have from 2 to 255 chunks")
+
+    if args.fec and args.header_version < 1:
+        parser.error("FEC requires sequence numbers (--header-version 1)")
+
+    if args.trace_size < 1:
+        parser.error("Trace buffer must hold at least one event")
+
+    if args.report_interval < 0:
+        parser.error("Report interval can't be negative")
+
+    if args.rx_batch < 0:
+        parser.error("Receive batch size can't be negative")
 
     if args.device_index is not None and args.device_index < 0:
         parser.error("Device index can't be negative")
 
-    if not args.ip_list:
+    outputs = []
+    for arg in args.outputs:
+        device_index, _, sink_latency_ms = arg.partition(':')
+        try:
+            device_index = int(device_index)
+            sink_latency_ms = int(sink_latency_ms or args.sink_latency_ms)
+        except ValueError:
+            parser.error("Output not in format DEVICE_INDEX[:SINK_LATENCY_MS]: " + arg)
+        if device_index < 0 or sink_latency_ms < 0:
+            parser.error("Output device index and sink latency can't be negative: " + arg)
+        if sink_latency_ms > args.latency_ms:
+            parser.error("Sink latency cannot exceed system latency: " + arg)
+        outputs.append((device_index, sink_latency_ms))
+    args.outputs = outputs
+
+    if len(set(device_index for device_index, _ in outputs)) != len(outputs):
+        parser.error("Output device repeated")
+
+    if outputs and args.device_index is not None:
+        parser.error("Use either --device-index or --output")
+
+    channel_map = []
+    for arg in args.channel_map:
+        try:
+            channel_map.append(parse_channel_map(arg, args.audio_channels))
+        except ValueError as ex:
+            parser.error(str(ex))
+    args.channel_map = channel_map
+
+    if channel_map and args.tx is None:
+        parser.error("Channel map can be used only with --tx")
+
+    if channel_map and (args.encode_workers or args.adaptive_compression):
+        parser.error("Channel map can't be used with encode workers or "
+                     "adaptive compression")
+
+    if not args.ip_list and not channel_map:
         args.ip_list.append('224.0.0.57:45300')
 
-    if args.rx and len(args.ip_list) > 1:
+    if (args.rx or args.relay_list) and len(args.ip_list) > 1:
         parser.error('Receiver must have only a single channel (IP)')
 
     # Parse IP addresses
-    parsed_ip_list = []
-    for arg in args.ip_list:
-        tmp = arg.split(':')
-        if len(tmp) != 2:
-            parser.error('TX/RX channel not in format IP_ADDRESS:PORT: ' + arg)
-        address, port = tmp
-
-        try:
-            port = int(port)
-        except ValueError:
-            parser.error('Port is not a number in channel: ' + arg)
+    args.ip_list = [parse_channel(parser, arg) for arg in args.ip_list]
+    args.relay_list = [parse_channel(parser, arg) for arg in args.relay_list]
 
-        parsed_ip_list.append((address, port))
-    args.ip_list = parsed_ip_list
+    if (args.relay_list and args.ip_list[0] in args.relay_list and
+            not args.source_address):
+        parser.error('Relay would forward the stream to itself - use another '
+                     'address or --source-address')
 
     return args
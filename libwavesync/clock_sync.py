@@ -0,0 +1,179 @@
+"""
+Clock synchronisation between the sender and the receivers.
+
+Receivers periodically ask the sender for its time (NTP-like exchange) and
+estimate the offset of the sender's clock:
+
+  request (receiver -> sender):  [0x10][0][t1:8]
+  response (sender -> receiver): [0x10][1][t1:8][t2:8][t3:8]
+
+t1 - receiver time when sending the request, t2 - sender time when the
+request arrived, t3 - sender time when sending the response, t4 - receiver
+time when the response arrived. Then:
+
+  offset = ((t2 - t1) + (t3 - t4)) / 2
+  delay = (t4 - t1) - (t3 - t2)
+
+The offset is exact if the network delay is symmetric, its error is at most
+delay / 2. Of the last few samples the one with the lowest delay is used
+(the NTP clock filter) and the offset is smoothed.
+
+The sender answers to the address the request came from. The receiver's
+audio socket is usually bound to a multicast group and would never get a
+unicast response - the exchange runs on a socket of its own.
+"""
+
+import asyncio
+import socket
+import struct
+from collections import deque
+
+from libwavesync import time_machine
+
+
+FLAG_TIMESYNC = 0x10
+
+KIND_REQUEST = 0
+KIND_RESPONSE = 1
+
+REQUEST = struct.Struct('<BBd')
+RESPONSE = struct.Struct('<BBddd')
+
+
+def create_response(data, received):
+    """
+    Sender side - answer the time request.
+
+    Args:
+      data: received datagram
+      received: time of the datagram arrival
+    Returns:
+      response datagram or None if data is not a valid request.
+    """
+    if len(data) != REQUEST.size:
+        return None
+    flags, kind, requested = REQUEST.unpack(data)
+    if flags != FLAG_TIMESYNC or kind != KIND_REQUEST:
+        return None
+    return RESPONSE.pack(FLAG_TIMESYNC, KIND_RESPONSE, requested,
+                         received, time_machine.now())
+
+
+class ClockSync:
+    """
+    Receiver side - estimate the sender's clock offset and align the
+    time_machine to it.
+    """
+
+    # Seconds between requests
+    INTERVAL = 0.5
+
+    # First requests are sent faster to sync quickly after start
+    FAST_INTERVAL = 0.1
+    FAST_REQUESTS = 10
+
+    # Samples considered by the filter. Older samples are off by the drift
+    # of the clocks - keep them within few seconds.
+    SAMPLES = 8
+
+    # Part of the measured offset change applied per sample
+    GAIN = 0.25
+
+    # Larger differences are applied at once (seconds)
+    MAX_SLEW = 0.005
+
+    # Responses with longer round trip are ignored (seconds)
+    MAX_DELAY = 0.5
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.samples = deque(maxlen=self.SAMPLES)
+        self.offset = None
+        self.error = None
+        self.requests = 0
+        self.responses = 0
+
+        # Unicast socket for the exchange
+        self.sock = None
+
+    def open(self, loop):
+        "Bind own socket to an ephemeral port and wait for the responses"
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('0.0.0.0', 0))
+        self.sock.setblocking(False)
+        loop.add_reader(self.sock.fileno(), self._receive)
+
+    def close(self, loop):
+        "Stop waiting for the responses and close the socket"
+        loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+    def create_request(self):
+        "Request datagram"
+        self.requests += 1
+        return REQUEST.pack(FLAG_TIMESYNC, KIND_REQUEST,
+                            time_machine.local_now())
+
+    def handle_response(self, data):
+        "Update the estimate. Returns False if data is not a valid response"
+        received = time_machine.local_now()
+        if len(data) != RESPONSE.size:
+            return False
+        flags, kind, t1, t2, t3 = RESPONSE.unpack(data)
+        if flags != FLAG_TIMESYNC or kind != KIND_RESPONSE:
+            return False
+
+        delay = (received - t1) - (t3 - t2)
+        if not 0 <= delay <= self.MAX_DELAY:
+            # Not our request, or a broken one
+            return False
+        self.responses += 1
+        self.samples.append((delay, ((t2 - t1) + (t3 - received)) / 2))
+
+        delay, measured = min(self.samples)
+        if self.offset is None or abs(measured - self.offset) > self.MAX_SLEW:
+            self.offset = measured
+        else:
+            self.offset += self.GAIN * (measured - self.offset)
+        self.error = delay / 2
+
+        time_machine.set_offset(self.offset)
+        self.stats.clock_offset = self.offset
+        self.stats.clock_error = self.error
+        return True
+
+    def _receive(self):
+        "Socket is readable - handle the responses"
+        while True:
+            try:
+                data = self.sock.recv(RESPONSE.size + 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # ICMP error of a request - sender is not listening
+                continue
+            self.handle_response(data)
+
+    def send_request(self, address):
+        "Send request to the sender's address"
+        try:
+            self.sock.sendto(self.create_request(), address)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as ex:
+            print("WARNING: Unable to send time request:", ex)
+
+    async def run(self, sender_address):
+        """
+        Send requests to the address returned by `sender_address` once the
+        sender is known. The socket must be open.
+        """
+        while True:
+            address = sender_address()
+            if address is not None:
+                self.send_request(address)
+            if self.requests < self.FAST_REQUESTS:
+                await asyncio.sleep(self.FAST_INTERVAL)
+            else:
+                await asyncio.sleep(self.INTERVAL)
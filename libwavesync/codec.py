@@ -0,0 +1,239 @@
+"""
+Audio codecs compressing the chunks.
+
+Codec used for a chunk is identified by the bits of the first header byte
+masked with CODEC_MASK:
+  0x00 - raw PCM
+  0x80 - zlib (the original "compressed" flag)
+  0x01 - rice - lossless, audio-aware: per-channel linear prediction and Rice
+         coding of the residuals. Requires NumPy.
+"""
+
+import struct
+import zlib
+
+from libwavesync import pcm
+
+# Header bits which select the codec
+CODEC_MASK = 0x87
+
+
+class CodecError(Exception):
+    "Undecodable payload"
+
+
+class Codec:
+    "Raw PCM - no compression"
+
+    FLAG = 0x00
+    NAME = 'raw'
+
+    def __init__(self, audio_config=None):
+        self.audio_config = audio_config
+
+    def encode(self, chunk):
+        "Encode chunk. Returns bytes or None if chunk can't be encoded."
+        return chunk
+
+    def decode(self, data):
+        "Decode payload into raw PCM bytes, raise CodecError on error"
+        return bytes(data)
+
+
+class ZlibCodec(Codec):
+    "Generic zlib compression"
+
+    FLAG = 0x80
+    NAME = 'zlib'
+
+    def __init__(self, audio_config=None, level=6):
+        super().__init__(audio_config)
+        self.level = level
+
+    def encode(self, chunk):
+        return zlib.compress(chunk, self.level)
+
+    def decode(self, data):
+        try:
+            return zlib.decompress(data)
+        except zlib.error as ex:
+            raise CodecError(str(ex))
+
+
+class RiceCodec(Codec):
+    """
+    Lossless audio codec.
+
+    Each channel is predicted with a fixed polynomial predictor (order 0-2,
+    chosen per chunk) and the residuals are Rice coded. Rice codes are split
+    into two streams, so that both coding and decoding vectorize over all
+    channels: a fixed width stream of k low bits and an unary stream of the
+    high bits.
+
+    First `order` residuals of a channel are stored verbatim.
+
+    Payload:
+      [channels:1][sample bytes:1][frames:2]
+      [order of each channel:1][k of each channel:1]
+      [verbatim residuals: int32]
+      [remainders: k bits per residual, channel after channel]
+      [unary coded quotients]
+    """
+
+    FLAG = 0x01
+    NAME = 'rice'
+
+    HEADER = struct.Struct('<BBH')
+
+    MAX_ORDER = 2
+
+    def __init__(self, audio_config=None):
+        if pcm.numpy is None:
+            raise CodecError("Rice codec requires NumPy")
+        super().__init__(audio_config)
+        self._mask_cache = {}
+
+    def _masks(self, frames, orders, ks):
+        """
+        Mask of a (ch, frames) residual grid selecting the coded residuals
+        and indices of their k low bits in the flattened (ch, frames, 32)
+        bit grid.
+
+        Orders and k change rarely between chunks, so masks are cached.
+        """
+        np = pcm.numpy
+        key = (frames, orders.tobytes(), ks.tobytes())
+        masks = self._mask_cache.get(key)
+        if masks is None:
+            valid = np.arange(frames)[None, :] >= orders[:, None]
+            low_bits = np.arange(32)[None, :] >= (32 - ks)[:, None]
+            bit_index = np.flatnonzero(valid[:, :, None] & low_bits[:, None, :])
+            masks = (valid, bit_index)
+            if len(self._mask_cache) > 64:
+                self._mask_cache.clear()
+            self._mask_cache[key] = masks
+        return masks
+
+    def encode(self, chunk):
+        np = pcm.numpy
+        config = self.audio_config
+        samples = pcm.to_array(chunk, config.sample, config.channels)
+        channels = config.channels
+        frames = samples.shape[0]
+
+        # (order, channel, frame) residuals of all predictors. Residuals of
+        # 24 bit samples fit in 26 bits.
+        residuals = np.empty((self.MAX_ORDER + 1, channels, frames), dtype=np.int32)
+        residuals[0] = samples.T
+        for order in range(1, self.MAX_ORDER + 1):
+            residuals[order, :, 0] = residuals[order - 1, :, 0]
+            np.subtract(residuals[order - 1, :, 1:], residuals[order - 1, :, :-1],
+                        out=residuals[order, :, 1:])
+
+        costs = np.abs(residuals[:, :, self.MAX_ORDER:]).sum(axis=2)
+        orders = costs.argmin(axis=0)
+        residuals = residuals[orders, np.arange(channels)]
+        orders = orders.astype(np.uint8)
+
+        # Zigzag: 0, -1, 1, -2, 2 -> 0, 1, 2, 3, 4
+        unsigned = (residuals << 1) ^ (residuals >> 31)
+        for order in range(1, self.MAX_ORDER + 1):
+            unsigned[orders >= order, order - 1] = 0
+        means = unsigned.sum(axis=1) // (frames - orders.astype(np.int64))
+        ks = np.floor(np.log2(np.maximum(means, 1))).astype(np.uint8)
+        valid, bit_index = self._masks(frames, orders, ks)
+
+        quotients = (unsigned >> ks[:, None])[valid]
+        # Don't even try if it's going to be larger than the raw chunk
+        total_bits = int(quotients.sum()) + len(quotients)
+        if total_bits > 8 * len(chunk):
+            return None
+        unary = np.zeros(total_bits, dtype=np.uint8)
+        unary[(quotients + 1).cumsum() - 1] = 1
+
+        # Flat unpacking and a precomputed index are several times faster
+        # than unpacking along an axis and masking.
+        remainders = b''
+        if len(bit_index):
+            bits = np.unpackbits(unsigned.astype('>u4').view(np.uint8))
+            remainders = np.packbits(bits.take(bit_index)).tobytes()
+
+        return b''.join([
+            self.HEADER.pack(channels, config.sample // 8, frames),
+            orders.tobytes(),
+            ks.tobytes(),
+            residuals[~valid].astype('<i4').tobytes(),
+            remainders,
+            np.packbits(unary).tobytes(),
+        ])
+
+    def decode(self, data):
+        np = pcm.numpy
+        try:
+            channels, sample_bytes, frames = self.HEADER.unpack_from(data)
+            pos = self.HEADER.size
+            orders = np.frombuffer(data, dtype=np.uint8, count=channels, offset=pos)
+            ks = np.frombuffer(data, dtype=np.uint8, count=channels,
+                               offset=pos + channels)
+            pos += 2 * channels
+            if (channels == 0 or frames <= self.MAX_ORDER or
+                    sample_bytes not in (2, 3) or
+                    orders.max() > self.MAX_ORDER or ks.max() > 31):
+                raise ValueError("Invalid rice header")
+
+            verbatim_count = int(orders.sum())
+            verbatim = np.frombuffer(data, dtype='<i4', count=verbatim_count,
+                                     offset=pos)
+            pos += 4 * verbatim_count
+
+            counts = frames - orders.astype(np.int64)
+            remainder_count = int((counts * ks).sum())
+            remainder_size = (remainder_count + 7) // 8
+            remainders = np.unpackbits(np.frombuffer(data, dtype=np.uint8,
+                                                     count=remainder_size,
+                                                     offset=pos))
+            pos += remainder_size
+
+            unary = np.unpackbits(np.frombuffer(data, dtype=np.uint8, offset=pos))
+        except (struct.error, ValueError) as ex:
+            raise CodecError(str(ex))
+
+        quotient_count = int(counts.sum())
+        ends = np.flatnonzero(unary)[:quotient_count]
+        if len(ends) != quotient_count:
+            raise CodecError("Truncated rice payload")
+        valid, bit_index = self._masks(frames, orders, ks)
+
+        unsigned = np.zeros((channels, frames), dtype=np.int64)
+        unsigned[valid] = np.diff(ends, prepend=-1) - 1
+        unsigned <<= ks[:, None].astype(np.int64)
+
+        if len(bit_index):
+            bits = np.zeros(channels * frames * 32, dtype=np.uint8)
+            bits[bit_index] = remainders[:remainder_count]
+            unsigned |= np.packbits(bits).view('>u4').reshape(channels, frames)
+
+        residuals = (unsigned >> 1) ^ -(unsigned & 1)
+        residuals[~valid] = verbatim
+        for order in range(1, self.MAX_ORDER + 1):
+            integrated = np.cumsum(residuals, axis=1)
+            residuals = np.where((orders >= order)[:, None], integrated, residuals)
+
+        return pcm.from_array(residuals.T, 8 * sample_bytes)
+
+
+CODECS = {
+    codec.NAME: codec
+    for codec in (Codec, ZlibCodec, RiceCodec)
+}
+
+
+def decoders():
+    "Instances of all available codecs by their header flag"
+    available = {}
+    for codec in CODECS.values():
+        try:
+            available[codec.FLAG] = codec()
+        except CodecError:
+            pass
+    return available
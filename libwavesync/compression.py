@@ -0,0 +1,176 @@
+"""
+Adaptive compression.
+
+Picks a codec (or compression level) per window of chunks using the
+measured encode time against the chunk duration and the ratio achieved.
+"""
+
+from libwavesync.codec import ZlibCodec
+
+
+class AdaptiveCompression:
+    """
+    Select a codec from a ladder - cheapest first.
+
+    Each window of chunks:
+    - steps down (or turns compression off) if encoding took more than
+      `budget` of the chunk time, or if the chunks don't compress,
+    - steps up if there's plenty of time left and the stronger level
+      isn't known to compress the same.
+
+    With compression off, a level is probed every PROBE_WINDOWS windows.
+
+    Chunks predicted to be incompressible - after a run of cancelled
+    compressions - are sent raw without trying, with exponential backoff.
+    """
+
+    # Chunks per decision window (~0.5s)
+    WINDOW = 64
+
+    # Compression off - try again after this many windows
+    PROBE_WINDOWS = 8
+
+    # Forget measured ratios after this many windows
+    RATIO_WINDOWS = 32
+
+    # Window ratio above which compression isn't worth the CPU
+    MIN_SAVING_RATIO = 0.97
+
+    # Stronger level must be better by this much to be used
+    STEP_UP_GAIN = 0.01
+
+    # Max number of chunks skipped after incompressible ones
+    MAX_SKIP = 32
+
+    def __init__(self, audio_config, ladder, budget=0.2):
+        assert ladder
+        self.audio_config = audio_config
+        self.ladder = ladder
+        self.budget = budget
+
+        # Index in the ladder, -1 - compression is off
+        self.level = 0
+
+        # Window accumulators
+        self._chunks = 0
+        self._encoded = 0
+        self._time = 0.0
+        self._raw = 0
+        self._sent = 0
+
+        # Level -> measured ratio
+        self._ratios = {}
+        self._windows = 0
+        self._off_windows = 0
+
+        # Incompressible chunk prediction
+        self._misses = 0
+        self._max_misses = self.MAX_SKIP.bit_length() + 2
+        self._skip = 0
+
+        # Counters
+        self.skipped = 0
+        self.adjustments = 0
+
+    @classmethod
+    def zlib_ladder(cls, audio_config, max_level=9):
+        "Zlib levels up to max_level"
+        levels = [level for level in (1, 3, 6, 9) if level <= max_level]
+        return [ZlibCodec(audio_config, level) for level in levels or [1]]
+
+    @property
+    def name(self):
+        "Description of the current level"
+        if self.level < 0:
+            return 'off'
+        codec = self.ladder[self.level]
+        if isinstance(codec, ZlibCodec):
+            return '%s-%d' % (codec.NAME, codec.level)
+        return codec.NAME
+
+    def select(self):
+        "Codec to use for the next chunk or None to send it raw"
+        self._chunks += 1
+        if self._chunks >= self.WINDOW:
+            self._adapt()
+
+        if self.level < 0:
+            return None
+        if self._skip:
+            self._skip -= 1
+            self.skipped += 1
+            return None
+        return self.ladder[self.level]
+
+    def record(self, took, raw_size, sent_size):
+        "Store result of an encoded chunk: encode time and payload sizes"
+        self._encoded += 1
+        self._time += took
+        self._raw += raw_size
+        self._sent += sent_size
+
+        if sent_size >= raw_size * self.MIN_SAVING_RATIO:
+            # Capped once the skip reaches MAX_SKIP
+            self._misses = min(self._misses + 1, self._max_misses)
+            if self._misses >= 2:
+                self._skip = min(1 << (self._misses - 2), self.MAX_SKIP)
+        else:
+            self._misses = 0
+
+        # Single chunk over the whole chunk time - don't wait for the window
+        if took > self.audio_config.chunk_time:
+            self._step(self.level - 1)
+
+    def _step(self, level):
+        "Change the level"
+        level = max(-1, min(level, len(self.ladder) - 1))
+        if level != self.level:
+            self.level = level
+            self.adjustments += 1
+        self._reset_window()
+
+    def _reset_window(self):
+        self._chunks = 0
+        self._encoded = 0
+        self._time = 0.0
+        self._raw = 0
+        self._sent = 0
+
+    def _adapt(self):
+        "Decide the level for the next window"
+        self._windows += 1
+        if self._windows % self.RATIO_WINDOWS == 0:
+            self._ratios.clear()
+
+        if self._encoded == 0:
+            # Off, or all chunks skipped
+            if self.level < 0:
+                self._off_windows += 1
+                if self._off_windows >= self.PROBE_WINDOWS:
+                    self._off_windows = 0
+                    self._step(0)
+                    return
+            self._reset_window()
+            return
+
+        took = self._time / self._encoded
+        ratio = self._sent / self._raw
+        self._ratios[self.level] = ratio
+        budget = self.audio_config.chunk_time * self.budget
+
+        if took > budget or ratio > self.MIN_SAVING_RATIO:
+            self._step(self.level - 1)
+            return
+
+        cheaper = self._ratios.get(self.level - 1)
+        if cheaper is not None and cheaper - ratio < self.STEP_UP_GAIN:
+            # Same result for less CPU
+            self._step(self.level - 1)
+            return
+
+        stronger = self._ratios.get(self.level + 1)
+        if took < budget / 4 and (stronger is None or
+                                  ratio - stronger >= self.STEP_UP_GAIN):
+            self._step(self.level + 1)
+            return
+        self._reset_window()
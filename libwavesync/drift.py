@@ -0,0 +1,90 @@
+"""
+Estimation of the drift between the sender's and the receiver's clocks.
+"""
+
+from collections import deque
+
+
+class DriftEstimator:
+    """
+    Estimate the rate ratio of the output from the playback timing error.
+
+    The player corrects the error by adding or removing frames (resampling,
+    frame correction). Error without these corrections grows linearly with
+    the clock drift - its slope, fitted with least squares over the last
+    couple of minutes, is the drift.
+
+    Points are averaged over POINT_S seconds to keep the fit cheap and
+    reduce the measurement jitter.
+    """
+
+    # Seconds averaged into a single point
+    POINT_S = 1.0
+
+    # Number of points in the fit
+    MAX_POINTS = 120
+
+    # Minimal number of points before the estimate is used
+    MIN_POINTS = 10
+
+    # Drift larger than this is surely a measurement problem
+    MAX_DRIFT = 500e-6
+
+    def __init__(self):
+        self.points = deque(maxlen=self.MAX_POINTS)
+        self.drift = 0.0
+        self._sum_time = 0.0
+        self._sum_error = 0.0
+        self._count = 0
+        self._point_start = None
+
+    def reset(self):
+        "Forget the measurements - after a resync. Keeps the estimate."
+        drift = self.drift
+        self.__init__()
+        self.drift = drift
+
+    @property
+    def ratio(self):
+        "Output frames per input frame compensating the drift"
+        return 1.0 + self.drift
+
+    def update(self, now, error):
+        """
+        Add measurement: local time and the error corrected by nothing
+        (seconds, positive when the output plays too early).
+
+        Returns True if the estimate was updated.
+        """
+        if self._point_start is None:
+            self._point_start = now
+        self._sum_time += now
+        self._sum_error += error
+        self._count += 1
+        if now - self._point_start < self.POINT_S:
+            return False
+
+        self.points.append((self._sum_time / self._count,
+                            self._sum_error / self._count))
+        self._sum_time = self._sum_error = 0.0
+        self._count = 0
+        self._point_start = now
+
+        if len(self.points) < self.MIN_POINTS:
+            return False
+
+        # Least squares slope, relative to the first point for precision
+        t0, e0 = self.points[0]
+        n = len(self.points)
+        mean_t = sum(t - t0 for t, _ in self.points) / n
+        mean_e = sum(e - e0 for _, e in self.points) / n
+        cov = var = 0.0
+        for t, e in self.points:
+            dt = t - t0 - mean_t
+            cov += dt * (e - e0 - mean_e)
+            var += dt * dt
+        if var <= 0:
+            return False
+        drift = cov / var
+        self.drift = max(-self.MAX_DRIFT, min(self.MAX_DRIFT, drift))
+        return True
@@ -0,0 +1,216 @@
+"""
+Encode chunks in worker processes.
+
+Capture and chunking (SampleReader) and sending (Packetizer) stay in the main
+process; compression runs in workers. Chunks are exchanged through a shared
+memory ring, processes only pass fixed size records with slot numbers:
+
+  main -> worker (one pipe per worker): [slot:4][chunk length:4]
+  worker -> main (pipe shared by workers): [slot:4][encoded length:4]
+
+Encoded length is -1 if the chunk couldn't be compressed. Each slot holds the
+raw chunk followed by the space for its encoded version. Chunks are returned
+in the order they were read.
+"""
+
+import os
+import asyncio
+import struct
+import multiprocessing
+from collections import deque
+
+from libwavesync.ring_buffer import SharedRing
+
+
+RECORD = struct.Struct('<Ii')
+
+
+def _read_records(fd, pending):
+    "Read available records from a pipe. Returns (records, leftover bytes)"
+    data = os.read(fd, 64 * 1024)
+    if not data:
+        return None, pending
+    data = pending + data
+    whole = len(data) - len(data) % RECORD.size
+    return list(RECORD.iter_unpack(data[:whole])), data[whole:]
+
+
+def _worker(requests, results, ring_name, slot_size, slots, codec):
+    "Worker process main loop"
+    ring = SharedRing(slot_size, slots, name=ring_name)
+    capacity = slot_size // 2
+    view = ring.view
+    requests_fd = requests.fileno()
+    results_fd = results.fileno()
+    pending = b''
+    try:
+        while True:
+            records, pending = _read_records(requests_fd, pending)
+            if records is None:
+                break
+            for slot, length in records:
+                start = slot * slot_size
+                encoded = codec.encode(bytes(view[start:start + length]))
+                if encoded is None or len(encoded) >= length:
+                    size = -1
+                else:
+                    size = len(encoded)
+                    start += capacity
+                    view[start:start + size] = encoded
+                os.write(results_fd, RECORD.pack(slot, size))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del view
+        ring.close()
+
+
+class EncodePool:
+    """
+    Read chunks from the reader, encode them in worker processes and return
+    them in order.
+    """
+
+    def __init__(self, reader, codec, workers, slots=64):
+        assert workers >= 1 and slots >= 4
+        self.reader = reader
+        self.codec = codec
+        self.workers = workers
+        self.slots = slots
+
+        self.ring = None
+        self.processes = []
+        self._requests = []
+        self._results = None
+
+        # Chunks in the reading order: [slot, stream_time, length, encoded length]
+        # Encoded length is None until the result arrives.
+        self._order = deque()
+        self._by_slot = {}
+        self._free = []
+        self._returned = None
+        self._pending = b''
+
+        self._next_worker = 0
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._feeder = None
+
+    def start(self, capacity):
+        "Spawn the workers. Capacity is the maximal chunk size"
+        slot_size = 2 * capacity
+        self.ring = SharedRing(slot_size, self.slots)
+        self._raw = [self.ring.slot(i)[:capacity] for i in range(self.slots)]
+        self._encoded = [self.ring.slot(i)[capacity:] for i in range(self.slots)]
+        self._free = list(range(self.slots))
+
+        # Spawn - don't copy the parent with its event loop and sockets.
+        ctx = multiprocessing.get_context('spawn')
+        results_reader, results_writer = ctx.Pipe(duplex=False)
+        for _ in range(self.workers):
+            requests_reader, requests_writer = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_worker,
+                                  args=(requests_reader, results_writer,
+                                        self.ring.name, slot_size, self.slots,
+                                        self.codec),
+                                  daemon=True)
+            process.start()
+            requests_reader.close()
+            self.processes.append(process)
+            self._requests.append(requests_writer)
+        results_writer.close()
+        self._results = results_reader
+
+        loop = asyncio.get_event_loop()
+        loop.add_reader(self._results.fileno(), self._receive_results)
+        self._space.set()
+        self._feeder = asyncio.ensure_future(self._feed())
+
+    def stop(self):
+        "Stop the workers and free the shared memory"
+        self._release()
+        if self._feeder is not None:
+            self._feeder.cancel()
+        if self._results is not None:
+            asyncio.get_event_loop().remove_reader(self._results.fileno())
+        for requests in self._requests:
+            requests.close()
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        if self._results is not None:
+            self._results.close()
+        for view in self._raw + self._encoded:
+            view.release()
+        self._raw = self._encoded = []
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    async def _feed(self):
+        "Copy chunks from the reader into the ring and dispatch them"
+        while True:
+            stream_time, chunk = await self.reader.get_next_chunk()
+            while not self._free:
+                self._space.clear()
+                await self._space.wait()
+
+            slot = self._free.pop()
+            length = len(chunk)
+            self._raw[slot][:length] = chunk
+
+            item = [slot, stream_time, length, None]
+            self._order.append(item)
+            self._by_slot[slot] = item
+
+            requests = self._requests[self._next_worker]
+            self._next_worker = (self._next_worker + 1) % self.workers
+            os.write(requests.fileno(), RECORD.pack(slot, length))
+
+    def _receive_results(self):
+        "Read results of the workers"
+        records, self._pending = _read_records(self._results.fileno(),
+                                               self._pending)
+        if records is None:
+            print("WARNING: Encoding workers exited")
+            asyncio.get_event_loop().remove_reader(self._results.fileno())
+            return
+        for slot, size in records:
+            self._by_slot.pop(slot)[3] = size
+        if self._order and self._order[0][3] is not None:
+            self._ready.set()
+
+    def _release(self):
+        "Free the slot of the previously returned chunk"
+        if self._returned is None:
+            return
+        slot, views = self._returned
+        for view in views:
+            if view is not None:
+                try:
+                    view.release()
+                except BufferError:
+                    # Still used - it's going to be garbage collected
+                    pass
+        self._free.append(slot)
+        self._returned = None
+        self._space.set()
+
+    async def get_next_chunk(self):
+        """
+        Next chunk in the reading order.
+
+        Returns (stream time, chunk, encoded chunk or None). Chunks are views
+        of the shared ring, valid until the next call.
+        """
+        self._release()
+        while not self._order or self._order[0][3] is None:
+            self._ready.clear()
+            await self._ready.wait()
+
+        slot, stream_time, length, size = self._order.popleft()
+        chunk = self._raw[slot][:length]
+        encoded = self._encoded[slot][:size] if size >= 0 else None
+        self._returned = (slot, (chunk, encoded))
+        return stream_time, chunk, encoded
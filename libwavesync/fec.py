@@ -0,0 +1,150 @@
+"""
+Forward error correction of audio datagrams.
+
+Every `group_size` numbered audio datagrams the sender transmits a parity
+datagram - a XOR of the group. Receiver rebuilds a single lost datagram of a
+group from the others and the parity.
+
+Parity datagram:
+  [flags=0x20][version][first sequence:2][group size:1][length XOR:2][XOR]
+
+The XOR covers the audio datagrams without the version byte and the sequence
+number (both known from the parity header): [flags][mark][payload]. Shorter
+datagrams are padded with zeroes, so the parity is longer by at most
+OVERHEAD bytes than the longest audio datagram of the group.
+"""
+
+import struct
+from collections import deque
+
+
+FLAG_PARITY = 0x20
+
+PARITY_HEADER = struct.Struct('>BBHBH')
+
+# Parity datagram size over the audio datagram
+OVERHEAD = PARITY_HEADER.size - 3
+
+SEQUENCE_MOD = 0x10000
+
+
+def _split(dgram, header_size):
+    "Audio datagram -> XORed part as a little endian integer and its length"
+    mark_end = header_size - 2
+    body = bytes(dgram[0:1]) + bytes(dgram[2:mark_end]) + bytes(dgram[header_size:])
+    return int.from_bytes(body, 'little'), len(body)
+
+
+class FecEncoder:
+    "Calculate parity datagrams on the sender"
+
+    def __init__(self, group_size, header_version):
+        assert group_size >= 2
+        self.group_size = group_size
+        self.header_version = header_version
+
+        self._first = None
+        self._count = 0
+        self._xor = 0
+        self._length_xor = 0
+        self._max_length = 0
+
+    def add(self, sequence, parts):
+        """
+        Add audio datagram given as parts [flags, mark + sequence, payload].
+
+        Returns parity datagram when the group is complete, otherwise None.
+        """
+        if self._count == 0:
+            self._first = sequence
+
+        # Equivalent to _split() of the joined datagram
+        head = parts[0][0:1] + parts[1][:-2]
+        body = int.from_bytes(head, 'little')
+        body |= int.from_bytes(parts[2], 'little') << (8 * len(head))
+        length = len(head) + len(parts[2])
+
+        self._xor ^= body
+        self._length_xor ^= length
+        self._max_length = max(self._max_length, length)
+        self._count += 1
+
+        if self._count < self.group_size:
+            return None
+
+        parity = PARITY_HEADER.pack(FLAG_PARITY, self.header_version,
+                                    self._first, self._count,
+                                    self._length_xor)
+        parity += self._xor.to_bytes(self._max_length, 'little')
+
+        self._count = 0
+        self._xor = 0
+        self._length_xor = 0
+        self._max_length = 0
+        return parity
+
+
+class FecDecoder:
+    """
+    Keep recently received audio datagrams and rebuild lost ones.
+
+    Becomes active after the first parity datagram, so nothing is stored
+    when the sender doesn't use FEC.
+    """
+
+    # Number of recent datagrams remembered
+    HISTORY = 128
+
+    def __init__(self):
+        self.active = False
+        self.received = {}
+        self._order = deque()
+
+        # Counters
+        self.recovered = 0
+        self.unrecoverable = 0
+
+    def store(self, sequence, dgram):
+        "Remember received audio datagram"
+        if sequence in self.received:
+            return
+        self.received[sequence] = bytes(dgram)
+        self._order.append(sequence)
+        if len(self._order) > self.HISTORY:
+            del self.received[self._order.popleft()]
+
+    def recover(self, parity, header_size):
+        """
+        Handle parity datagram.
+
+        Returns (group size, rebuilt audio datagram or None).
+        """
+        self.active = True
+        (_, version, first,
+         count, length_xor) = PARITY_HEADER.unpack_from(parity)
+
+        members = [(first + i) % SEQUENCE_MOD for i in range(count)]
+        missing = [sequence for sequence in members
+                   if sequence not in self.received]
+        if not missing:
+            return count, None
+        if len(missing) > 1:
+            self.unrecoverable += len(missing)
+            return count, None
+
+        body = int.from_bytes(parity[PARITY_HEADER.size:], 'little')
+        for sequence in members:
+            if sequence == missing[0]:
+                continue
+            value, length = _split(self.received[sequence], header_size)
+            body ^= value
+            length_xor ^= length
+
+        body = body.to_bytes(length_xor, 'little')
+        mark_end = header_size - 2
+        sequence = struct.pack('>H', missing[0])
+        dgram = (body[0:1] + bytes([version]) + body[1:mark_end - 1] +
+                 sequence + body[mark_end - 1:])
+        self.recovered += 1
+        self.store(missing[0], dgram)
+        return count, dgram
@@ -0,0 +1,207 @@
+"""
+Receiver feedback.
+
+Receivers periodically send a small report with their statistics to the
+sender (similar to RTCP receiver reports). The sender keeps the latest report
+of each receiver in a table, prints it and optionally writes it as a JSON
+snapshot for monitoring.
+
+Report: [0x08][version=0][statistics][receiver name:32]
+"""
+
+import math
+import socket
+import struct
+import asyncio
+
+from libwavesync import time_machine
+from libwavesync.metrics import write_json
+
+
+FLAG_REPORT = 0x08
+
+REPORT_VERSION = 0
+
+# Report fields - in the order of the REPORT structure
+FIELDS = (
+    'queue_length',
+    'chunks',
+    'time_drops',
+    'network_drops',
+    'output_delays',
+    'duplicates',
+    'reordered',
+    'fec_recovered',
+    'fec_lost',
+    'frames_corrected',
+    'underruns_ms',
+    'avg_delay_ms',
+    'latency_ms',
+    'clock_error_ms',
+    'drift_ppm',
+)
+
+REPORT = struct.Struct('<BBH10I4f32s')
+
+
+class Reporter:
+    "Receiver side - send reports to the sender"
+
+    def __init__(self, stats, chunk_queue, interval=2.0, name=None):
+        self.stats = stats
+        self.chunk_queue = chunk_queue
+        self.interval = interval
+        if name is None:
+            name = socket.gethostname()
+        self.name = name.encode('utf-8')[:32]
+        self.sent = 0
+
+    def create_report(self):
+        "Report datagram with the current statistics"
+        stats = self.stats
+        counters = [
+            stats.total_chunks,
+            stats.time_drops,
+            stats.network_drops,
+            stats.output_delays,
+            stats.duplicates,
+            stats.reordered,
+            stats.fec_recovered,
+            stats.fec_unrecoverable,
+            stats.frames_corrected,
+            stats.output_underruns_ms,
+        ]
+        if stats.total_chunks:
+            avg_delay = stats.total_delay_ns / stats.total_chunks / 1e9
+        else:
+            avg_delay = 0.0
+        clock_error = stats.clock_error
+        return REPORT.pack(FLAG_REPORT, REPORT_VERSION,
+                           min(len(self.chunk_queue.chunk_list), 0xffff),
+                           *[int(value) & 0xffffffff for value in counters],
+                           1000.0 * avg_delay,
+                           1000.0 * stats.network_latency,
+                           math.nan if clock_error is None else 1000.0 * clock_error,
+                           stats.drift_ppm,
+                           self.name)
+
+    async def run(self, send):
+        "Send reports using the `send` function"
+        while True:
+            await asyncio.sleep(self.interval)
+            send(self.create_report())
+            self.sent += 1
+
+
+def parse_report(data):
+    "Report datagram -> (receiver name, dict of fields) or None if invalid"
+    if len(data) != REPORT.size:
+        return None
+    values = REPORT.unpack(data)
+    if values[0] != FLAG_REPORT or values[1] != REPORT_VERSION:
+        return None
+    name = values[-1].rstrip(b'\x00').decode('utf-8', 'replace')
+    report = dict(zip(FIELDS, values[2:-1]))
+    for field in ('avg_delay_ms', 'latency_ms', 'clock_error_ms', 'drift_ppm'):
+        value = report[field]
+        report[field] = None if math.isnan(value) else round(value, 3)
+    return name, report
+
+
+class FleetTable:
+    """
+    Sender side - latest reports of all receivers.
+
+    Handling a report is a single unpack and a dictionary update, the table
+    is printed and saved on a timer.
+    """
+
+    # Receivers silent for longer are shown as stale...
+    STALE_S = 10
+
+    # ...and forgotten after this time
+    FORGET_S = 120
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+
+        # "address:port name" -> receiver entry. Receivers behind a relay
+        # share its address.
+        self.receivers = {}
+        self.invalid = 0
+
+    def handle(self, data, address):
+        "Store report received from address. Returns False if invalid"
+        parsed = parse_report(bytes(data))
+        if parsed is None:
+            self.invalid += 1
+            return False
+        name, report = parsed
+        key = '%s:%d %s' % (address[0], address[1], name)
+        entry = self.receivers.get(key)
+        if entry is None:
+            entry = self.receivers[key] = {'address': '%s:%d' % address,
+                                           'reports': 0}
+        entry['name'] = name
+        entry['last_seen'] = time_machine.now()
+        entry['reports'] += 1
+        entry.update(report)
+        return True
+
+    def prune(self, now):
+        "Forget receivers which stopped reporting"
+        for key, entry in list(self.receivers.items()):
+            if now - entry['last_seen'] > self.FORGET_S:
+                del self.receivers[key]
+
+    def snapshot(self, now):
+        "Machine-readable state of the fleet"
+        receivers = []
+        for key in sorted(self.receivers):
+            entry = dict(self.receivers[key])
+            entry['age_s'] = round(now - entry['last_seen'], 3)
+            entry['stale'] = entry['age_s'] > self.STALE_S
+            receivers.append(entry)
+        return {
+            'time': now,
+            'receivers': receivers,
+        }
+
+    def write_snapshot(self, now):
+        "Atomically replace the snapshot file"
+        write_json(self.snapshot_path, self.snapshot(now))
+
+    def format(self, now):
+        "Table lines for the console"
+        lines = [
+            "FLEET: %d receivers" % len(self.receivers),
+            "  %-21s %-16s %4s %7s %6s %6s %6s %7s %7s %7s %8s %5s" % (
+                'address', 'name', 'q', 'chunks', 'late', 'net',
+                'out', 'fec', 'delay', 'lat', 'drift', 'age'),
+        ]
+        for entry in self.snapshot(now)['receivers']:
+            drift = entry['drift_ppm']
+            lines.append(
+                "  %-21s %-16s %4d %7d %6d %6d %6d %7d %7.2f %7.2f %8s %4.0fs%s" % (
+                    entry['address'], entry['name'][:16],
+                    entry['queue_length'], entry['chunks'],
+                    entry['time_drops'], entry['network_drops'],
+                    entry['output_delays'], entry['fec_recovered'],
+                    entry['avg_delay_ms'] or 0.0, entry['latency_ms'] or 0.0,
+                    '-' if not drift else '%+.1fppm' % drift,
+                    entry['age_s'], ' STALE' if entry['stale'] else ''))
+        return lines
+
+    async def run(self, interval=10.0):
+        "Print the table and write the snapshot periodically"
+        while True:
+            await asyncio.sleep(interval)
+            now = time_machine.now()
+            self.prune(now)
+            if self.snapshot_path is not None:
+                try:
+                    self.write_snapshot(now)
+                except OSError as ex:
+                    print("WARNING: Unable to write fleet snapshot:", ex)
+            if self.receivers:
+                print("\n".join(self.format(now)))
@@ -0,0 +1,642 @@
+"""
+Network impairment simulator.
+
+A local UDP proxy sits between the sender and the receivers and forwards
+each datagram to every receiver over an independently impaired link: lost
+(in bursts - Gilbert-Elliott model), delayed with jitter, reordered and
+duplicated. Datagrams sent back by the receivers (reports, time requests)
+are passed to the sender unchanged.
+
+Proxy between real WaveSync instances:
+
+  python3 -m libwavesync.impair proxy --listen 127.0.0.1:45300 \\
+      --to 127.0.0.1:45301 --to 127.0.0.1:45302 --loss 0.02 --jitter-ms 5
+
+Headless sync-quality test - a Packetizer, the proxy and few Receivers with
+ChunkPlayers playing into simulated sound cards, all in one process:
+
+  python3 -m libwavesync.impair test [--scenario NAME ...] [--json PATH]
+
+The sender plays a ramp (frame number in the samples), so the simulated
+cards tell exactly which frame is played when. Reported are the playout
+errors, the skew between the receivers and the drop/recovery counters.
+Cards read in blocks (like PortAudio), so the errors include up to a block
+(2ms) of constant offset - the skew between the receivers doesn't.
+"""
+
+import io
+import sys
+import json
+import random
+import socket
+import asyncio
+import argparse
+import contextlib
+
+from libwavesync import (
+    AudioConfig,
+    ChunkQueue,
+    ChunkPlayer,
+    Packetizer,
+    Receiver,
+    SampleReader,
+    Stats,
+    time_machine,
+)
+from libwavesync.metrics import Histogram
+
+
+class Impairment:
+    """
+    Impairments of a single link.
+
+    Args:
+      loss: average part of lost datagrams
+      burst: average length of a loss burst (1 - independent losses)
+      delay_ms: constant delay
+      jitter_ms: average additional delay
+      jitter: distribution of the additional delay: uniform, normal,
+              exponential or pareto (heavy tail, like Wi-Fi retransmissions)
+      reorder: part of datagrams held back by reorder_ms
+      duplicate: part of datagrams delivered twice
+      seed: random seed of the link
+    """
+
+    JITTERS = ('uniform', 'normal', 'exponential', 'pareto')
+
+    def __init__(self, loss=0.0, burst=1.0, delay_ms=0.0, jitter_ms=0.0,
+                 jitter='normal', reorder=0.0, reorder_ms=10.0,
+                 duplicate=0.0, seed=None):
+        assert 0 <= loss < 1 and burst >= 1
+        assert jitter in self.JITTERS
+        self.loss = loss
+        self.burst = burst
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_ms = reorder_ms
+        self.duplicate = duplicate
+        self.random = random.Random(seed)
+
+        # Gilbert-Elliott: all datagrams are lost in the bad state. Average
+        # stay in the bad state is `burst` datagrams, the good state is
+        # entered so that `loss` of time is spent in the bad one.
+        self._to_good = 1 / burst
+        self._to_bad = loss * self._to_good / (1 - loss)
+        self._bad = False
+
+    def describe(self):
+        "Parameters for the reports"
+        return {
+            'loss': self.loss,
+            'burst': self.burst,
+            'delay_ms': self.delay_ms,
+            'jitter_ms': self.jitter_ms,
+            'jitter': self.jitter,
+            'reorder': self.reorder,
+            'reorder_ms': self.reorder_ms,
+            'duplicate': self.duplicate,
+        }
+
+    def _jitter_s(self):
+        "Random additional delay"
+        mean = self.jitter_ms
+        if not mean:
+            return 0.0
+        rnd = self.random
+        if self.jitter == 'uniform':
+            value = rnd.uniform(0, 2 * mean)
+        elif self.jitter == 'normal':
+            # Half-normal distribution with the given mean
+            value = abs(rnd.gauss(0, mean * 1.2533))
+        elif self.jitter == 'exponential':
+            value = rnd.expovariate(1 / mean)
+        else:
+            # Pareto with shape 3 shifted to start at 0 has mean of scale / 2
+            value = 2 * mean * (rnd.paretovariate(3) - 1)
+        return value / 1000
+
+    def _delay_s(self):
+        "Delay of a single copy"
+        delay = self.delay_ms / 1000 + self._jitter_s()
+        if self.reorder and self.random.random() < self.reorder:
+            delay += self.reorder_ms / 1000
+        return delay
+
+    def schedule(self):
+        "Delays (seconds) of the copies of the next datagram - empty if lost"
+        rnd = self.random
+        if self._bad:
+            self._bad = rnd.random() >= self._to_good
+        else:
+            self._bad = rnd.random() < self._to_bad
+        if self._bad:
+            return []
+
+        delays = [self._delay_s()]
+        if self.duplicate and rnd.random() < self.duplicate:
+            delays.append(self._delay_s())
+        return delays
+
+
+# Test scenarios: name -> Impairment arguments
+SCENARIOS = {
+    'clean': {},
+    'loss': {'loss': 0.02},
+    'burst': {'loss': 0.02, 'burst': 4},
+    'jitter': {'delay_ms': 2, 'jitter_ms': 5, 'jitter': 'normal'},
+    'pareto': {'delay_ms': 2, 'jitter_ms': 5, 'jitter': 'pareto'},
+    'reorder': {'reorder': 0.05, 'reorder_ms': 5},
+    'duplicate': {'duplicate': 0.05},
+    'wifi': {'loss': 0.01, 'burst': 3, 'delay_ms': 2, 'jitter_ms': 4,
+             'jitter': 'pareto', 'reorder': 0.01, 'duplicate': 0.01},
+}
+
+
+class _Link(asyncio.DatagramProtocol):
+    "Proxy side of a single receiver: impaired forwarding, replies back"
+
+    def __init__(self, proxy, target, impairment):
+        self.proxy = proxy
+        self.target = target
+        self.impairment = impairment
+        self.transport = None
+
+        # Counters
+        self.forwarded = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.replies = 0
+
+        super().__init__()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def forward(self, data):
+        "Send the datagram over the impaired link"
+        delays = self.impairment.schedule()
+        if not delays:
+            self.lost += 1
+            return
+        self.forwarded += 1
+        self.duplicated += len(delays) - 1
+        loop = asyncio.get_event_loop()
+        for delay in delays:
+            if delay > 0:
+                loop.call_later(delay, self._send, data)
+            else:
+                self._send(data)
+
+    def _send(self, data):
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.transport.sendto(data, self.target)
+
+    def datagram_received(self, data, addr):
+        "Reply from the receiver - pass it to the sender"
+        self.replies += 1
+        self.proxy.reply(data)
+
+    def error_received(self, exc):
+        # Receiver not listening (yet) - like on a real network
+        pass
+
+    def describe(self):
+        "Link counters"
+        return {
+            'target': '%s:%d' % self.target,
+            'forwarded': self.forwarded,
+            'lost': self.lost,
+            'duplicated': self.duplicated,
+            'replies': self.replies,
+        }
+
+
+class ImpairmentProxy(asyncio.DatagramProtocol):
+    "Forwards datagrams from the sender to the receivers over impaired links"
+
+    def __init__(self, targets, impairments):
+        assert len(targets) == len(impairments)
+        self.links = [_Link(self, target, impairment)
+                      for target, impairment in zip(targets, impairments)]
+        self.transport = None
+        self.sender_address = None
+        self.received = 0
+        super().__init__()
+
+    async def start(self, listen=('127.0.0.1', 0)):
+        "Open the sockets. Returns the address the sender should send to"
+        loop = asyncio.get_event_loop()
+        for link in self.links:
+            await loop.create_datagram_endpoint(lambda link=link: link,
+                                                family=socket.AF_INET,
+                                                local_addr=('0.0.0.0', 0))
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, family=socket.AF_INET, local_addr=listen)
+        return self.transport.get_extra_info('sockname')
+
+    def close(self):
+        for link in self.links:
+            if link.transport is not None:
+                link.transport.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.sender_address = addr
+        for link in self.links:
+            link.forward(data)
+
+    def error_received(self, exc):
+        pass
+
+    def reply(self, data):
+        "Pass datagram from a receiver to the sender"
+        if self.sender_address is not None:
+            self.transport.sendto(data, self.sender_address)
+
+
+class _RampSource:
+    """
+    Reader generating a ramp in real time: each sample holds the number of
+    its frame (modulo 2^16).
+    """
+
+    PERIOD = 0x10000
+
+    def __init__(self, audio_config):
+        assert audio_config.sample == 16
+        self.audio_config = audio_config
+        channels = audio_config.channels
+        ramp = b''.join(frame.to_bytes(2, 'little') * channels
+                        for frame in range(self.PERIOD))
+        # Doubled - chunks are slices crossing the period end
+        self.ramp = memoryview(ramp + ramp)
+        self.start = None
+        self.frame = 0
+
+    async def get_next_chunk(self):
+        config = self.audio_config
+        if self.start is None:
+            self.start = time_machine.now_ns()
+        stream_time = self.start + self.frame * 1000000000 // config.rate
+        wait = stream_time - time_machine.now_ns()
+        if wait > 0:
+            await asyncio.sleep(wait / 1e9)
+        offset = (self.frame % self.PERIOD) * config.frame_size
+        self.frame += config.chunk_size // config.frame_size
+        return stream_time, self.ramp[offset:offset + config.chunk_size]
+
+
+class _SoundCard:
+    """
+    Simulated output device playing from the player's ring at its own clock
+    rate (off by `ppm`), in blocks every few milliseconds.
+    """
+
+    def __init__(self, player, ppm):
+        self.player = player
+        self.ppm = ppm
+        self.start = None
+        self.played = 0
+
+    def play(self, now, source):
+        """
+        Consume frames due at `now`. Returns the playout error (seconds,
+        positive when late) of the first frame, or None if unknown.
+        """
+        output = self.player.audio_output
+        if self.start is None:
+            self.start = now
+        config = source.audio_config
+        speed = config.rate * (1 + self.ppm * 1e-6)
+        due = int((now - self.start) * speed) - self.played
+        if due <= 0:
+            return None
+        # Device time of the first frame of the block
+        played_at = self.start + self.played / speed
+        self.played += due
+
+        if output is None or source.start is None:
+            return None
+        frame_size = config.frame_size
+        complete = output.ring.available() >= 2 * frame_size
+        block = output.ring.read(due * frame_size)
+        if not complete or due < 2:
+            return None
+
+        # Two consecutive ramp values - splices and resampling might
+        # produce nonsense at the ramp wrap. Zeroes are the silence played
+        # in the slot of a lost chunk.
+        value = int.from_bytes(block[:2], 'little')
+        step = (int.from_bytes(block[frame_size:frame_size + 2], 'little') -
+                value) % source.PERIOD
+        if step > 2 or (value == 0 and step == 0):
+            return None
+
+        start = source.start / 1e9
+        expected = (played_at - start - config.latency_s) * config.rate
+        frame = value + source.PERIOD * round((expected - value) / source.PERIOD)
+        return played_at - (start + frame / config.rate + config.latency_s)
+
+
+# Receiver statistics in the scenario report
+STAT_FIELDS = (
+    'total_chunks',
+    'time_drops',
+    'network_drops',
+    'duplicates',
+    'reordered',
+    'fec_recovered',
+    'fec_unrecoverable',
+    'frames_corrected',
+    'output_underruns_ms',
+)
+
+
+def _summary_us(histogram):
+    "Percentiles of a microsecond histogram"
+    return {
+        'count': histogram.count,
+        'p50': histogram.percentile(50),
+        'p90': histogram.percentile(90),
+        'p99': histogram.percentile(99),
+        'max': histogram.max,
+    }
+
+
+async def _measure(source, cards, duration, warmup, tick):
+    "Play the cards, collect playout errors and skew after the warmup"
+    errors = [Histogram(highest=10000000) for _ in cards]
+    skew = Histogram(highest=10000000)
+    start = time_machine.now()
+    while True:
+        await asyncio.sleep(tick)
+        now = time_machine.now()
+        if now - start > duration:
+            break
+        measured = []
+        for card, histogram in zip(cards, errors):
+            error = card.play(now, source)
+            if error is None or now - start < warmup:
+                continue
+            histogram.record(abs(error) * 1000000)
+            measured.append(error)
+        if len(measured) == len(cards) and len(cards) > 1:
+            skew.record((max(measured) - min(measured)) * 1000000)
+    return errors, skew
+
+
+def run_scenario(name, impairment_args, receivers=3, duration=20.0,
+                 warmup=5.0, latency_ms=300, tolerance_ms=15, fec=0,
+                 drift_ppm=0.0, seed=1, tick=0.002):
+    """
+    Run a scenario in a new event loop. Receivers play into simulated cards
+    spread evenly within +-drift_ppm.
+
+    Returns a dictionary with the results.
+    """
+    config = AudioConfig(rate=44100, sample=16, channels=2,
+                         latency_ms=latency_ms, sink_latency_ms=0)
+    reader = SampleReader(config)
+    reader.header_size = Packetizer.HEADER_SIZES[Packetizer.HEADER_VERSION]
+    reader.payload_size = 1472
+    source = _RampSource(config)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    players = []
+    transports = []
+    for _ in range(receivers):
+        stats = Stats()
+        chunk_queue = ChunkQueue()
+        receiver = Receiver(chunk_queue, channel=('127.0.0.1', 0),
+                            sink_latency_ms=0, stats=stats)
+        endpoint = loop.create_datagram_endpoint(lambda receiver=receiver: receiver,
+                                                 family=socket.AF_INET,
+                                                 local_addr=('127.0.0.1', 0))
+        with contextlib.redirect_stdout(io.StringIO()):
+            transport, _ = loop.run_until_complete(endpoint)
+        transports.append(transport)
+        players.append(ChunkPlayer(chunk_queue, stats,
+                                   tolerance_ms=tolerance_ms,
+                                   buffer_size=512, device_index=-1,
+                                   callback=True))
+
+    if receivers > 1:
+        ppms = [drift_ppm * (2 * i / (receivers - 1) - 1) for i in range(receivers)]
+    else:
+        ppms = [drift_ppm]
+    cards = [_SoundCard(player, ppm) for player, ppm in zip(players, ppms)]
+
+    targets = [transport.get_extra_info('sockname') for transport in transports]
+    impairments = [Impairment(seed=seed * 1000 + i, **impairment_args)
+                   for i in range(receivers)]
+    proxy = ImpairmentProxy(targets, impairments)
+    proxy_address = loop.run_until_complete(proxy.start())
+
+    packetizer = Packetizer(source, None, config, fec=fec)
+    packetizer.create_socket([proxy_address], ttl=1, multicast_loop=False,
+                             broadcast=False)
+
+    tasks = [loop.create_task(packetizer.packetize())]
+    tasks += [loop.create_task(player.chunk_player()) for player in players]
+
+    # Console messages of the components would bury the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        errors, skew = loop.run_until_complete(
+            _measure(source, cards, duration, warmup, tick))
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    loop.remove_reader(packetizer.sock.fileno())
+    packetizer.sock.close()
+    proxy.close()
+    for transport in transports:
+        # Don't let connection_lost stop the loop
+        transport.abort()
+    loop.close()
+
+    results = []
+    for player, card, histogram, link in zip(players, cards, errors, proxy.links):
+        stats = player.stats
+        entry = {field: getattr(stats, field) for field in STAT_FIELDS}
+        entry['device_ppm'] = card.ppm
+        entry['drift_ppm'] = stats.drift_ppm
+        entry['error_us'] = _summary_us(histogram)
+        entry['link'] = link.describe()
+        results.append(entry)
+
+    return {
+        'scenario': name,
+        'impairment': impairments[0].describe(),
+        'receivers': results,
+        'skew_us': _summary_us(skew),
+        'chunks_sent': packetizer.chunks_sent,
+        'duration_s': duration,
+        'warmup_s': warmup,
+        'latency_ms': latency_ms,
+        'fec': fec,
+    }
+
+
+def format_result(result):
+    "Scenario result lines for the console"
+    skew = result['skew_us']
+    lines = [
+        "%s: chunks=%d skew: p50=%.3fms p99=%.3fms max=%.3fms (%d samples)" % (
+            result['scenario'], result['chunks_sent'], skew['p50'] / 1000,
+            skew['p99'] / 1000, skew['max'] / 1000, skew['count']),
+        "  %-3s %6s %6s %6s %5s %5s %5s %5s %6s %7s %8s %8s" % (
+            'rx', 'lost', 'late', 'net', 'dup', 'reord', 'fec', 'unrec',
+            'corr', 'underr', 'err p50', 'err p99'),
+    ]
+    for number, entry in enumerate(result['receivers']):
+        lines.append(
+            "  %-3d %6d %6d %6d %5d %5d %5d %5d %6d %5.0fms %6.3fms %6.3fms" % (
+                number, entry['link']['lost'], entry['time_drops'],
+                entry['network_drops'], entry['duplicates'],
+                entry['reordered'], entry['fec_recovered'],
+                entry['fec_unrecoverable'], entry['frames_corrected'],
+                entry['output_underruns_ms'],
+                entry['error_us']['p50'] / 1000,
+                entry['error_us']['p99'] / 1000))
+    return lines
+
+
+def _address(text):
+    "Parse HOST:PORT"
+    host, _, port = text.rpartition(':')
+    try:
+        return (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected HOST:PORT, got %r" % text)
+
+
+def _add_impairment_args(parser):
+    "Impairment options of the proxy mode"
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help="part of lost datagrams (eg. 0.02)")
+    parser.add_argument('--burst', type=float, default=1.0,
+                        help="average loss burst length (default 1 - independent)")
+    parser.add_argument('--delay-ms', type=float, default=0.0,
+                        help="constant delay")
+    parser.add_argument('--jitter-ms', type=float, default=0.0,
+                        help="average random delay")
+    parser.add_argument('--jitter', choices=Impairment.JITTERS, default='normal',
+                        help="jitter distribution (default normal)")
+    parser.add_argument('--reorder', type=float, default=0.0,
+                        help="part of datagrams delayed by --reorder-ms")
+    parser.add_argument('--reorder-ms', type=float, default=10.0)
+    parser.add_argument('--duplicate', type=float, default=0.0,
+                        help="part of datagrams delivered twice")
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def _run_proxy(args):
+    "Proxy mode - run until interrupted"
+    impairments = [
+        Impairment(loss=args.loss, burst=args.burst, delay_ms=args.delay_ms,
+                   jitter_ms=args.jitter_ms, jitter=args.jitter,
+                   reorder=args.reorder, reorder_ms=args.reorder_ms,
+                   duplicate=args.duplicate,
+                   seed=None if args.seed is None else args.seed + i)
+        for i in range(len(args.targets))
+    ]
+    proxy = ImpairmentProxy(args.targets, impairments)
+    loop = asyncio.get_event_loop()
+    address = loop.run_until_complete(proxy.start(args.listen))
+    print("Forwarding %s:%d to %s" % (address[0], address[1],
+                                      ", ".join('%s:%d' % target
+                                                for target in args.targets)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Received %d datagrams" % proxy.received)
+        for link in proxy.links:
+            print("  %(target)s: forwarded=%(forwarded)d lost=%(lost)d "
+                  "duplicated=%(duplicated)d replies=%(replies)d" % link.describe())
+    return 0
+
+
+def _run_tests(args):
+    "Test mode - run the scenarios and report"
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            print("Unknown scenario %s, available: %s" % (name, ", ".join(SCENARIOS)))
+            return 1
+
+    results = []
+    for name in names:
+        result = run_scenario(name, SCENARIOS[name],
+                              receivers=args.receivers,
+                              duration=args.duration,
+                              warmup=args.warmup,
+                              latency_ms=args.latency_ms,
+                              tolerance_ms=args.tolerance_ms,
+                              fec=args.fec,
+                              drift_ppm=args.drift_ppm,
+                              seed=args.seed)
+        print("\n".join(format_result(result)))
+        results.append(result)
+
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=1)
+        print("Results written to", args.json_path)
+    return 0
+
+
+def main(argv=None):
+    "Run the proxy or the test scenarios"
+    parser = argparse.ArgumentParser(prog='python3 -m libwavesync.impair',
+                                     description=__doc__.strip().splitlines()[0])
+    modes = parser.add_subparsers(dest='mode')
+    modes.required = True
+
+    proxy = modes.add_parser('proxy', help="impairing proxy between real instances")
+    proxy.add_argument('--listen', type=_address, required=True,
+                       metavar='HOST:PORT', help="address the sender sends to")
+    proxy.add_argument('--to', type=_address, required=True, action='append',
+                       dest='targets', metavar='HOST:PORT',
+                       help="receiver address, can be repeated")
+    _add_impairment_args(proxy)
+
+    test = modes.add_parser('test', help="headless sync-quality scenarios")
+    test.add_argument('--scenario', action='append', dest='scenarios',
+                      choices=list(SCENARIOS),
+                      help="scenario to run, can be repeated (default: all)")
+    test.add_argument('--receivers', type=int, default=3)
+    test.add_argument('--duration', type=float, default=20.0,
+                      help="seconds per scenario (default 20)")
+    test.add_argument('--warmup', type=float, default=5.0,
+                      help="seconds before the measurement starts (default 5)")
+    test.add_argument('--latency-ms', type=int, default=300)
+    test.add_argument('--tolerance-ms', type=int, default=15)
+    test.add_argument('--fec', type=int, default=0,
+                      help="parity datagram every N chunks (default off)")
+    test.add_argument('--drift-ppm', type=float, default=0.0,
+                      help="spread of the simulated sound card clocks")
+    test.add_argument('--seed', type=int, default=1)
+    test.add_argument('--json', metavar='PATH', dest='json_path',
+                      help="save the results as JSON")
+
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.mode == 'proxy':
+        return _run_proxy(args)
+    return _run_tests(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Metrics - histograms and counters exported for monitoring.
+
+Histograms use fixed log-linear buckets (like HdrHistogram): values below
+2 * SUB_BUCKETS are exact, above that each power of two is split into
+SUB_BUCKETS buckets - relative error under 1 / SUB_BUCKETS. Recording is
+O(1): an index computation and a list increment.
+
+Metrics are exported in the Prometheus text format over a local HTTP
+endpoint and/or as a JSON file written periodically. The Prometheus export
+uses a fixed, coarser layout - a bucket per power of two - so the set of
+series doesn't change between scrapes.
+"""
+
+import os
+import json
+import asyncio
+
+
+def write_json(path, data):
+    "Atomically replace the JSON file"
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=1)
+    os.replace(tmp_path, path)
+
+
+class Histogram:
+    """
+    Histogram of non-negative integer values (eg. microseconds).
+
+    Values over `highest` are counted in the last bucket, negative ones in
+    the first.
+    """
+
+    SUB_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self, highest, scale=1.0):
+        # Value of a unit in the exported metrics (eg. 1e-6 for microseconds
+        # exported as seconds)
+        self.scale = scale
+        self.highest = highest
+        self.counts = [0] * (self._index(highest) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        "Bucket of a value"
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        if shift <= 0:
+            return value
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def _upper(cls, index):
+        "Upper bound (exclusive) of the bucket"
+        if index < 2 * cls.SUB_BUCKETS:
+            return index + 1
+        shift = (index >> cls.SUB_BITS) - 1
+        return ((index - (shift << cls.SUB_BITS)) + 1) << shift
+
+    def record(self, value):
+        "Add a value"
+        value = int(value)
+        if value < 0:
+            value = 0
+        elif value > self.highest:
+            value = self.highest
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        "Upper bound of the bucket containing the percentile (in units)"
+        if not self.count:
+            return 0
+        needed = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= needed and count:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def buckets(self):
+        "Non-empty buckets: list of (upper bound, cumulative count)"
+        result = []
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count:
+                seen += count
+                result.append((self._upper(index), seen))
+        return result
+
+    def export_buckets(self):
+        """
+        Fixed layout: list of (upper bound, cumulative count) for each power
+        of two up to the highest value, including empty buckets.
+        """
+        result = []
+        seen = 0
+        index = 0
+        for bit in range(self.highest.bit_length() + 1):
+            bound = 1 << bit
+            # Power of two is always an upper bound of a bucket
+            while index < len(self.counts) and self._upper(index) <= bound:
+                seen += self.counts[index]
+                index += 1
+            result.append((bound, seen))
+        return result
+
+    def summary(self):
+        "Short description for JSON export - scaled values"
+        scale = self.scale
+        return {
+            'count': self.count,
+            'sum': self.sum * scale,
+            'max': self.max * scale,
+            'p50': self.percentile(50) * scale,
+            'p90': self.percentile(90) * scale,
+            'p99': self.percentile(99) * scale,
+            'p999': self.percentile(99.9) * scale,
+            'buckets': [[upper * scale, count]
+                        for upper, count in self.buckets()],
+        }
+
+
+class Metrics:
+    """
+    Registry of the exported metrics.
+
+    Counters and gauges are registered as functions returning the current
+    value, so components keep their plain attributes.
+    """
+
+    PREFIX = 'wavesync_'
+
+    def __init__(self):
+        # name -> (type, help, histogram or getter)
+        self.metrics = {}
+
+    def add_histogram(self, name, help_text, histogram):
+        self.metrics[name] = ('histogram', help_text, histogram)
+
+    def add_counter(self, name, help_text, getter):
+        self.metrics[name] = ('counter', help_text, getter)
+
+    def add_gauge(self, name, help_text, getter):
+        self.metrics[name] = ('gauge', help_text, getter)
+
+    def prometheus(self):
+        "Metrics in the Prometheus text exposition format"
+        lines = []
+        for name, (kind, help_text, source) in sorted(self.metrics.items()):
+            name = self.PREFIX + name
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind != 'histogram':
+                lines.append('%s %r' % (name, float(source())))
+                continue
+            for upper, count in source.export_buckets():
+                lines.append('%s_bucket{le="%r"} %d' % (name, upper * source.scale,
+                                                        count))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, source.count))
+            lines.append('%s_sum %r' % (name, source.sum * source.scale))
+            lines.append('%s_count %d' % (name, source.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        "Metrics as a dictionary for JSON export"
+        result = {}
+        for name, (kind, _, source) in self.metrics.items():
+            if kind == 'histogram':
+                result[name] = source.summary()
+            else:
+                result[name] = source()
+        return result
+
+    def write_json(self, path):
+        "Atomically replace the JSON file"
+        write_json(path, self.snapshot())
+
+    async def write_periodically(self, path, interval=10.0):
+        "Keep the JSON file updated"
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_json(path)
+            except OSError as ex:
+                print("WARNING: Unable to write metrics:", ex)
+
+    async def _handle_http(self, reader, writer):
+        "Answer a single HTTP request"
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the request headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+        except asyncio.TimeoutError:
+            writer.close()
+            return
+
+        parts = request.split()
+        path = parts[1].decode('ascii', 'replace') if len(parts) > 1 else '/'
+        if path == '/metrics.json':
+            body = json.dumps(self.snapshot()).encode()
+            content_type = 'application/json'
+            status = '200 OK'
+        elif path in ('/', '/metrics'):
+            body = self.prometheus().encode()
+            content_type = 'text/plain; version=0.0.4'
+            status = '200 OK'
+        else:
+            body = b'Not found\n'
+            content_type = 'text/plain'
+            status = '404 Not Found'
+
+        header = ('HTTP/1.0 %s\r\nContent-Type: %s\r\n'
+                  'Content-Length: %d\r\nConnection: close\r\n\r\n')
+        writer.write((header % (status, content_type, len(body))).encode())
+        writer.write(body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self, port, host='127.0.0.1'):
+        "Start the HTTP endpoint: /metrics (Prometheus) and /metrics.json"
+        return await asyncio.start_server(self._handle_http, host, port)
@@ -3,15 +3,30 @@ Packetizer class.
 """
 
 import asyncio
+import errno
 import socket
 import struct
-import zlib
 import ipaddress
 
 from datetime import datetime
-from time import time
+from time import time, perf_counter
 
 from libwavesync import time_machine
+from libwavesync.send_scheduler import SendScheduler
+from libwavesync.fec import FecEncoder
+from libwavesync.codec import ZlibCodec
+from libwavesync import clock_sync
+from libwavesync import trace
+from libwavesync.feedback import FLAG_REPORT
+from libwavesync.metrics import Histogram
+
+
+def _ratio(numerator, denominator, fmt):
+    "Format the ratio, or '-' if nothing was sent yet"
+    if not denominator:
+        return '-'
+    return fmt % (numerator / denominator)
+
 
 class Packetizer:
     """Read chunks from queue, add timestamp marks and send over multicast."""
@@ -20,15 +35,151 @@ class Packetizer:
     HEADER_RAW_AUDIO = b'\x00\x00'
     HEADER_STATUS = b'\x40\x00'
 
-    def __init__(self, reader, chunk_queue, audio_config, compress=False):
+    # First byte of the header. Audio codec is selected by the
+    # codec.CODEC_MASK bits, zlib uses FLAG_COMPRESSED.
+    FLAG_COMPRESSED = 0x80
+    FLAG_STATUS = 0x40
+
+    # Second byte of the audio header selects its layout:
+    # 0: [flags][0][mark:2]
+    # 1: [flags][1][mark:2][sequence:2]
+    # 2: [flags][2][microsecond mark:4][sequence:2]
+    # Status packets carry the audio header version in the second byte.
+    HEADER_SIZES = {
+        0: 4,
+        1: 6,
+        2: 8,
+    }
+    HEADER_VERSION = 1
+
+    SEQUENCE = struct.Struct('>H')
+
+    # Status: [timestamp][chunks sent][audio configuration]
+    STATUS = struct.Struct('dIHBBHH')
+
+    # Max time requests and reports handled per host and second when the
+    # receivers aren't known. A receiver sends up to 10 requests per second
+    # while syncing, a relay forwards the requests of all its receivers.
+    MAX_REQUESTS = 50
+
+    def __init__(self, reader, chunk_queue, audio_config, compress=False,
+                 header_version=HEADER_VERSION, fec=0, codec=None,
+                 adaptive=None, pool=None, fleet=None, groups=None, name=None):
         self.reader = reader
         self.chunk_queue = chunk_queue
-        self.compress = compress
         self.audio_config = audio_config
         self.stop = False
 
+        # Zone name when the sender serves several
+        self.name = name
+
+        # Compression level selects the legacy zlib codec
+        if codec is None and compress is not False:
+            codec = ZlibCodec(audio_config, compress)
+        self.codec = codec
+
+        # AdaptiveCompression selecting the codec per chunk instead
+        self.adaptive = adaptive
+
+        # EncodePool reading and encoding chunks in worker processes
+        self.pool = pool
+        if pool is not None:
+            assert adaptive is None
+            self.codec = codec = pool.codec
+
+        assert header_version in self.HEADER_SIZES
+        self.header_version = header_version
+        self.header_raw = bytes([0, header_version])
+        if header_version >= 2:
+            self.get_timemark = time_machine.get_timemark_us_ns
+        else:
+            self.get_timemark = time_machine.get_timemark_ns
+
+        # Header of the chunks encoded by a codec - by its flag
+        codecs = adaptive.ladder if adaptive is not None else [codec]
+        self.header_codec = {
+            chunk_codec.FLAG: bytes([chunk_codec.FLAG, header_version])
+            for chunk_codec in codecs
+            if chunk_codec is not None
+        }
+
+        # Parity datagram every `fec` chunks. Requires sequence numbers.
+        if fec:
+            assert header_version >= 1
+            self.fec = FecEncoder(fec, header_version)
+        else:
+            self.fec = None
+
+        # FleetTable collecting receiver reports
+        self.fleet = fleet
+
+        # ChannelGroups - subsets of the channels sent to their own
+        # destinations. Encoded whole chunks can't be split.
+        self.groups = groups or []
+        for group in self.groups:
+            assert adaptive is None and pool is None
+            group.configure(audio_config, codec)
+            if group.codec is not None:
+                group.header_codec = bytes([group.codec.FLAG, header_version])
+            if fec:
+                group.fec = FecEncoder(fec, header_version)
+
+        # Counters
+        self.chunks_sent = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+        self.bytes_parity = 0
+        self.cancelled_compressions = 0
+        self.rejected_requests = 0
+
+        # Distributions (microseconds)
+        self.encode_time_us = Histogram(highest=10000000, scale=1e-6)
+        self.send_time_us = Histogram(highest=10000000, scale=1e-6)
+
         self.sock = None
         self.destinations = []
+        self.sender = None
+
+        # Hosts whose time requests and reports are handled, None - any
+        # host (multicast or broadcast destinations). Requests per host
+        # are limited: host -> (second start, count).
+        self.receiver_hosts = None
+        self._request_counts = {}
+
+    def register_metrics(self, metrics, prefix=''):
+        "Export the sender statistics, names prefixed with the prefix"
+        counters = [
+            ('chunks_sent', 'Audio chunks sent'),
+            ('packets_sent', 'Audio datagrams sent to all destinations'),
+            ('bytes_sent', 'Bytes sent including parity'),
+            ('bytes_raw', 'Bytes which would be sent without compression'),
+            ('bytes_parity', 'Bytes of FEC parity sent'),
+            ('cancelled_compressions', 'Chunks sent raw as they did not compress'),
+            ('rejected_requests', 'Time requests and reports from unknown or too eager hosts'),
+        ]
+        for name, help_text in counters:
+            metrics.add_counter(prefix + name + '_total', help_text,
+                                lambda name=name: getattr(self, name))
+        metrics.add_gauge(prefix + 'destinations', 'Number of destinations',
+                          self.count_destinations)
+        metrics.add_counter(prefix + 'send_dropped_total',
+                            'Datagrams dropped from the full destination queues',
+                            lambda: sum(sender.dropped() for sender in self.senders()))
+        metrics.add_counter(prefix + 'send_failures_total',
+                            'Failed sends and datagrams skipped during backoff',
+                            lambda: sum(sender.failures() for sender in self.senders()))
+        metrics.add_gauge(prefix + 'destinations_backing_off',
+                          'Destinations skipped after a send failure',
+                          lambda: sum(sender.backing_off() for sender in self.senders()))
+        metrics.add_gauge(prefix + 'send_queue_datagrams',
+                          'Datagrams waiting for a writable socket',
+                          lambda: sum(sender.queued() for sender in self.senders()))
+        metrics.add_histogram(prefix + 'encode_seconds', 'Chunk compression time',
+                              self.encode_time_us)
+        metrics.add_histogram(prefix + 'send_seconds',
+                              'Time of sending a chunk to all destinations',
+                              self.send_time_us)
 
     def create_socket(self, channels, ttl, multicast_loop, broadcast, source_address=None):
         "Create a UDP multicast socket"
@@ -39,7 +190,10 @@ class Packetizer:
                              socket.IP_MULTICAST_TTL,
                              ttl)
 
-        for address, port in channels:
+        group_destinations = [destination
+                              for group in self.groups
+                              for destination in group.destinations]
+        for address, port in list(channels) + group_destinations:
             if source_address and ipaddress.IPv4Address(address).is_multicast:
                 try:
                     self.sock.setsockopt(socket.SOL_IP,
@@ -71,30 +225,163 @@ class Packetizer:
         # it's way better to chunk the packets right.
         self.sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
 
-    def _create_status_packet(self, chunk_no):
+        # Destinations which can't take a datagram get queued or backed off
+        # instead of blocking the others
+        self.sock.setblocking(False)
+        self.sender = SendScheduler(self.sock, self.destinations)
+        for group in self.groups:
+            group.sender = SendScheduler(self.sock, group.destinations)
+
+        # Anyone on the network can receive a multicast or broadcast
+        # stream; unicast destinations are the only receivers.
+        hosts = self._resolve(address for address, _ in
+                              self.destinations + group_destinations)
+        if not broadcast and not any(ipaddress.IPv4Address(host).is_multicast
+                                     for host in hosts):
+            self.receiver_hosts = set(hosts)
+
+        # Receivers send their time requests and reports to this socket
+        loop = asyncio.get_event_loop()
+        loop.add_reader(self.sock.fileno(), self._handle_requests)
+
+    @staticmethod
+    def _resolve(hosts):
+        "IPv4 addresses of the hosts, unresolvable ones are skipped"
+        addresses = []
+        for host in hosts:
+            try:
+                addresses.append(socket.gethostbyname(host))
+            except OSError as ex:
+                print("WARNING: Unable to resolve %s: %s" % (host, ex))
+        return addresses
+
+    def _accept_request(self, address):
+        """
+        Check the source of a time request or a report. Responses are
+        larger than requests - don't let anyone use the sender to flood
+        a third party.
+
+        With unicast destinations only their hosts are handled, otherwise
+        any host within a rate limit.
+        """
+        host = address[0]
+        if self.receiver_hosts is not None:
+            if host in self.receiver_hosts:
+                return True
+            self.rejected_requests += 1
+            return False
+
+        now = perf_counter()
+        start, count = self._request_counts.get(host, (now, 0))
+        if now - start >= 1:
+            start, count = now, 0
+        if count >= self.MAX_REQUESTS:
+            self.rejected_requests += 1
+            return False
+        if len(self._request_counts) > 1024:
+            self._request_counts.clear()
+        self._request_counts[host] = (start, count + 1)
+        return True
+
+    def _handle_requests(self):
+        "Answer clock synchronisation requests, collect receiver reports"
+        while True:
+            try:
+                data, address = self.sock.recvfrom(256, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                # ICMP errors of the sent audio are reported here
+                if ex.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                                errno.ENETUNREACH):
+                    continue
+                raise
+            if not self._accept_request(address):
+                continue
+            if data and data[0] == FLAG_REPORT:
+                if self.fleet is not None:
+                    self.fleet.handle(data, address)
+                continue
+            response = clock_sync.create_response(data, time_machine.now())
+            if response is None:
+                continue
+            try:
+                self.sock.sendto(response, address)
+            except OSError as ex:
+                print("WARNING: Unable to answer time request:", ex)
+
+    def senders(self):
+        "SendSchedulers of the destinations and the channel groups"
+        senders = [self.sender] if self.sender is not None else []
+        return senders + [group.sender for group in self.groups
+                          if group.sender is not None]
+
+    def count_destinations(self):
+        "Number of destinations, including the channel groups'"
+        return len(self.destinations) + sum(len(group.destinations)
+                                            for group in self.groups)
+
+    def _create_status_packet(self, chunk_no, audio_config=None):
         "Format status packet"
-        flags = Packetizer.HEADER_STATUS
-        now = time()
-        dgram = flags + struct.pack('dIHBBHH',
-                                    now,
-                                    chunk_no,
-                                    self.audio_config.rate,
-                                    self.audio_config.sample,
-                                    self.audio_config.channels,
-                                    self.audio_config.chunk_size,
-                                    self.audio_config.latency_ms)
+        if audio_config is None:
+            audio_config = self.audio_config
+        flags = bytes([self.FLAG_STATUS, self.header_version])
+        now = time_machine.now()
+        dgram = flags + self.STATUS.pack(now,
+                                         chunk_no,
+                                         audio_config.rate,
+                                         audio_config.sample,
+                                         audio_config.channels,
+                                         audio_config.chunk_size,
+                                         audio_config.latency_ms)
         return dgram
 
+    def _send_groups(self, chunk, mark, sequence):
+        """
+        Send the channel groups' parts of the chunk.
+
+        Returns (bytes sent, list of failures).
+        """
+        sent_bytes = 0
+        failures = []
+        for group in self.groups:
+            part = group.split(chunk)
+            part_len = len(part)
+            parts = [self.header_raw, mark, part]
+            if group.codec is not None:
+                encode_start = perf_counter()
+                encoded = group.codec.encode(part)
+                self.encode_time_us.record((perf_counter() - encode_start) * 1000000)
+                if encoded is not None and len(encoded) < part_len:
+                    parts = [group.header_codec, mark, encoded]
+                else:
+                    self.cancelled_compressions += 1
+
+            header_len = 2 + len(mark)
+            dgram_len = header_len + len(parts[2])
+            group_failures = group.sender.send(parts)
+            sent = len(group.destinations) - len(group_failures)
+            sent_bytes += dgram_len * sent
+            self.bytes_raw += (part_len + header_len) * sent
+            self.packets_sent += sent
+            failures += group_failures
+
+            if group.fec is not None:
+                parity = group.fec.add(sequence, parts)
+                if parity is not None:
+                    parity_failures = group.sender.send([parity])
+                    failures += parity_failures
+                    sent = len(group.destinations) - len(parity_failures)
+                    sent_bytes += len(parity) * sent
+                    self.bytes_parity += len(parity) * sent
+        self.bytes_sent += sent_bytes
+        return sent_bytes, failures
+
     async def packetize(self):
         "Read pre-chunked samples from queue and send them over UDP"
         start = time()
-        # Numer of sent packets
-        stat_pkts = 0
         # Chunk number as seen by receivers
         chunk_no = 0
-        bytes_sent = 0
-        bytes_raw = 0
-        cancelled_compressions = 0
 
         # Current speed measurement
         recent = 0
@@ -108,61 +395,114 @@ class Packetizer:
 
         while not self.stop:
             # Block until samples are read by the reader.
-            stream_time, chunk = await self.reader.get_next_chunk()
+            if self.pool is not None:
+                stream_time, chunk, encoded = await self.pool.get_next_chunk()
+            else:
+                stream_time, chunk = await self.reader.get_next_chunk()
 
             # Handle input flood, to keep us within timemarking range.
-            now = time_machine.now()
+            now = time_machine.now_ns()
             diff = stream_time - now
 
-            if diff > 0.5:
+            if diff > 500000000:
                 print("Waiting to synchronize input stream. Stream-real, difference is",
-                      diff)
+                      diff / 1e9)
                 await asyncio.sleep(0.4)
-            elif diff < -5:
-                print("Input stream is lagging", diff)
+            elif diff < -5000000000:
+                print("Input stream is lagging", diff / 1e9)
 
             relative = stream_time
-            future_ts, mark = time_machine.get_timemark(relative,
-                                                        self.audio_config.latency_s)
+            future_ns, mark = self.get_timemark(relative,
+                                                self.audio_config.latency_ns)
+            if trace.tracer:
+                trace.tracer.record(trace.MARKED, future_ns)
 
             if self.chunk_queue is not None:
-                item = (future_ts, chunk)
+                # Chunk is a view of the reader's ring buffer - local player
+                # keeps it for the whole latency, so it needs a copy.
+                item = (future_ns, bytes(chunk))
                 self.chunk_queue.chunk_list.append((self.chunk_queue.CMD_AUDIO,
                                                     item))
                 self.chunk_queue.chunk_available.set()
 
+            if self.header_version >= 1:
+                mark += self.SEQUENCE.pack(chunk_no % 0x10000)
+
             chunk_len = len(chunk)
-            if self.compress is not False:
-                chunk_compressed = zlib.compress(chunk, self.compress)
-                if len(chunk_compressed) < chunk_len:
+            if self.adaptive is not None:
+                codec = self.adaptive.select()
+            else:
+                codec = self.codec
+            if not self.destinations:
+                # Only the channel groups are sent
+                codec = None
+
+            if self.pool is not None:
+                # Already encoded
+                chunk_compressed = encoded
+            elif codec is not None:
+                encode_start = perf_counter()
+                chunk_compressed = codec.encode(chunk)
+                took = perf_counter() - encode_start
+                self.encode_time_us.record(took * 1000000)
+
+            if codec is not None:
+                if chunk_compressed is not None and len(chunk_compressed) < chunk_len:
                     # Go with compressed
-                    dgram = Packetizer.HEADER_COMPRESSED_AUDIO + mark + chunk_compressed
+                    parts = [self.header_codec[codec.FLAG], mark, chunk_compressed]
                 else:
                     # Cancel - compressed might not fit to packet
-                    dgram = Packetizer.HEADER_RAW_AUDIO + mark + chunk
-                    cancelled_compressions += 1
+                    parts = [self.header_raw, mark, chunk]
+                    self.cancelled_compressions += 1
+                if self.adaptive is not None:
+                    self.adaptive.record(took, chunk_len, len(parts[2]))
             else:
-                dgram = Packetizer.HEADER_RAW_AUDIO + mark + chunk
+                parts = [self.header_raw, mark, chunk]
 
-            dgram_len = len(dgram)
+            # Datagram is gathered from parts by the kernel - without copying
+            # the payload.
+            header_len = 2 + len(mark)
+            dgram_len = header_len + len(parts[2])
             chunk_no += 1
+            self.chunks_sent = chunk_no
             recent += 1
-            for destination in self.destinations:
-                try:
-                    self.sock.sendto(dgram, destination)
-                    bytes_sent += dgram_len
-                    recent_bytes += dgram_len
-                    bytes_raw += chunk_len + 4
-                    stat_pkts += 1
-                except OSError as ex:
-                    import errno
-                    if ex.errno == errno.EMSGSIZE:
-                        s = "WARNING: UDP datagram size (%d) is too big for your network MTU"
-                        s = s % len(dgram)
-                        print(s)
-                        new_size = self.reader.decrement_payload_size()
-                        print("Trying MTU detection. New payload size is %d" % new_size)
-                        break
+            send_start = perf_counter()
+            failures = self.sender.send(parts)
+            self.send_time_us.record((perf_counter() - send_start) * 1000000)
+            if trace.tracer:
+                trace.tracer.record(trace.SENT, future_ns)
+            sent = len(self.destinations) - len(failures)
+            self.bytes_sent += dgram_len * sent
+            recent_bytes += dgram_len * sent
+            self.bytes_raw += (chunk_len + header_len) * sent
+            self.packets_sent += sent
+
+            if self.fec is not None:
+                parity = self.fec.add((chunk_no - 1) % 0x10000, parts)
+                if parity is not None:
+                    parity_failures = self.sender.send([parity])
+                    failures += parity_failures
+                    sent = len(self.destinations) - len(parity_failures)
+                    self.bytes_sent += len(parity) * sent
+                    recent_bytes += len(parity) * sent
+                    self.bytes_parity += len(parity) * sent
+
+            if self.groups:
+                group_bytes, group_failures = self._send_groups(
+                    chunk, mark, (chunk_no - 1) % 0x10000)
+                recent_bytes += group_bytes
+                failures += group_failures
+
+            # The other destinations got the datagram anyway - shrink the
+            # payload once per chunk.
+            for _, ex in failures:
+                if ex.errno == errno.EMSGSIZE:
+                    s = "WARNING: UDP datagram size (%d) is too big for your network MTU"
+                    s = s % dgram_len
+                    print(s)
+                    new_size = self.reader.decrement_payload_size()
+                    print("Trying MTU detection. New payload size is %d" % new_size)
+                    break
 
             # Send small status datagram every 124 chunks - ~ 1 second
             # It's used to determine if some frames were lost on the network
@@ -170,27 +510,52 @@ class Packetizer:
             # Contains the audio configuration too.
             if chunk_no % 124 == 0:
                 dgram = self._create_status_packet(chunk_no)
-                for destination in self.destinations:
-                    self.sock.sendto(dgram, destination)
+                self.sender.send([dgram])
+                for group in self.groups:
+                    dgram = self._create_status_packet(chunk_no, group.audio_config)
+                    group.sender.send([dgram])
 
             if recent >= 100:
                 # Main status line
                 now = time()
                 took_total = now - start
                 took_recent = now - recent_start
-                s = ("STATE: dsts=%d total: pkts=%d kB=%d time=%d "
+                s = ("STATE%s: dsts=%d total: pkts=%d kB=%d time=%d "
                      "kB/s: avg=%.3f cur=%.3f")
                 s = s % (
-                    len(self.destinations),
-                    stat_pkts,
-                    bytes_sent / 1024, took_total,
-                    bytes_sent / took_total / 1024,
+                    '' if self.name is None else ' ' + self.name,
+                    self.count_destinations(),
+                    self.packets_sent,
+                    self.bytes_sent / 1024, took_total,
+                    self.bytes_sent / took_total / 1024,
                     recent_bytes / took_recent / 1024,
                 )
-                if self.compress:
-                    s += ' compress_ratio=%.3f cancelled=%d'
-                    s = s % (bytes_sent / bytes_raw, cancelled_compressions)
+                if self.adaptive is not None:
+                    s += ' codec=%s compress_ratio=%s cancelled=%d skipped=%d'
+                    s = s % (self.adaptive.name,
+                             _ratio(self.bytes_sent - self.bytes_parity,
+                                    self.bytes_raw, '%.3f'),
+                             self.cancelled_compressions, self.adaptive.skipped)
+                elif self.codec is not None:
+                    s += ' codec=%s compress_ratio=%s cancelled=%d'
+                    s = s % (self.codec.NAME,
+                             _ratio(self.bytes_sent - self.bytes_parity,
+                                    self.bytes_raw, '%.3f'),
+                             self.cancelled_compressions)
+                if self.fec is not None:
+                    s += ' fec_overhead=%s' % _ratio(100 * self.bytes_parity,
+                                                     self.bytes_sent, '%.1f%%')
+                problems = [line for sender in self.senders()
+                            for line in sender.problems()]
+                if problems:
+                    s += ' send: queued=%d dropped=%d failed=%d backoff=%d' % (
+                        sum(sender.queued() for sender in self.senders()),
+                        sum(sender.dropped() for sender in self.senders()),
+                        sum(sender.failures() for sender in self.senders()),
+                        sum(sender.backing_off() for sender in self.senders()))
                 print(s)
+                for line in problems:
+                    print(line)
 
                 recent_start = now
                 recent_bytes = 0
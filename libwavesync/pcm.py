@@ -0,0 +1,33 @@
+"""
+Conversions of interleaved, little-endian PCM between bytes and NumPy arrays.
+
+NumPy is optional - features using this module are available only if it's
+installed.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def to_array(data, sample, channels):
+    "Decode PCM bytes into a (frames, channels) int32 array"
+    if sample == 16:
+        samples = numpy.frombuffer(data, dtype='<i2').astype(numpy.int32)
+    else:
+        raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+        samples = (raw[:, 0].astype(numpy.int32) |
+                   (raw[:, 1].astype(numpy.int32) << 8) |
+                   (raw[:, 2].astype(numpy.int32) << 16))
+        # Sign extend 24 bits
+        samples -= (samples & 0x800000) << 1
+    return samples.reshape(-1, channels)
+
+
+def from_array(samples, sample):
+    "Encode (frames, channels) array of integers into PCM bytes"
+    if sample == 16:
+        return samples.astype('<i2').tobytes()
+    raw = samples.astype('<i4').reshape(-1, 1).view(numpy.uint8)
+    return raw[:, :3].tobytes()
@@ -1,10 +1,45 @@
 import asyncio
 import socket
 import struct
-import zlib
 
 from libwavesync import Packetizer, AudioConfig
 from libwavesync import time_machine
+from libwavesync import trace
+from libwavesync import codec
+from libwavesync.batch_socket import BatchReceiver
+from libwavesync.fec import FecDecoder, FLAG_PARITY
+from libwavesync.clock_sync import FLAG_TIMESYNC
+
+
+def join_multicast(sock, channel):
+    "Join the multicast group of the channel, if it's a multicast address"
+    group, port = channel
+
+    multicast = True
+    octets = group.split('.')
+
+    if len(octets) != 4:
+        multicast = False
+    else:
+        try:
+            octet_0 = int(octets[0])
+            if not 224 <= octet_0 <= 239:
+                multicast = False
+        except ValueError:
+            multicast = False
+
+    # If not multicast - end
+    if multicast is False:
+        print("Assuming unicast reception on %s:%d" % (group, port))
+        return
+
+    # Multicast - join group
+    print("Joining multicast group", group)
+
+    group = socket.inet_aton(group)
+    mreq = struct.pack('4sL', group, socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
 
 class Receiver(asyncio.DatagramProtocol):
     """
@@ -13,8 +48,17 @@ class Receiver(asyncio.DatagramProtocol):
     - Receive packets
     - decode headers
     - store in chunk list.
+
+    Works either as an asyncio datagram protocol or, for lower per-datagram
+    overhead, drains the socket in batches (see start_batched).
     """
 
+    # Max number of batches handled in a single socket readiness callback
+    MAX_DRAIN_ROUNDS = 8
+
+    # Shortest valid datagram - the oldest audio header
+    MIN_DATAGRAM = min(Packetizer.HEADER_SIZES.values())
+
     def __init__(self, chunk_queue, channel, sink_latency_ms, stats):
         self.stats = stats
 
@@ -27,59 +71,84 @@ class Receiver(asyncio.DatagramProtocol):
         self.audio_config = None
         self.sink_latency_ms = sink_latency_ms
 
+        # Used in the batched mode
+        self.batch_receiver = None
+
+        # Rebuilds lost chunks if sender transmits parity datagrams
+        self.fec = FecDecoder()
+
+        # Codecs by their header flag
+        self.decoders = codec.decoders()
+
+        # Audio header version announced in the sender's status packets
+        self.header_version = None
+
+        # Previous chunk arrival and play time - to measure the jitter
+        self._last_arrival = None
+        self._last_mark = None
+        self.sendto = None
+        self.sender_address = None
+
         super().__init__()
 
     def connection_made(self, transport):
         "Configure multicast"
         sock = transport.get_extra_info('socket')
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # Check if address is multicast and join group.
-        group, port = self.channel
+        self._setup_socket(sock)
+        self.sendto = transport.sendto
+
+    def start_batched(self, sock, batch):
+        """
+        Receive in batches from a bound, non-blocking socket instead of
+        being called by the event loop for each datagram.
+        """
+        self._setup_socket(sock)
+        self.sendto = sock.sendto
+        self.batch_receiver = BatchReceiver(sock, batch)
+        loop = asyncio.get_event_loop()
+        loop.add_reader(sock.fileno(), self._drain)
 
-        multicast = True
-        octets = group.split('.')
+    def _setup_socket(self, sock):
+        "Configure multicast"
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         # Received audio chunk counter
         self.chunk_queue.init_queue()
 
-        if len(octets) != 4:
-            multicast = False
-        else:
-            try:
-                octet_0 = int(octets[0])
-                if not 224 <= octet_0 <= 239:
-                    multicast = False
-            except ValueError:
-                multicast = False
+        join_multicast(sock, self.channel)
 
-        # If not multicast - end
-        if multicast is False:
-            print("Assuming unicast reception on %s:%d" % (group, port))
+    def send_to_sender(self, data):
+        "Send datagram to the sender, if it's known already"
+        if self.sender_address is None or self.sendto is None:
             return
-
-        # Multicast - join group
-        print("Joining multicast group", group)
-
-        group = socket.inet_aton(group)
-        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        try:
+            self.sendto(data, self.sender_address)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as ex:
+            print("WARNING: Unable to send to the sender:", ex)
 
     def _handle_status(self, data):
 
-        if len(data) < (2 + 20):
+        if len(data) < (2 + Packetizer.STATUS.size):
             print("WARNING: Status header too short")
+            return
 
         (sender_timestamp,
          sender_chunk_no,
          rate, sample,
          channels,
          chunk_size,
-         latency_ms) = struct.unpack('dIHBBHH',
-                                     data[2:2 + 8+4+2+1+1+2+2])
+         latency_ms) = Packetizer.STATUS.unpack_from(data, 2)
 
         q = self.chunk_queue
 
+        # Older senders leave the header version byte zeroed
+        header_version = data[1]
+        if header_version != self.header_version:
+            print("Sender uses audio header version %d" % header_version)
+            self.header_version = header_version
+
         # Handle timestamp
         now = time_machine.now()
         self.stats.network_latency = (now - sender_timestamp)
@@ -97,6 +166,12 @@ class Receiver(asyncio.DatagramProtocol):
 
         # Handle dropped packets
 
+        if q.sequenced:
+            # Numbered chunks - drops are detected on arrival
+            q.last_sender_chunk_no = sender_chunk_no
+            q.chunk_no = 0
+            return
+
         # If this is first status packet
         # or low sender_chunk_no indicates that sender was restarted
         if q.last_sender_chunk_no is None or sender_chunk_no < 1500:
@@ -119,40 +194,127 @@ class Receiver(asyncio.DatagramProtocol):
             q.chunk_list.append((q.CMD_DROPS, dropped))
             q.chunk_available.set()
 
-    def datagram_received(self, data, addr):
-        "Handle incoming datagram - audio chunk, or status packet"
-        header = data[:2]
-        mark = data[2:4]
-        chunk = data[4:]
-        if header == Packetizer.HEADER_RAW_AUDIO:
-            pass
-        elif header == Packetizer.HEADER_COMPRESSED_AUDIO:
-            try:
-                chunk = zlib.decompress(chunk)
-            except zlib.error:
-                print("WARNING: Invalid compressed data - dropping")
-                return
-        elif header == Packetizer.HEADER_STATUS:
+    def _drain(self):
+        "Socket is readable - handle all waiting datagrams"
+        received = False
+        for _ in range(self.MAX_DRAIN_ROUNDS):
+            datagrams = self.batch_receiver.receive()
+            for data, address in datagrams:
+                if self._handle_datagram(data, address):
+                    received = True
+            if len(datagrams) < self.batch_receiver.batch:
+                break
+
+        # Wake the player once per batch
+        if received:
+            self.chunk_queue.chunk_available.set()
+
+    def _handle_datagram(self, data, address=None):
+        """
+        Handle incoming datagram - audio chunk, or status packet.
+
+        Data can be a view of a reused buffer. Returns True if audio chunk
+        was queued.
+        """
+        if len(data) < self.MIN_DATAGRAM:
+            print("WARNING: Datagram too short - dropping")
+            return False
+
+        flags = data[0]
+        if flags & Packetizer.FLAG_STATUS:
             # Status header!
+            if address is not None:
+                self.sender_address = address
             self._handle_status(data)
-            return
-        else:
+            return False
+
+        if flags & FLAG_TIMESYNC:
+            # Responses come to the ClockSync socket
+            return False
+
+        if flags & FLAG_PARITY:
+            return self._handle_parity(data)
+
+        header_size = Packetizer.HEADER_SIZES.get(data[1])
+        decoder = self.decoders.get(flags & codec.CODEC_MASK)
+        if (header_size is None or flags & ~codec.CODEC_MASK or
+                len(data) < header_size):
             print("Invalid header!")
-            return
+            return False
+        if decoder is None:
+            print("WARNING: Unsupported codec %#x - dropping" % (flags & codec.CODEC_MASK))
+            return False
+
+        if header_size >= 6:
+            # Sequence number follows the mark
+            mark = bytes(data[2:header_size - 2])
+            sequence = Packetizer.SEQUENCE.unpack_from(data, header_size - 2)[0]
+            if self.fec.active:
+                self.fec.store(sequence, data)
+        else:
+            mark = bytes(data[2:4])
+            sequence = None
 
-        if self.chunk_queue.ignore_audio_packets != 0:
-            self.chunk_queue.ignore_audio_packets -= 1
-            return
+        try:
+            chunk = decoder.decode(data[header_size:])
+        except codec.CodecError:
+            print("WARNING: Invalid compressed data - dropping")
+            return False
 
-        mark = time_machine.to_absolute_timestamp(time_machine.now(),
-                                                  mark)
+        q = self.chunk_queue
+        if q.ignore_audio_packets != 0:
+            q.ignore_audio_packets -= 1
+            return False
+
+        # Play time in integer nanoseconds
+        now = time_machine.now_ns()
+        if data[1] >= 2:
+            mark = time_machine.to_absolute_us_ns(now, mark)
+        else:
+            mark = time_machine.to_absolute_ns(now, mark)
+
+        # Arrival interval against the chunk interval (RFC 3550 style)
+        if self._last_arrival is not None:
+            jitter = (now - self._last_arrival) - (mark - self._last_mark)
+            self.stats.jitter_us.record(abs(jitter) // 1000)
+        self._last_arrival = now
+        self._last_mark = mark
+        if trace.tracer:
+            trace.tracer.record(trace.RECEIVED, mark)
         item = (mark, chunk)
 
-        # Count received audio-chunks
-        self.chunk_queue.chunk_no += 1
+        # Count received audio-chunks, reorder if numbered
+        lost = q.put_audio(item, sequence)
+        if lost:
+            self.stats.network_drops += lost
+        self.stats.duplicates = q.duplicates
+        self.stats.reordered = q.reordered
+        self.stats.late_arrivals = q.late
+        return True
+
+    def _handle_parity(self, data):
+        "Rebuild a lost audio datagram using FEC parity"
+        header_size = Packetizer.HEADER_SIZES.get(data[1])
+        if header_size is None or header_size < 6:
+            print("Invalid parity header!")
+            return False
+
+        group_size, dgram = self.fec.recover(bytes(data), header_size)
+
+        # Hold chunks long enough for the parity to arrive
+        q = self.chunk_queue
+        q.reorder_window = max(q.reorder_window, group_size + 2)
+
+        self.stats.fec_recovered = self.fec.recovered
+        self.stats.fec_unrecoverable = self.fec.unrecoverable
+        if dgram is None:
+            return False
+        return self._handle_datagram(dgram)
 
-        self.chunk_queue.chunk_list.append((self.chunk_queue.CMD_AUDIO, item))
-        self.chunk_queue.chunk_available.set()
+    def datagram_received(self, data, addr):
+        "Handle incoming datagram - audio chunk, or status packet"
+        if self._handle_datagram(data, addr):
+            self.chunk_queue.chunk_available.set()
 
     def error_received(self, exc):
         print('Error received:', exc)
@@ -0,0 +1,222 @@
+"""
+Relay - forward the stream to another network.
+
+Multicast doesn't cross routers and VLANs. The relay listens on the channel
+like a receiver does (joining the multicast group) and forwards each
+datagram, unchanged, to its destinations: eg. a multicast group on another
+interface (--source-address) or unicast receivers. Nothing is decoded - the
+time marks are absolute, so chunks keep their play time and the forwarding
+only takes its delay from the latency margin.
+
+Datagrams are drained in batches into preallocated buffers and sent from
+them without copying (copied only when queued for a slow destination).
+
+Receivers behind the relay send their reports and time requests to it. Both
+are passed to the sender from a unicast socket - the listening one may be
+bound to a multicast group and wouldn't get the responses. Time responses
+come back to the unicast socket and are routed to the requester.
+"""
+
+import errno
+import socket
+import asyncio
+from time import perf_counter
+
+from libwavesync import Packetizer
+from libwavesync.batch_socket import BatchReceiver
+from libwavesync.send_scheduler import SendScheduler
+from libwavesync.receiver import join_multicast
+from libwavesync.feedback import FLAG_REPORT
+from libwavesync import clock_sync
+from libwavesync.metrics import Histogram
+
+
+class Relay:
+    "Forward datagrams of a stream from the channel to the destinations"
+
+    # Max number of batches handled in a single socket readiness callback
+    MAX_DRAIN_ROUNDS = 8
+
+    # Time requests waiting for their responses
+    MAX_REQUESTS = 256
+
+    def __init__(self, channel, destinations, batch=32):
+        self.channel = channel
+        self.destinations = list(destinations)
+        self.batch = batch
+
+        # Receives the stream
+        self.sock = None
+        self.receiver = None
+
+        # Sends the stream, receives the receivers' datagrams
+        self.out_sock = None
+        self.sender = None
+
+        # Sends the receivers' datagrams to the sender, receives the time
+        # responses
+        self.up_sock = None
+
+        # Address the status packets come from
+        self.sender_address = None
+
+        # Time of a forwarded time request -> address of the requester
+        self.requests = {}
+
+        # Statistics
+        self.forwarded = 0
+        self.bytes_forwarded = 0
+        self.send_errors = 0
+        self.replies = 0
+        # Time from draining a datagram from the socket until it's sent
+        self.forward_us = Histogram(highest=10000000, scale=1e-6)
+
+    def register_metrics(self, metrics):
+        "Export the relay statistics"
+        counters = [
+            ('forwarded', 'Datagrams forwarded to all destinations'),
+            ('bytes_forwarded', 'Bytes forwarded to all destinations'),
+            ('send_errors', 'Failed sends to destinations'),
+            ('replies', 'Reports and time requests passed to the sender'),
+        ]
+        for name, help_text in counters:
+            metrics.add_counter('relay_' + name + '_total', help_text,
+                                lambda name=name: getattr(self, name))
+        metrics.add_histogram('relay_forward_seconds',
+                              'Time from receiving a datagram to sending it',
+                              self.forward_us)
+
+    def create_sockets(self, ttl, multicast_loop, source_address=None):
+        "Open the listening, the sending and the upstream socket"
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.channel)
+        join_multicast(self.sock, self.channel)
+        self.sock.setblocking(False)
+        self.receiver = BatchReceiver(self.sock, self.batch)
+
+        self.out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.out_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.out_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP,
+                                 1 if multicast_loop else 0)
+        if source_address:
+            # Send the multicast through the other interface
+            self.out_sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF,
+                                     socket.inet_aton(source_address))
+            self.out_sock.bind((source_address, 0))
+        else:
+            self.out_sock.bind(('0.0.0.0', 0))
+        self.out_sock.setblocking(False)
+        self.sender = SendScheduler(self.out_sock, self.destinations)
+
+        self.up_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.up_sock.bind(('0.0.0.0', 0))
+        self.up_sock.setblocking(False)
+
+    def start(self, loop):
+        "Forward on the socket readiness"
+        loop.add_reader(self.sock.fileno(), self._drain)
+        loop.add_reader(self.out_sock.fileno(), self._handle_replies)
+        loop.add_reader(self.up_sock.fileno(), self._handle_responses)
+
+    def close(self, loop):
+        "Stop forwarding and close the sockets"
+        for sock in (self.sock, self.out_sock, self.up_sock):
+            loop.remove_reader(sock.fileno())
+            loop.remove_writer(sock.fileno())
+            sock.close()
+
+    def _drain(self):
+        "Socket is readable - forward all waiting datagrams"
+        for _ in range(self.MAX_DRAIN_ROUNDS):
+            datagrams = self.receiver.receive()
+            received = perf_counter()
+            for data, address in datagrams:
+                if not data:
+                    continue
+                flags = data[0]
+                if flags == clock_sync.FLAG_TIMESYNC:
+                    # Not a part of the stream
+                    continue
+                if flags & Packetizer.FLAG_STATUS:
+                    self.sender_address = address
+
+                failures = self.sender.send([data])
+                if failures:
+                    self.send_errors += len(failures)
+                self.forwarded += 1
+                self.bytes_forwarded += len(data) * len(self.destinations)
+                self.forward_us.record((perf_counter() - received) * 1000000)
+            if len(datagrams) < self.batch:
+                break
+
+    def _handle_responses(self):
+        "Route the time responses of the sender"
+        while True:
+            try:
+                data = self.up_sock.recv(256)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # ICMP error of a passed datagram - sender is gone
+                continue
+            if data and data[0] == clock_sync.FLAG_TIMESYNC:
+                self._route_response(data)
+
+    def _route_response(self, data):
+        "Send time response to the receiver which asked for it"
+        if len(data) != clock_sync.RESPONSE.size:
+            return
+        address = self.requests.pop(bytes(data[2:10]), None)
+        if address is None:
+            return
+        try:
+            self.out_sock.sendto(data, address)
+        except OSError as ex:
+            print("WARNING: Unable to pass time response:", ex)
+
+    def _handle_replies(self):
+        "Pass reports and time requests of the receivers to the sender"
+        while True:
+            try:
+                data, address = self.out_sock.recvfrom(256)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                # ICMP errors of the forwarded audio are reported here
+                if ex.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                                errno.ENETUNREACH):
+                    continue
+                raise
+            if not data or self.sender_address is None:
+                continue
+            if data[0] == clock_sync.FLAG_TIMESYNC:
+                if len(data) != clock_sync.REQUEST.size:
+                    continue
+                if len(self.requests) >= self.MAX_REQUESTS:
+                    self.requests.clear()
+                self.requests[data[2:10]] = address
+            elif data[0] != FLAG_REPORT:
+                continue
+            try:
+                self.up_sock.sendto(data, self.sender_address)
+                self.replies += 1
+            except OSError as ex:
+                print("WARNING: Unable to pass datagram to the sender:", ex)
+
+    def show(self):
+        "Display statistics"
+        s = ("RELAY: dsts=%d fwd=%d kB=%d errors=%d replies=%d "
+             "p50=%.0fus p99=%.0fus")
+        print(s % (len(self.destinations), self.forwarded,
+                   self.bytes_forwarded / 1024, self.send_errors, self.replies,
+                   self.forward_us.percentile(50),
+                   self.forward_us.percentile(99)))
+        for line in self.sender.problems():
+            print(line)
+
+    async def run(self, interval=10.0):
+        "Print the statistics periodically"
+        while True:
+            await asyncio.sleep(interval)
+            self.show()
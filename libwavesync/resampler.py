@@ -0,0 +1,70 @@
+"""
+Fractional resampling of the played audio, compensating the drift between
+the sender's and the receiver's sound card clocks. Requires NumPy.
+"""
+
+from libwavesync import pcm
+
+
+class Resampler:
+    """
+    Stream resampler with a 4-point cubic (Catmull-Rom) interpolation,
+    vectorized over all frames and channels of a chunk.
+
+    The ratio is output frames per input frame and is expected to stay close
+    to 1 (tens or hundreds of ppm off). The interpolation state (last input
+    frames and the fractional position) carries over between chunks, so
+    the chunks join without discontinuities.
+    """
+
+    # Input frames kept from the previous chunk
+    HISTORY = 3
+
+    def __init__(self, audio_config):
+        if pcm.numpy is None:
+            raise ImportError("Resampler requires NumPy")
+        self.audio_config = audio_config
+        self.ratio = 1.0
+        self.reset()
+
+    def reset(self):
+        "Start from scratch - eg. after a gap in the stream"
+        self._history = None
+        # Position of the next output frame in the buffer of
+        # history + current chunk.
+        self._position = float(self.HISTORY)
+
+    def process(self, chunk):
+        "Resample chunk, returns PCM bytes"
+        np = pcm.numpy
+        config = self.audio_config
+        samples = pcm.to_array(chunk, config.sample, config.channels)
+        if self._history is None:
+            self._history = np.repeat(samples[:1], self.HISTORY, axis=0)
+
+        buf = np.concatenate([self._history, samples]).astype(np.float64)
+        step = 1.0 / self.ratio
+
+        # Outputs need buf[i - 1] .. buf[i + 2]
+        last = len(buf) - 2
+        count = int(np.ceil((last - self._position) / step))
+        positions = self._position + step * np.arange(count)
+        index = positions.astype(np.int64)
+        frac = (positions - index)[:, None]
+
+        p0 = buf[index - 1]
+        p1 = buf[index]
+        p2 = buf[index + 1]
+        p3 = buf[index + 2]
+        out = p1 + 0.5 * frac * (
+            p2 - p0 + frac * (
+                2.0 * p0 - 5.0 * p1 + 4.0 * p2 - p3 + frac * (
+                    3.0 * (p1 - p2) + p3 - p0)))
+
+        # Next chunk's buffer starts with the last HISTORY frames
+        self._history = samples[-self.HISTORY:]
+        self._position += step * count - len(samples)
+
+        top = 2 ** (config.sample - 1)
+        out = np.clip(out.round(), -top, top - 1)
+        return pcm.from_array(out, config.sample)
@@ -0,0 +1,204 @@
+"""
+Preallocated ring buffers used to pass audio between pipeline stages without
+per-chunk allocations.
+"""
+
+
+class ChunkRing:
+    """
+    Ring of fixed, chunk-sized slots in a single preallocated bytearray.
+
+    Incoming stream data is copied once into the ring and complete chunks are
+    handed out as memoryviews of their slots - without any further copying.
+
+    A slot is overwritten after `slots` more chunks were produced, so the
+    consumer has to be done with a chunk (or copy it) by then.
+    """
+
+    def __init__(self, chunk_size, slots):
+        assert chunk_size > 0 and slots > 2
+        self.chunk_size = chunk_size
+        self.slots = slots
+
+        self.buffer = bytearray(chunk_size * slots)
+        self.view = memoryview(self.buffer)
+
+        # Slot being currently filled and number of bytes already in it
+        self.slot = 0
+        self.filled = 0
+
+    def feed(self, data):
+        "Copy data into the ring and return a list of completed chunk views"
+        chunks = []
+        data = memoryview(data)
+        size = len(data)
+        chunk_size = self.chunk_size
+        view = self.view
+        pos = 0
+        while pos < size:
+            start = self.slot * chunk_size
+            if self.filled == 0:
+                # Copy as many whole chunks as fit before the end of the ring
+                # with a single copy.
+                count = min((size - pos) // chunk_size, self.slots - self.slot)
+                if count:
+                    end = start + count * chunk_size
+                    view[start:end] = data[pos:pos + count * chunk_size]
+                    chunks.extend(view[offset:offset + chunk_size]
+                                  for offset in range(start, end, chunk_size))
+                    pos += count * chunk_size
+                    self.slot = (self.slot + count) % self.slots
+                    continue
+
+            # Incomplete chunk - fill the current slot
+            take = min(chunk_size - self.filled, size - pos)
+            offset = start + self.filled
+            view[offset:offset + take] = data[pos:pos + take]
+            pos += take
+            self.filled += take
+
+            if self.filled == chunk_size:
+                chunks.append(view[start:start + chunk_size])
+                self.filled = 0
+                self.slot += 1
+                if self.slot == self.slots:
+                    self.slot = 0
+        return chunks
+
+    def pending(self):
+        "Copy of the data which doesn't form a complete chunk yet"
+        start = self.slot * self.chunk_size
+        return bytes(self.view[start:start + self.filled])
+
+
+class FrameRing:
+    """
+    Single producer, single consumer byte ring for passing audio from the
+    event loop to the audio callback thread.
+
+    Lock-free: each side only advances its own, ever increasing, position.
+    Assigning an integer attribute is atomic in CPython, so the other side
+    always sees a consistent position. Data is written before the position
+    is advanced, so the reader never sees unwritten bytes.
+    """
+
+    def __init__(self, capacity, frame_size):
+        assert capacity >= frame_size > 0
+        # Always keep whole frames
+        capacity -= capacity % frame_size
+        self.capacity = capacity
+        self.frame_size = frame_size
+
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+
+        # Total bytes written and read
+        self.write_pos = 0
+        self.read_pos = 0
+
+        # Bytes of silence substituted when reading from an empty ring
+        self.underrun_bytes = 0
+
+        # Position up to which the data should be dropped. Set by the
+        # producer, applied by the consumer.
+        self._flush_to = None
+
+    def available(self):
+        "Bytes ready to be read"
+        return self.write_pos - self.read_pos
+
+    def space(self):
+        "Bytes which can be written"
+        return self.capacity - (self.write_pos - self.read_pos)
+
+    def _copy(self, position, data):
+        "Copy data into the ring at the absolute position"
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.view[start:start + first] = data[:first]
+        if first < len(data):
+            self.view[:len(data) - first] = data[first:]
+
+    def write(self, data):
+        "Producer: write as much of data as fits, returns number of bytes written"
+        size = min(len(data), self.space())
+        size -= size % self.frame_size
+        if size:
+            self._copy(self.write_pos, memoryview(data)[:size])
+            self.write_pos += size
+        return size
+
+    def read(self, size):
+        """
+        Consumer: read exactly size bytes. Missing data is replaced with
+        silence.
+        """
+        flush_to = self._flush_to
+        if flush_to is not None:
+            self._flush_to = None
+            self.read_pos = max(self.read_pos, flush_to)
+
+        take = min(size, self.available())
+        take -= take % self.frame_size
+        start = self.read_pos % self.capacity
+        first = min(take, self.capacity - start)
+        data = self.buffer[start:start + first]
+        if first < take:
+            data += self.buffer[:take - first]
+        self.read_pos += take
+
+        if take < size:
+            if self.write_pos:
+                # Not just waiting for the first data
+                self.underrun_bytes += size - take
+            data += bytes(size - take)
+        return bytes(data)
+
+    def clear(self):
+        "Producer: drop the data written so far"
+        self._flush_to = self.write_pos
+
+
+class SharedRing:
+    """
+    Ring of fixed size slots in shared memory, used to pass chunks between
+    processes. Only slot indices need to be sent between them.
+
+    Created by the owner (name=None) and attached to by name in the other
+    processes. Bookkeeping of free slots is up to the owner.
+    """
+
+    def __init__(self, slot_size, slots, name=None):
+        # Imported here - not available everywhere (eg. Python < 3.8)
+        from multiprocessing import shared_memory
+
+        self.slot_size = slot_size
+        self.slots = slots
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=slot_size * slots)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.view = self.shm.buf
+
+    def slot(self, index):
+        "Memoryview of the whole slot"
+        start = index * self.slot_size
+        return self.view[start:start + self.slot_size]
+
+    def close(self):
+        """
+        Detach - and free the memory in the owner.
+
+        Views of the slots have to be released first, otherwise the memory
+        stays mapped until exit.
+        """
+        self.view = None
+        if self.owner:
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
@@ -1,29 +1,44 @@
 import asyncio
-from libwavesync import time_machine
+from libwavesync import time_machine, trace
+from libwavesync.ring_buffer import ChunkRing
+from libwavesync.silence import SilenceDetector
 
 class SampleReader(asyncio.Protocol):
     """Read samples over the network, chunk them and put into a queue"""
 
-    # Number of empty chunks before silence is detected.
-    SILENCE_TRESHOLD = 20
     HEADER_SIZE = 4
 
-    def __init__(self, audio_config):
+    # Number of chunks buffered in the ring. Chunks are handed out as views
+    # of the ring, so this also limits the length of the sample queue.
+    RING_SLOTS = 1024
+
+    def __init__(self, audio_config, silence_detector=None):
         super().__init__()
         self.sample_queue = asyncio.Queue()
 
         self.audio_config = audio_config
 
-        self.silence_detect = 0
+        if silence_detector is None:
+            silence_detector = SilenceDetector(audio_config)
+        self.silence = silence_detector
+
+        # Size of the datagram header, set before the payload_size
+        self.header_size = self.HEADER_SIZE
 
         # Initialized along the chunk_size
         self._payload_size = None
 
         # Buffering before chunking
-        self.buffer = None
+        self.ring = None
+
+        # Chunks dropped because the consumer didn't keep up with the input
+        self.overflows = 0
 
-        # Tracking stream time.
+        # Tracking stream time (ns). Counted from the stream start in frames,
+        # so the integer time doesn't accumulate rounding errors.
         self.stream_time = None
+        self.stream_start = None
+        self.stream_frames = 0
 
     @property
     def payload_size(self):
@@ -34,63 +49,66 @@ class SampleReader(asyncio.Protocol):
         "Calculate optimal chunk size"
         # 1420 is max payload for UDP over 1500 MTU ethernet
         # 80 - max IP header (60) + UDP header.
-        # 4 - our header / timestamp
+        # 4 - our header / timestamp (6 with a sequence number)
         # NOTE: 60 bytes is pessimistically large IP header. Could be as
         #       small as 20 bytes.
 
         # Remove our header from the max payload size
         self._payload_size = payload_size
-        max_chunk_size = payload_size - self.HEADER_SIZE
+        max_chunk_size = payload_size - self.header_size
         self.audio_config.chunk_size = max_chunk_size
 
     def connection_made(self, transport):
         "Initialize stream buffer"
-        self.buffer = bytes()
+        self.ring = ChunkRing(self.audio_config.chunk_size, self.RING_SLOTS)
+
+    def _resize_ring(self, data):
+        """
+        Recreate ring for a changed chunk size.
+
+        Returns data with the incomplete chunk of the previous ring prepended,
+        so that the stream stays frame-aligned.
+        """
+        pending = self.ring.pending() if self.ring is not None else b''
+        self.ring = ChunkRing(self.audio_config.chunk_size, self.RING_SLOTS)
+        return pending + data
 
     def data_received(self, data):
         "Read fifo indefinitely and push data into queue"
-
-        # TODO: Buffer needs to be only twice the size of the data
-        # and could be handled without allocations/deallocations.
-        # TODO: Use bytearray()
-        self.buffer += data
-
-        while len(self.buffer) >= self.audio_config.chunk_size:
-            chunk = self.buffer[:self.audio_config.chunk_size]
-            self.buffer = self.buffer[self.audio_config.chunk_size:]
-
-            # Detect the end of current silence
-            if self.silence_detect is True:
-                if any(chunk):
-                    self.silence_detect = 0
-                    print("Silence - end")
-                    now = time_machine.now()
-                    if not self.stream_time or self.stream_time < now:
-                        self.stream_time = now
-                else:
-                    # Still silence
-                    continue
-            else:
-                # Heuristic detection of silence start
-                if chunk[0] == 0 and chunk[-1] == 0:
-                    self.silence_detect += 1
-                else:
-                    self.silence_detect = 0
-
-                # Silence too long - stop transmission
-                if self.silence_detect > self.SILENCE_TRESHOLD:
-                    if any(chunk): # Accurate check
-                        self.silence_detect = 0
-                    else:
-                        print("Silence - start")
-                        self.silence_detect = True
-                        continue
+        if self.ring is None or self.ring.chunk_size != self.audio_config.chunk_size:
+            data = self._resize_ring(data)
+
+        for chunk in self.ring.feed(data):
+            in_silence = self.silence.silent
+            if self.silence.update(chunk):
+                if not in_silence:
+                    print("Silence - start")
+                continue
+
+            if in_silence:
+                print("Silence - end")
+                now = time_machine.now_ns()
+                if not self.stream_time or self.stream_time < now:
+                    self._start_stream(now)
 
             if self.stream_time is None:
-                self.stream_time = time_machine.now()
+                self._start_stream(time_machine.now_ns())
             else:
-                self.stream_time += self.audio_config.chunk_time
+                self.stream_frames += len(chunk) // self.audio_config.frame_size
+                self.stream_time = (self.stream_start + self.stream_frames *
+                                    1000000000 // self.audio_config.rate)
+
+            # Ring slot of the oldest queued chunk is about to be reused.
+            # Held chunk + queued chunks + currently filled slot must fit.
+            if self.sample_queue.qsize() >= self.RING_SLOTS - 2:
+                self.sample_queue.get_nowait()
+                self.overflows += 1
+                if self.overflows % 100 == 1:
+                    print("WARNING: Sample queue overflow, dropped %d chunks" % self.overflows)
             self.sample_queue.put_nowait((self.stream_time, chunk))
+            if trace.tracer:
+                trace.tracer.record(trace.READ,
+                                    self.stream_time + self.audio_config.latency_ns)
 
         # Warning - might happen on slow UDP output sink
         if self.sample_queue.qsize() > 600:
@@ -99,11 +117,16 @@ class SampleReader(asyncio.Protocol):
             print(s)
 
         if self.stream_time is not None:
-            diff = self.stream_time - time_machine.now()
-            if diff < min(-self.audio_config.latency_ms/2, -1):
+            diff = self.stream_time - time_machine.now_ns()
+            if diff < -max(self.audio_config.latency_ms * 500000000, 1000000000):
                 print("WARNING: Input underflow.")
                 self.stream_time = None
 
+    def _start_stream(self, now_ns):
+        "Restart the stream time counting"
+        self.stream_time = self.stream_start = now_ns
+        self.stream_frames = 0
+
     def connection_lost(self, exc):
         print("The pulse was lost. I should go.")
         loop = asyncio.get_event_loop()
@@ -118,7 +141,7 @@ class SampleReader(asyncio.Protocol):
                 self.sample_queue.get_nowait()
             except asyncio.QueueEmpty:
                 break
-        return self.audio_config.chunk_size + self.HEADER_SIZE
+        return self.audio_config.chunk_size + self.header_size
 
     def get_next_chunk(self):
         return self.sample_queue.get()
@@ -0,0 +1,246 @@
+"""
+Non-blocking sending to many destinations.
+
+All destinations share one non-blocking socket. While every destination
+accepts the datagrams they are sent with the BatchSender in a single pass.
+A destination which can't take a datagram gets its own path:
+
+- socket buffer full (EAGAIN, ENOBUFS): the datagram waits in the
+  destination's bounded queue, flushed when the socket is writable. When the
+  queue is full the oldest datagram is dropped - stale audio is useless,
+- other errors (eg. EHOSTUNREACH): the destination is skipped for a backoff
+  time doubling with each consecutive failure.
+
+So a slow or unreachable receiver never delays the others. EMSGSIZE is not
+a fault of the destination - it's reported to the caller, which shrinks the
+payload.
+"""
+
+import errno
+import asyncio
+from collections import deque
+from time import perf_counter
+
+from libwavesync.batch_socket import BatchSender
+
+
+# Errors meaning the datagram should wait in the queue
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+class Destination:
+    "Queue, failure and backoff state of a single destination"
+
+    __slots__ = ('address', 'queue', 'dropped', 'failures', 'consecutive',
+                 'retry_at', 'last_error', 'skipped')
+
+    def __init__(self, address, queue_size):
+        self.address = address
+        self.queue = deque(maxlen=queue_size)
+        # Datagrams dropped from the full queue or after a failure
+        self.dropped = 0
+        # Failed sends and datagrams skipped during the backoff
+        self.failures = 0
+        self.skipped = 0
+        self.consecutive = 0
+        self.retry_at = 0.0
+        self.last_error = None
+
+    def enqueue(self, datagram):
+        "Queue the datagram, dropping the oldest one if full"
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(datagram)
+
+    def fail(self, ex, now, backoff_min, backoff_max):
+        "Count the failure and back off"
+        self.failures += 1
+        self.consecutive += 1
+        self.last_error = ex
+        self.dropped += len(self.queue)
+        self.queue.clear()
+        self.retry_at = now + min(backoff_min * 2 ** (self.consecutive - 1),
+                                  backoff_max)
+
+    def backoff_s(self, now):
+        "Time left to the next try"
+        return max(self.retry_at - now, 0.0)
+
+
+class SendScheduler:
+    """
+    Send datagrams to all destinations without letting any of them block
+    the others. Same interface as the BatchSender.
+    """
+
+    # Datagrams queued per destination, ~130ms of 44.1kHz stereo chunks
+    QUEUE_SIZE = 16
+
+    # Backoff after the first failure and the limit
+    BACKOFF_MIN = 0.1
+    BACKOFF_MAX = 5.0
+
+    def __init__(self, sock, destinations, queue_size=QUEUE_SIZE):
+        self.sock = sock
+        self.destinations = list(destinations)
+        self.batch_sender = BatchSender(sock, self.destinations)
+        self.states = [Destination(address, queue_size)
+                       for address in self.destinations]
+        self._by_address = {state.address: state for state in self.states}
+
+        # Destinations with a queue or backing off, the others are sent to
+        # by a BatchSender of their own
+        self.slow = set()
+        self._healthy = None
+        self._healthy_key = None
+        self._writer = False
+
+        # Datagrams handed for sending to all destinations
+        self.datagrams = 0
+
+    def send(self, parts):
+        """
+        Send datagram composed of parts to all destinations.
+
+        Returns list of (destination, OSError) for the destinations which
+        didn't get it - failed or backing off. Queued datagrams are counted
+        as sent.
+        """
+        self.datagrams += 1
+        if not self.slow:
+            failures = self.batch_sender.send(parts)
+            if failures:
+                failures = self._handle_failures(parts, failures)
+            return failures
+
+        skipped, recovered = self._send_slow(parts)
+        failures = self._healthy_sender().send(parts)
+        if failures:
+            failures = self._handle_failures(parts, failures)
+        for state in recovered:
+            if state not in self.slow:
+                state.consecutive = 0
+        return skipped + failures
+
+    def _send_slow(self, parts):
+        """
+        Queue the datagram for the destinations with a queue, skip those
+        backing off. Returns (skipped failures, destinations done backing off).
+        """
+        now = perf_counter()
+        datagram = None
+        skipped = []
+        recovered = []
+        for state in list(self.slow):
+            if state.retry_at > now:
+                state.skipped += 1
+                skipped.append((state.address, state.last_error))
+            elif state.queue:
+                # Keep the order - send after the queued ones
+                if datagram is None:
+                    datagram = b''.join(parts)
+                state.enqueue(datagram)
+            else:
+                # Try again with the others
+                self.slow.discard(state)
+                recovered.append(state)
+        return skipped, recovered
+
+    def _healthy_sender(self):
+        "BatchSender of the destinations without a queue or backoff"
+        key = frozenset(self.slow)
+        if key != self._healthy_key:
+            self._healthy = BatchSender(self.sock, [state.address
+                                                    for state in self.states
+                                                    if state not in key])
+            self._healthy_key = key
+        return self._healthy
+
+    def _handle_failures(self, parts, failures):
+        "Queue or back off the destinations which failed in the batch"
+        now = perf_counter()
+        datagram = None
+        reported = []
+        for address, ex in failures:
+            state = self._by_address[address]
+            if ex.errno in _WOULD_BLOCK:
+                if datagram is None:
+                    datagram = b''.join(parts)
+                self._enqueue(state, datagram)
+            else:
+                reported.append((address, ex))
+                if ex.errno != errno.EMSGSIZE:
+                    self._fail(state, ex, now)
+        return reported
+
+    def _enqueue(self, state, datagram):
+        "Queue datagram and wait for the socket to be writable"
+        state.enqueue(datagram)
+        self.slow.add(state)
+        if not self._writer:
+            asyncio.get_event_loop().add_writer(self.sock.fileno(), self.flush)
+            self._writer = True
+
+    def _fail(self, state, ex, now):
+        "Back off after a failure"
+        state.fail(ex, now, self.BACKOFF_MIN, self.BACKOFF_MAX)
+        self.slow.add(state)
+
+    def flush(self):
+        "Socket is writable - send the queued datagrams"
+        now = perf_counter()
+        waiting = False
+        for state in list(self.slow):
+            queue = state.queue
+            while queue:
+                try:
+                    self.sock.sendto(queue[0], state.address)
+                except OSError as ex:
+                    if ex.errno in _WOULD_BLOCK:
+                        waiting = True
+                        break
+                    self._fail(state, ex, now)
+                    break
+                queue.popleft()
+                state.consecutive = 0
+            if not queue and state.retry_at <= now:
+                self.slow.discard(state)
+
+        if not waiting and self._writer:
+            asyncio.get_event_loop().remove_writer(self.sock.fileno())
+            self._writer = False
+
+    def queued(self):
+        "Number of datagrams waiting in the queues"
+        return sum(len(state.queue) for state in self.slow)
+
+    def dropped(self):
+        "Datagrams dropped from the queues"
+        return sum(state.dropped for state in self.states)
+
+    def failures(self):
+        "Failed sends and the datagrams skipped while backing off"
+        return sum(state.failures + state.skipped for state in self.states)
+
+    def backing_off(self):
+        "Number of destinations currently skipped"
+        now = perf_counter()
+        return sum(1 for state in self.slow if state.retry_at > now)
+
+    def problems(self):
+        "Status lines of the destinations which lost datagrams"
+        now = perf_counter()
+        lines = []
+        for state in self.states:
+            if not (state.dropped or state.failures or state.queue):
+                continue
+            s = "  %s:%d: queued=%d dropped=%d failures=%d skipped=%d"
+            s = s % (state.address[0], state.address[1], len(state.queue),
+                     state.dropped, state.failures, state.skipped)
+            backoff = state.backoff_s(now)
+            if backoff:
+                s += " backoff=%.1fs" % backoff
+            if state.last_error is not None:
+                s += " error=%s" % (state.last_error.strerror or state.last_error)
+            lines.append(s)
+        return lines
@@ -0,0 +1,100 @@
+"""
+Detection of silent input to stop flooding the network.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SilenceDetector:
+    """
+    Decide whether the input chunks are silent.
+
+    With NumPy a chunk counts as silent when its peak (or RMS) level is below
+    the threshold given in dBFS - this catches dithered and noise-floor
+    "digital near-silence". Without NumPy only the digital silence (all
+    zeroes) is detected.
+
+    Silence starts after `hold_chunks` consecutive quiet chunks and ends when
+    the level exceeds the threshold increased by the hysteresis.
+    """
+
+    # Number of quiet chunks before silence is detected.
+    HOLD_CHUNKS = 20
+
+    METRICS = ('peak', 'rms')
+
+    def __init__(self, audio_config, threshold_db=-70, hysteresis_db=6,
+                 metric='peak', hold_chunks=HOLD_CHUNKS):
+        assert metric in self.METRICS
+        assert threshold_db <= 0 and hysteresis_db >= 0
+        self.audio_config = audio_config
+        self.metric = metric
+        self.hold_chunks = hold_chunks
+
+        # Levels are measured on the top 16 bits of each sample, and compared
+        # in linear scale.
+        self.enter_level = 32768 * 10 ** (threshold_db / 20)
+        self.exit_level = 32768 * 10 ** ((threshold_db + hysteresis_db) / 20)
+
+        # Number of consecutive quiet chunks and the current state
+        self.quiet_chunks = 0
+        self.silent = False
+
+        # Cached zeroed chunk for the digital silence comparison
+        self._zeroes = b''
+
+        if numpy is None:
+            print("NumPy not available - detecting only the digital silence")
+
+    def _is_zero(self, chunk):
+        "Fast check for a digital silence"
+        if len(self._zeroes) != len(chunk):
+            self._zeroes = bytes(len(chunk))
+        return bytes(chunk) == self._zeroes
+
+    def _samples(self, chunk):
+        "Decode most significant 16 bits of each sample into floats"
+        if self.audio_config.sample == 16:
+            samples = numpy.frombuffer(chunk, dtype='<i2')
+        else:
+            # Zero-copy, strided view at the two top bytes of 24-bit samples
+            samples = numpy.ndarray(shape=(len(chunk) // 3,),
+                                    dtype='<i2',
+                                    buffer=chunk,
+                                    offset=1,
+                                    strides=(3,))
+        return samples.astype(numpy.float32)
+
+    def is_quiet(self, chunk, level):
+        "Is the chunk level below given linear level?"
+        if numpy is None or not chunk:
+            return self._is_zero(chunk)
+
+        samples = self._samples(chunk)
+        if self.metric == 'peak':
+            return float(numpy.abs(samples).max()) < level
+
+        # Compare sum of squares, instead of calculating the root of mean.
+        return float(numpy.dot(samples, samples)) < level * level * len(samples)
+
+    def update(self, chunk):
+        "Track the state and return True if chunk is a part of a silence"
+        if self.silent:
+            if self.is_quiet(chunk, self.exit_level):
+                return True
+            self.silent = False
+            self.quiet_chunks = 0
+            return False
+
+        if self.is_quiet(chunk, self.enter_level):
+            self.quiet_chunks += 1
+        else:
+            self.quiet_chunks = 0
+
+        if self.quiet_chunks > self.hold_chunks:
+            self.silent = True
+            return True
+        return False
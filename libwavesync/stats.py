@@ -1,10 +1,15 @@
 from time import time
 
+from libwavesync.metrics import Histogram
+
 class Stats:
     """
     Aggregate statistics from all components and display periodically
     """
-    def __init__(self):
+    def __init__(self, name=None):
+        # Output device name when the receiver plays on several
+        self.name = name
+
         # Chunk counter
         self.chunks = 0
         self.start = time()
@@ -12,41 +17,133 @@ class Stats:
         # Player stats
         self.time_drops = 0
         self.output_delays = 0
-        self.total_delay = 0
+        self.output_underruns_ms = 0
+        self.frames_corrected = 0
+        self.gap_chunks = 0
+        self.drift_ppm = 0.0
+        self.total_delay_ns = 0
         self.total_chunks = 0
 
+        # Distributions (microseconds, queue in chunks)
+        self.delay_us = Histogram(highest=60000000, scale=1e-6)
+        # Chunks dequeued already past their play time
+        self.late_us = Histogram(highest=60000000, scale=1e-6)
+        self.output_wait_us = Histogram(highest=10000000, scale=1e-6)
+        self.queue_length = Histogram(highest=4096)
+
         # Receiver stats
         self.network_latency = 0
         self.network_drops = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.late_arrivals = 0
+        self.fec_recovered = 0
+        self.fec_unrecoverable = 0
+        self.jitter_us = Histogram(highest=10000000, scale=1e-6)
+
+        # Clock synchronisation - offset of the sender's clock and its
+        # estimated error (seconds)
+        self.clock_offset = None
+        self.clock_error = None
 
     def show(self, queue_length):
         "Display statistics"
         took = time() - self.start
         chunks_per_s = self.chunks / took
 
-        s = ("STAT: chunks: q_len=%-3d "
+        s = ("STAT%s: chunks: q_len=%-3d "
              "ch/s=%5.1f "
              "net lat: %-5.1fms "
-             "avg_delay=%-5.2f drops: time=%d net=%d out_delay=%d")
+             "avg_delay=%-5.2f drops: time=%d net=%d out_delay=%d "
+             "dup=%d reord=%d late_arr=%d corr=%.0f/min "
+             "p99: delay=%.1fms jitter=%.1fms")
 
         s = s % (
+            '' if self.name is None else ' ' + self.name,
             queue_length,
             chunks_per_s,
             1000.0 * self.network_latency,
-            1000.0 * self.total_delay/self.total_chunks,
+            self.total_delay_ns / self.total_chunks / 1e6,
             self.time_drops,
             self.network_drops,
             self.output_delays,
+            self.duplicates,
+            self.reordered,
+            self.late_arrivals,
+            60.0 * self.frames_corrected / took,
+            self.delay_us.percentile(99) / 1000.0,
+            self.jitter_us.percentile(99) / 1000.0,
         )
+
+        if self.late_us.count:
+            s += " late: n=%d p99=%.1fms" % (
+                self.late_us.count, self.late_us.percentile(99) / 1000.0)
+        if self.drift_ppm:
+            s += " drift=%+.1fppm" % self.drift_ppm
+        if self.output_underruns_ms:
+            s += " underruns=%.0fms" % self.output_underruns_ms
+
+        if self.clock_offset is not None:
+            s += " clock: offset=%+.2fms err=%.2fms" % (
+                1000.0 * self.clock_offset, 1000.0 * self.clock_error)
+
+        fec_total = self.fec_recovered + self.fec_unrecoverable
+        if fec_total:
+            s += " fec: rec=%d lost=%d rate=%.1f%%" % (
+                self.fec_recovered, self.fec_unrecoverable,
+                100.0 * self.fec_recovered / fec_total)
         print(s)
 
         # Warnings
         if self.network_latency > 1:
             print("WARNING: Your network latency seems HUGE. "
-                  "Are the clocks synchronised?")
+                  "Are the clocks synchronised (NTP or --clock-sync)?")
         elif self.network_latency <= -0.05:
             print("WARNING: You either exceeded the speed of "
-                  "light or have unsynchronised clocks")
+                  "light or have unsynchronised clocks (try --clock-sync)")
+
+    def register_metrics(self, metrics, prefix=''):
+        "Export the receiver statistics, names prefixed with the prefix"
+        metrics.add_histogram(prefix + 'chunk_delay_seconds',
+                              'Time from dequeuing a chunk to its play time',
+                              self.delay_us)
+        metrics.add_histogram(prefix + 'chunk_lateness_seconds',
+                              'Time from the play time to dequeuing a late chunk',
+                              self.late_us)
+        metrics.add_histogram(prefix + 'arrival_jitter_seconds',
+                              'Chunk arrival interval minus the chunk time interval',
+                              self.jitter_us)
+        metrics.add_histogram(prefix + 'output_wait_seconds',
+                              'Time waiting for the output buffer space',
+                              self.output_wait_us)
+        metrics.add_histogram(prefix + 'queue_length_chunks',
+                              'Chunks waiting in the queue',
+                              self.queue_length)
+        counters = [
+            ('chunks_played', 'total_chunks', 'Chunks handled by the player'),
+            ('time_drops', 'time_drops', 'Chunks dropped as too late'),
+            ('network_drops', 'network_drops', 'Chunks lost in the network'),
+            ('output_delays', 'output_delays', 'Waits for the output buffer'),
+            ('duplicates', 'duplicates', 'Duplicated datagrams'),
+            ('reordered', 'reordered', 'Reordered datagrams'),
+            ('late_arrivals', 'late_arrivals',
+             'Datagrams arriving after their chunk was given up as lost'),
+            ('fec_recovered', 'fec_recovered', 'Chunks rebuilt from parity'),
+            ('fec_unrecoverable', 'fec_unrecoverable', 'Chunks lost despite parity'),
+            ('frames_corrected', 'frames_corrected', 'Frames added or removed to keep sync'),
+            ('gap_chunks', 'gap_chunks', 'Slots of lost chunks played as silence'),
+        ]
+        for name, attribute, help_text in counters:
+            metrics.add_counter(prefix + name + '_total', help_text,
+                                lambda attribute=attribute: getattr(self, attribute))
+        metrics.add_gauge(prefix + 'drift_ppm', 'Estimated sound card clock drift',
+                          lambda: self.drift_ppm)
+        metrics.add_gauge(prefix + 'network_latency_seconds',
+                          'Network latency measured from status packets',
+                          lambda: self.network_latency)
+        metrics.add_gauge(prefix + 'clock_error_seconds',
+                          'Estimated error of the clock synchronisation',
+                          lambda: self.clock_error or 0.0)
 
     def chunk(self, queue_length):
         """
@@ -0,0 +1,127 @@
+"""
+Sample-accurate playback sync correction.
+
+Instead of dropping whole chunks the player adds or removes a few frames per
+chunk. The amount is decided by a PI controller from the measured timing
+error and the frames are spliced with a short crossfade (plain splice
+without NumPy).
+"""
+
+from libwavesync import pcm
+
+
+class SyncController:
+    """
+    PI controller turning the timing error into frames to add (positive) or
+    remove (negative) in the next chunk.
+
+    Error is positive when the chunk would be played too early.
+    """
+
+    # Part of the error corrected per chunk. Gains were tuned in
+    # a simulation with 0.2ms measurement jitter and up to 100ppm drift -
+    # larger ones make the corrections hunt around the target.
+    KP = 0.02
+
+    # Integral gain - removes the steady error caused by clock drift
+    KI = 0.0002
+
+    # Errors below this are ignored by the proportional part (seconds)
+    DEADBAND = 0.0003
+
+    def __init__(self, audio_config, max_frames):
+        self.rate = audio_config.rate
+        self.max_frames = max_frames
+        self.integral = 0.0
+        self._carry = 0.0
+
+    def reset(self):
+        "Forget the history - after a resync"
+        self.integral = 0.0
+        self._carry = 0.0
+
+    def update(self, error):
+        "Return number of frames to correct in the next chunk"
+        error_frames = error * self.rate
+        proportional = 0.0 if abs(error) < self.DEADBAND else self.KP * error_frames
+
+        # Anti-windup: integral alone can't exceed the correction limit
+        limit = self.max_frames / self.KI
+        self.integral = max(-limit, min(limit, self.integral + error_frames))
+
+        self._carry += proportional + self.KI * self.integral
+        self._carry = max(-self.max_frames, min(self.max_frames, self._carry))
+        frames = int(self._carry)
+        self._carry -= frames
+        return frames
+
+
+class FrameCorrector:
+    """
+    Add or remove frames from a chunk.
+
+    Frames are added by repeating a part of the chunk, removed by skipping
+    it. The join is crossfaded over CROSSFADE frames in the middle of the
+    chunk.
+    """
+
+    CROSSFADE = 64
+
+    def __init__(self, audio_config):
+        self.audio_config = audio_config
+        frames = audio_config.chunk_size // audio_config.frame_size
+
+        # Max frames corrected in a single chunk (~1% speed change)
+        self.max_frames = max(1, min(frames // 100, self.CROSSFADE // 4))
+        self._ramps = {}
+
+    def _ramp(self, length):
+        "Cached fade-in ramp"
+        ramp = self._ramps.get(length)
+        if ramp is None:
+            numpy = pcm.numpy
+            ramp = ((numpy.arange(length) + 0.5) / length)[:, None]
+            self._ramps[length] = ramp
+        return ramp
+
+    def apply(self, chunk, frames):
+        """
+        Return chunk longer by `frames` frames (or shorter if negative).
+        """
+        if frames == 0:
+            return chunk
+
+        config = self.audio_config
+        frame_size = config.frame_size
+        total = len(chunk) // frame_size
+        shift = abs(frames)
+        fade = min(self.CROSSFADE, total - 2 * shift)
+        if fade <= 0:
+            return chunk
+
+        # Fade from the original to the shifted stream:
+        # adding: x[:p] | fade(x[p:p+L] -> x[p-n:p-n+L]) | x[p-n+L:]
+        # removing: x[:p] | fade(x[p:p+L] -> x[p+n:p+n+L]) | x[p+n+L:]
+        position = (total - fade) // 2
+        if frames > 0:
+            source = position - shift
+        else:
+            source = position + shift
+        tail = (source + fade) * frame_size
+        head = position * frame_size
+
+        if pcm.numpy is None:
+            # No crossfade, splice only.
+            return bytes(chunk[:head]) + bytes(chunk[source * frame_size:])
+
+        original = pcm.to_array(chunk[head:head + fade * frame_size],
+                                config.sample, config.channels)
+        shifted = pcm.to_array(chunk[source * frame_size:tail],
+                               config.sample, config.channels)
+        ramp = self._ramp(fade)
+        mixed = original + (shifted - original) * ramp
+        return b''.join([
+            bytes(chunk[:head]),
+            pcm.from_array(mixed.round(), config.sample),
+            bytes(chunk[tail:]),
+        ])
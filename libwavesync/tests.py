@@ -1,4 +1,10 @@
+import os
+import errno
+import select
 import sys
+import json
+import tempfile
+import socket
 import asyncio
 import unittest
 from datetime import datetime
@@ -6,15 +12,36 @@ from unittest.mock import Mock, MagicMock
 
 from . import (
     AudioConfig,
+    AudioOutput,
     Packetizer,
     ChunkPlayer,
     ChunkQueue,
+    ChunkFanOut,
     SampleReader,
     Receiver,
+    Stats,
     cli_args,
 )
 
 from . import time_machine
+from .ring_buffer import ChunkRing, FrameRing
+from .send_scheduler import SendScheduler
+from . import batch_socket
+from . import silence
+from .fec import FecEncoder, FecDecoder
+from . import codec
+from .compression import AdaptiveCompression
+from .encode_pool import EncodePool
+from .sync_correction import SyncController, FrameCorrector
+from .drift import DriftEstimator
+from .resampler import Resampler
+from . import clock_sync
+from .feedback import Reporter, FleetTable
+from .metrics import Histogram, Metrics
+from . import trace
+from . import impair
+from . import channel_map
+from . import relay as relay_module
 
 
 async def mock_audio_generator(reader, packetizer, tx_player, rx_player):
@@ -59,38 +86,41 @@ def mock_chunk_player():
     "Mock chunk player"
     chunk_queue = ChunkQueue()
     player = ChunkPlayer(chunk_queue,
-                         receiver=None,
+                         stats=Stats(),
                          tolerance_ms=30,
                          buffer_size=8192,
                          # Mock output device
                          device_index=-1)
 
     # Mock output
-    player._close_stream = Mock()
-    original_open_stream = player._open_stream
-    def open_stream():
-        original_open_stream()
+    player.stream = Mock()
+    player.stream.get_write_available = Mock(return_value=300)
+    player.stream.write = Mock()
 
-        # Open stream after _open_stream is called
-        player.stream = Mock()
-        player.stream.get_write_available = Mock(return_value=300)
-        player.stream.write = Mock()
+    original_handle_cmd_cfg = player._handle_cmd_cfg
+    def handle_cmd_cfg(audio_config):
+        original_handle_cmd_cfg(audio_config)
+        # Output is created without a stream when tested - attach the mock.
+        player.audio_output.stream = player.stream
 
-    player._open_stream = open_stream
+    player._handle_cmd_cfg = handle_cmd_cfg
     return chunk_queue, player
 
 
-def mock_packetizer(audio_config, sample_reader, chunk_queue):
+def mock_packetizer(audio_config, sample_reader, chunk_queue,
+                    header_version=Packetizer.HEADER_VERSION):
     # Packet splitter / sender
     packetizer = Packetizer(sample_reader,
                             chunk_queue,
                             audio_config,
-                            compress=False)
+                            compress=False,
+                            header_version=header_version)
 
     # Mock UDP socket
     packetizer.sock = Mock()
-    packetizer.sock.sendto = Mock()
+    packetizer.sock.sendmsg = Mock()
     packetizer.destinations = [("Mocked IP", 1234)]
+    packetizer.sender = SendScheduler(packetizer.sock, packetizer.destinations)
     return packetizer
 
 
@@ -112,7 +142,7 @@ async def mock_packets(packets, receiver, player):
     await asyncio.sleep(0)
 
 
-def mock_txrx():
+def mock_txrx(header_version=Packetizer.HEADER_VERSION):
     """
     Mocked TX-RX pipeline
     """
@@ -136,10 +166,11 @@ def mock_txrx():
 
     # Sound sample reader
     sample_reader = SampleReader(audio_config)
+    sample_reader.header_size = Packetizer.HEADER_SIZES[header_version]
     sample_reader.payload_size = 1000
 
     tx_packetizer = mock_packetizer(audio_config, sample_reader,
-                                    tx_chunk_queue)
+                                    tx_chunk_queue, header_version)
 
     # Mock audio input
     task_tx_reader = mock_audio_generator(sample_reader,
@@ -155,11 +186,14 @@ def mock_txrx():
 
     rx_receiver = Receiver(rx_chunk_queue,
                            channel=channel,
-                           sink_latency_ms=0)
+                           sink_latency_ms=0,
+                           stats=Stats())
 
     # Combine TX-RX
     rx_receiver.connection_made(MagicMock())
-    tx_packetizer.sock.sendto = rx_receiver.datagram_received
+    def sendmsg(parts, ancdata, flags, address):
+        rx_receiver.datagram_received(b''.join(parts), address)
+    tx_packetizer.sock.sendmsg = sendmsg
 
     ##
     # Start loop
@@ -223,11 +257,1120 @@ class WaveSyncTestCase(unittest.TestCase):
         # Won't work, will assume next interval
         self.assertFalse(check(relatives[0], relatives[0]+10, 3000))
 
+        # Header v2 - microsecond marks
+        def check_us(relative1, relative2, latency_ms):
+            "Microsecond mark conversion, returns the error"
+            ts_future, mark = time_machine.get_timemark_us(relative1, latency_ms/1000)
+            self.assertEqual(len(mark), 4)
+            ts_recovered = time_machine.to_absolute_timestamp_us(relative2, mark)
+            return abs(relative1 + latency_ms/1000 - ts_recovered)
+
+        for relative in relatives + [1549305460.1234567, 1549306799.9999]:
+            for time in times + [60000]:
+                for later in [-3, 0.2, 1.8, time/1000 + 10]:
+                    self.assertLess(check_us(relative, relative + later, time),
+                                    0.000002)
+
+        # Integer variants of the per-chunk paths - exact to the resolution
+        for relative in [1549305460 * 10**9, 1549305459999999999,
+                         1549306799999912345]:
+            for time in times + [60000]:
+                latency_ns = time * 1000000
+                future, mark = time_machine.get_timemark_ns(relative, latency_ns)
+                self.assertEqual(future, relative + latency_ns)
+                if time < 60000:
+                    for later in [-3, 0.2, 1.8]:
+                        recovered = time_machine.to_absolute_ns(
+                            relative + int(later * 10**9), mark)
+                        self.assertEqual(recovered, future - future % 1000000)
+
+                future, mark = time_machine.get_timemark_us_ns(relative, latency_ns)
+                for later in [-3, 0.2, 1.8, time/1000 + 10]:
+                    recovered = time_machine.to_absolute_us_ns(
+                        relative + int(later * 10**9), mark)
+                    self.assertEqual(recovered, future - future % 1000)
+
+    def test_chunk_ring(self):
+        "Test chunking in the ring buffer"
+        ring = ChunkRing(chunk_size=4, slots=3)
+        self.assertEqual(ring.feed(b'012'), [])
+        self.assertEqual(ring.pending(), b'012')
+
+        chunks = ring.feed(b'3456789ab')
+        self.assertEqual([bytes(chunk) for chunk in chunks],
+                         [b'0123', b'4567', b'89ab'])
+        self.assertEqual(ring.pending(), b'')
+
+        # Slots are reused after a full turn of the ring
+        self.assertEqual([bytes(chunk) for chunk in ring.feed(b'cdefgh')],
+                         [b'cdef'])
+        self.assertEqual(bytes(chunks[0]), b'cdef')
+        self.assertEqual(ring.pending(), b'gh')
+
+    def test_frame_ring(self):
+        "Test ring feeding the audio callback"
+        ring = FrameRing(capacity=10, frame_size=4)
+        self.assertEqual(ring.capacity, 8)
+        self.assertEqual(ring.read(4), bytes(4))
+        self.assertEqual(ring.underrun_bytes, 0)
+
+        self.assertEqual(ring.write(b'aaaabbbbcccc'), 8)
+        self.assertEqual(ring.read(4), b'aaaa')
+        # Wraps around
+        self.assertEqual(ring.write(b'dddd'), 4)
+        self.assertEqual(ring.read(12), b'bbbbdddd' + bytes(4))
+        self.assertEqual(ring.underrun_bytes, 4)
+
+        ring.write(b'eeee')
+        ring.clear()
+        self.assertEqual(ring.read(4), bytes(4))
+
+        # In the audio output
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        output = AudioOutput(audio_config, device_index=-1, buffer_size=512,
+                             callback=True)
+        space = output.get_write_available()
+        output.write(b'\x01\x02\x03\x04' * 10)
+        self.assertEqual(output.get_write_available(), space - 10)
+        data, flag = output._callback(None, 20, None, 0)
+        self.assertEqual(data, b'\x01\x02\x03\x04' * 10 + bytes(40))
+        self.assertEqual(flag, output.PA_CONTINUE)
+        self.assertAlmostEqual(output.underruns_ms, 10000 / 44100)
+
+    @unittest.skipIf(silence.numpy is None, "requires NumPy")
+    def test_silence_detector(self):
+        "Test near-silence detection with hysteresis"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        detector = silence.SilenceDetector(audio_config, threshold_db=-70,
+                                           hysteresis_db=6, hold_chunks=2)
+        # Dither of a few LSBs (-80dBFS) and a quiet signal (-67dBFS).
+        dither = b'\x03\x00\xfd\xff' * 100
+        quiet = b'\x0e\x00\xf2\xff' * 100
+
+        self.assertEqual([detector.update(dither) for _ in range(4)],
+                         [False, False, True, True])
+        # Above threshold, but within hysteresis - silence continues
+        self.assertTrue(detector.update(quiet))
+        self.assertFalse(detector.update(b'\x00\x40' * 200))
+        self.assertFalse(detector.update(quiet))
+
+    def test_reordering(self):
+        "Test ordering chunks by sequence numbers"
+        queue = ChunkQueue(reorder_window=3)
+
+        def put(sequences):
+            lost = sum(queue.put_audio((0, sequence), sequence)
+                       for sequence in sequences)
+            played = [item if cmd == queue.CMD_AUDIO else ('lost', item)
+                      for cmd, item in queue.chunk_list]
+            queue.chunk_list.clear()
+            return played, lost
+
+        self.assertEqual(put([65534, 0, 65535, 1]),
+                         ([(0, 65534), (0, 65535), (0, 0), (0, 1)], 0))
+        self.assertEqual(queue.reordered, 1)
+
+        # Duplicates are dropped
+        self.assertEqual(put([1, 2, 2, 0]), ([(0, 2)], 0))
+        self.assertEqual(queue.duplicates, 3)
+
+        # Gap is detected once the window is exceeded
+        self.assertEqual(put([4, 5]), ([], 0))
+        self.assertEqual(put([6]), ([('lost', 1), (0, 4), (0, 5), (0, 6)], 1))
+
+        # Chunk arriving after it was given up is late, not a duplicate
+        self.assertEqual(put([3]), ([], 0))
+        self.assertEqual((queue.late, queue.duplicates, queue.stale_run), (1, 3, 0))
+
+        # Or when the player runs out of chunks
+        put([8])
+        self.assertEqual(queue.flush_pending(), 1)
+        queue.chunk_list.clear()
+
+        # Restarted sender is detected by a run of jumped back sequences
+        self.assertEqual(put([7]), ([], 0))
+        self.assertEqual(queue.late, 2)
+        self.assertEqual(put(range(7)), ([], 0))
+        self.assertEqual(put([0, 1]), ([(0, 0), (0, 1)], 0))
+
+    def test_batched_receive(self):
+        "Test draining a real socket in batches"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        packetizer = Packetizer(None, None, audio_config, header_version=1)
+        audio_config.chunk_size = 400
+        status = packetizer._create_status_packet(10)
+
+        chunk_queue = ChunkQueue()
+        receiver = Receiver(chunk_queue, channel=('127.0.0.1', 0),
+                            sink_latency_ms=0, stats=Stats())
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.setblocking(False)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.1', 0))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            receiver.start_batched(sock, batch=4)
+
+            # More datagrams than fit in a batch: one reordered, one duplicate
+            _, mark = time_machine.get_timemark_ns(time_machine.now_ns(),
+                                                   audio_config.latency_ns)
+            sequences = [0, 1, 3, 2, 4, 5, 5, 6, 7, 8, 9]
+            sender.sendto(status, sock.getsockname())
+            # Short and truncated datagrams are dropped
+            for short in [b'', b'\x00', b'\x40\x00\x00', b'\x00\x01\x00\x00\x00']:
+                sender.sendto(short, sock.getsockname())
+            for sequence in sequences:
+                sender.sendto(b'\x00\x01' + mark + Packetizer.SEQUENCE.pack(sequence) +
+                              bytes([sequence]) * 400, sock.getsockname())
+            select.select([sock], [], [], 1)
+            receiver._drain()
+
+            self.assertTrue(chunk_queue.chunk_available.is_set())
+            cmd, config = chunk_queue.chunk_list.popleft()
+            self.assertEqual(cmd, ChunkQueue.CMD_CFG)
+            self.assertEqual(config, audio_config)
+            # In order and intact - the receive buffers were reused by the
+            # following batches
+            chunks = [item for cmd, item in chunk_queue.chunk_list]
+            self.assertEqual([bytes(chunk) for _, chunk in chunks],
+                             [bytes([sequence]) * 400 for sequence in range(10)])
+            self.assertEqual(len({mark for mark, _ in chunks}), 1)
+            self.assertEqual(chunk_queue.reordered, 1)
+            self.assertEqual(chunk_queue.duplicates, 1)
+            self.assertEqual(receiver.sender_address, sender.getsockname())
+
+            # Socket is drained
+            sender.sendto(status, sock.getsockname())
+            select.select([sock], [], [], 1)
+            receiver._drain()
+            self.assertEqual(receiver.batch_receiver.receive(), [])
+        finally:
+            loop.remove_reader(sock.fileno())
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            loop.close()
+            sock.close()
+            sender.close()
+
+    def test_fec(self):
+        "Test rebuilding a lost datagram from parity"
+        encoder = FecEncoder(group_size=3, header_version=1)
+        decoder = FecDecoder()
+        datagrams = [
+            [b'\x00\x01', b'\x12\x34\xff\xff', b'raw audio'],
+            [b'\x80\x01', b'\x12\x35\x00\x00', b'compressed'],
+            [b'\x00\x01', b'\x12\x36\x00\x01', b'short'],
+        ]
+        parities = [encoder.add(0xffff + i, parts)
+                    for i, parts in enumerate(datagrams)]
+        self.assertEqual(parities[:2], [None, None])
+
+        decoder.store(0xffff, b''.join(datagrams[0]))
+        decoder.store(1, b''.join(datagrams[2]))
+        group_size, rebuilt = decoder.recover(parities[2], header_size=6)
+        self.assertEqual(group_size, 3)
+        self.assertEqual(rebuilt, b''.join(datagrams[1]))
+        self.assertEqual(decoder.recovered, 1)
+
+    def test_fan_out(self):
+        "Test feeding several outputs from a single queue"
+        chunk_queue = ChunkQueue()
+        fan_out = ChunkFanOut(chunk_queue)
+        usb = fan_out.add_output(sink_latency_ms=0)
+        hdmi = fan_out.add_output(sink_latency_ms=120)
+
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        chunk_queue.chunk_list.append((chunk_queue.CMD_CFG, audio_config))
+        chunk_queue.put_audio((1.0, b'a'), sequence=1)
+        chunk_queue.put_audio((1.2, b'c'), sequence=3)
+        fan_out.distribute()
+        self.assertFalse(chunk_queue.chunk_list)
+
+        for output, sink_latency_s in [(usb, 0), (hdmi, 0.12)]:
+            self.assertTrue(output.chunk_available.is_set())
+            cmd, config = output.chunk_list.popleft()
+            self.assertEqual(cmd, ChunkQueue.CMD_CFG)
+            self.assertEqual(config.sink_latency_s, sink_latency_s)
+            self.assertEqual(output.chunk_list.popleft(),
+                             (ChunkQueue.CMD_AUDIO, (1.0, b'a')))
+        self.assertEqual(audio_config.sink_latency_ms, 0)
+
+        # Idle output releases the chunk held for reordering for both
+        self.assertEqual(usb.flush_pending(), 1)
+        for output in [usb, hdmi]:
+            self.assertEqual(list(output.chunk_list),
+                             [(ChunkQueue.CMD_DROPS, 1),
+                              (ChunkQueue.CMD_AUDIO, (1.2, b'c'))])
+            output.chunk_list.clear()
+
+        # Recovery of one output doesn't affect the other
+        hdmi.do_recovery()
+        self.assertEqual(chunk_queue.ignore_audio_packets, 0)
+        chunk_queue.put_audio((1.3, b'd'), sequence=4)
+        fan_out.distribute()
+        self.assertEqual(len(usb.chunk_list), 1)
+        self.assertEqual(len(hdmi.chunk_list), 0)
+
+    def test_channel_map(self):
+        "Test splitting chunks into channel groups"
+        self.assertEqual(channel_map.parse_channel_map('2,3=224.0.0.58:45300', 6),
+                         ((2, 3), ('224.0.0.58', 45300)))
+        for wrong in ['2,3', '6=224.0.0.58:45300', '1,1=224.0.0.58:45300',
+                      'a=224.0.0.58:45300', '1=224.0.0.58']:
+            with self.assertRaises(ValueError):
+                channel_map.parse_channel_map(wrong, 6)
+
+        groups = channel_map.create_groups([
+            ((0, 1), ('224.0.0.58', 1)),
+            ((5,), ('224.0.0.59', 1)),
+            ((0, 1), ('10.0.0.2', 1)),
+        ])
+        self.assertEqual([group.channels for group in groups], [(0, 1), (5,)])
+        self.assertEqual(len(groups[0].destinations), 2)
+
+        for sample in (16, 24):
+            config = AudioConfig(48000, sample, 6, latency_ms=1000,
+                                 sink_latency_ms=0)
+            size = sample // 8
+            # Each sample holds its frame and channel number
+            chunk = b''.join(bytes([frame, channel]) + bytes(size - 2)
+                             for frame in range(100) for channel in range(6))
+            group = channel_map.ChannelGroup((4, 1), [])
+            group.configure(config)
+            part = group.split(memoryview(chunk))
+            self.assertEqual(group.audio_config.channels, 2)
+            self.assertEqual(group.audio_config.chunk_size, 100 * 2 * size)
+            self.assertEqual(bytes(part[:2 * size]),
+                             b'\x00\x04' + bytes(size - 2) + b'\x00\x01' + bytes(size - 2))
+            self.assertEqual(bytes(part[-size:]), b'\x63\x01' + bytes(size - 2))
+
+        # Largest group's datagram fits the payload
+        config = AudioConfig(48000, 16, 6, latency_ms=1000, sink_latency_ms=0)
+        payload = channel_map.reader_payload_size(1472, 6, config, groups,
+                                                  full_stream=False)
+        self.assertEqual((payload - 6) // 12 * 4, 1464)
+
+        # Groups are sent with their own status packets
+        config.chunk_size = 1200
+        packetizer = Packetizer(None, None, config, fec=4, groups=groups)
+        for group in groups:
+            group.sender = Mock()
+            group.sender.send = Mock(return_value=[])
+        sent, failures = packetizer._send_groups(bytes(1200), b'\x12\x34\x00\x01', 1)
+        self.assertEqual(failures, [])
+        self.assertEqual(sent, 2 * (6 + 400) + (6 + 200))
+        datagram = groups[1].sender.send.call_args[0][0]
+        self.assertEqual(len(datagram[2]), 200)
+        status = packetizer._create_status_packet(124, groups[1].audio_config)
+        rate, sample, channels, chunk_size = Packetizer.STATUS.unpack_from(status, 2)[2:6]
+        self.assertEqual((rate, sample, channels, chunk_size), (48000, 16, 1, 200))
+
+    @unittest.skipIf(codec.pcm.numpy is None, "requires NumPy")
+    def test_rice_codec(self):
+        "Test lossless audio codec"
+        np = codec.pcm.numpy
+        rnd = np.random.default_rng(1)
+        for sample, channels in [(16, 2), (24, 6)]:
+            audio_config = AudioConfig(rate=48000, sample=sample,
+                                       channels=channels,
+                                       latency_ms=1000, sink_latency_ms=0)
+            audio_config.chunk_size = 1464
+            frames = audio_config.chunk_size // audio_config.frame_size
+            top = 2 ** (sample - 1)
+
+            # Smooth signal with some noise, channel with extremes and silence
+            ramp = np.linspace(0, 20, frames)
+            samples = (0.5 * top * np.sin(ramp[:, None] + np.arange(channels)) +
+                       rnd.normal(0, 30, (frames, channels))).astype(np.int32)
+            samples[::2, 1] = top - 1
+            samples[1::2, 1] = -top
+            samples[:, -1] = 0
+            chunk = codec.pcm.from_array(samples, sample)
+
+            rice = codec.RiceCodec(audio_config)
+            encoded = rice.encode(chunk)
+            self.assertLess(len(encoded), len(chunk))
+            self.assertEqual(codec.decoders()[rice.FLAG].decode(encoded), chunk)
+
+            with self.assertRaises(codec.CodecError):
+                rice.decode(encoded[:len(encoded) // 2])
+
+    def test_adaptive_compression(self):
+        "Test selecting compression level"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        ladder = AdaptiveCompression.zlib_ladder(audio_config, max_level=6)
+        adaptive = AdaptiveCompression(audio_config, ladder, budget=0.2)
+        fast = audio_config.chunk_time * 0.01
+        slow = audio_config.chunk_time * 0.5
+
+        def run(took, ratio, windows=1):
+            for _ in range(windows * adaptive.WINDOW):
+                if adaptive.select() is not None:
+                    adaptive.record(took, 1000, int(1000 * ratio))
+            return adaptive.name
+
+        # Compressible and cheap: go up while it helps
+        self.assertEqual(run(fast, 0.5), 'zlib-3')
+        self.assertEqual(run(fast, 0.4), 'zlib-6')
+        self.assertEqual(run(fast, 0.4), 'zlib-3')
+        self.assertEqual(run(fast, 0.4), 'zlib-3')
+
+        # Over the budget
+        self.assertEqual(run(slow, 0.4), 'zlib-1')
+
+        # Incompressible: chunks are skipped, then compression is turned off
+        skipped = adaptive.skipped
+        self.assertEqual(run(fast, 1.0, 2), 'off')
+        self.assertGreater(adaptive.skipped - skipped, adaptive.WINDOW)
+
+        # And probed again later
+        self.assertEqual(run(fast, 0.5, adaptive.PROBE_WINDOWS), 'zlib-1')
+
+        # Long runs of misses don't grow the backoff state
+        adaptive = AdaptiveCompression(audio_config, ladder, budget=0.2)
+        for _ in range(10000):
+            adaptive.record(fast, 1000, 1000)
+        self.assertLessEqual(adaptive._misses, adaptive.MAX_SKIP.bit_length() + 2)
+        self.assertEqual(adaptive._skip, adaptive.MAX_SKIP)
+
+    def test_encode_pool(self):
+        "Test encoding in worker processes"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        chunks = [bytes([i]) * 1000 + bytes(range(i, i + 200)) * 2
+                  for i in range(40)]
+        source = iter(enumerate(chunks))
+
+        async def get_next_chunk():
+            for item in source:
+                return item
+            await asyncio.sleep(3600)
+
+        reader = Mock()
+        reader.get_next_chunk = get_next_chunk
+
+        zlib_codec = codec.ZlibCodec(audio_config)
+        pool = EncodePool(reader, zlib_codec, workers=2, slots=8)
+
+        async def encode():
+            pool.start(audio_config.chunk_size)
+            results = []
+            try:
+                for _ in chunks:
+                    stream_time, chunk, encoded = await pool.get_next_chunk()
+                    results.append((stream_time, bytes(chunk),
+                                    zlib_codec.decode(encoded)))
+            finally:
+                pool.stop()
+            await asyncio.sleep(0)
+            return results
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(encode())
+        finally:
+            loop.close()
+        self.assertEqual(results, [(i, chunk, chunk) for i, chunk in enumerate(chunks)])
+
+    def test_sync_correction(self):
+        "Test adding/removing frames driven by the PI controller"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        frames = audio_config.chunk_size // audio_config.frame_size
+        chunk = bytes(range(256)) * 5 + bytes(range(188))
+
+        corrector = FrameCorrector(audio_config)
+        for correction in [2, -2, 0]:
+            corrected = corrector.apply(chunk, correction)
+            self.assertEqual(len(corrected), len(chunk) + 4 * correction)
+            # Beginning and the end of the chunk are untouched
+            self.assertEqual(corrected[:400], chunk[:400])
+            self.assertEqual(corrected[-400:], chunk[-400:])
+
+        # Closed loop: output clock faster by 100ppm, initial error 0.8ms
+        controller = SyncController(audio_config, corrector.max_frames)
+        output_rate = 44100 * (1 + 100e-6)
+        error = 0.0008
+        errors = []
+        for _ in range(3000):
+            correction = controller.update(error)
+            self.assertLessEqual(abs(correction), corrector.max_frames)
+            error -= (frames + correction) / output_rate - frames / 44100
+            errors.append(abs(error))
+        self.assertLess(max(errors[1000:]), 0.0005)
+
+    def test_late_chunk(self):
+        "Test lateness of the chunks is recorded apart from the delay"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        chunk_queue, player = mock_chunk_player()
+        player._handle_cmd_cfg(audio_config)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            late = (time_machine.now_ns() - 50000000, bytes(1468))
+            loop.run_until_complete(player._handle_cmd_audio(late))
+        finally:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            loop.close()
+        self.assertEqual(player.stats.time_drops, 1)
+        self.assertEqual(player.stats.delay_us.count, 0)
+        self.assertEqual(player.stats.late_us.count, 1)
+        self.assertGreaterEqual(player.stats.late_us.max, 50000)
+
+    def test_lost_chunk_slot(self):
+        "Test the slot of a chunk lost while the output was full is kept silent"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        chunk_time_ns = 367 * 1000000000 // 44100
+        player = ChunkPlayer(ChunkQueue(), stats=Stats(), tolerance_ms=30,
+                             buffer_size=256, device_index=-1,
+                             callback=True, resample=False)
+        player._handle_cmd_cfg(audio_config)
+        output = player.audio_output
+
+        # The output still plays three chunks while the next one was lost
+        end = time_machine.now_ns() + 3 * chunk_time_ns
+        output.buffered_ns = lambda: max(0, end - time_machine.now_ns())
+        chunk = b'\x01' * 1468
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(
+                player._handle_cmd_audio((end + chunk_time_ns, chunk)))
+        finally:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            loop.close()
+        self.assertEqual(player.stats.gap_chunks, 1)
+        written = output.ring.read(output.ring.available())
+        self.assertEqual(written[:1468], bytes(1468))
+        self.assertEqual(written[1468:1500], chunk[:32])
+
+    @unittest.skipIf(codec.pcm.numpy is None, "requires NumPy")
+    def test_resampler(self):
+        "Test drift estimation and the resampler"
+        np = codec.pcm.numpy
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 1468
+        frames = np.arange(367 * 100)
+        sine = np.sin(2 * np.pi * 440 * frames / 44100) * 10000
+        data = codec.pcm.from_array(
+            np.stack([sine, -sine], axis=1).astype(np.int32), 16)
+        chunks = [data[i:i + 1468] for i in range(0, len(data), 1468)]
+
+        # Identity, delayed by 2 frames
+        resampler = Resampler(audio_config)
+        out = b''.join(resampler.process(chunk) for chunk in chunks)
+        self.assertEqual(out, data[:len(out)])
+        self.assertEqual(len(out), len(data) - 2 * 4)
+
+        # 500ppm faster output gets more frames of the same sine
+        resampler = Resampler(audio_config)
+        resampler.ratio = 1 + 500e-6
+        out = b''.join(resampler.process(chunk) for chunk in chunks)
+        out = codec.pcm.to_array(out, 16, 2)
+        self.assertAlmostEqual(len(out), len(frames) * resampler.ratio, delta=3)
+        expected = np.sin(2 * np.pi * 440 * np.arange(len(out)) /
+                          resampler.ratio / 44100) * 10000
+        self.assertLess(np.abs(out[:, 0] - expected).max(), 5)
+        self.assertLess(np.abs(out[:, 1] + expected).max(), 5)
+
+        # Error growing by 50us/s with 0.2ms jitter
+        estimator = DriftEstimator()
+        rnd = np.random.default_rng(1)
+        for step in range(30 * 100):
+            now = 1000 + step / 100
+            estimator.update(now, 50e-6 * now + rnd.normal(0, 0.0002))
+        self.assertAlmostEqual(estimator.drift, 50e-6, delta=5e-6)
+        estimator.reset()
+        self.assertEqual(len(estimator.points), 0)
+        self.assertAlmostEqual(estimator.ratio, 1 + 50e-6, delta=5e-6)
+
+    def test_monotonic_time(self):
+        "Test following wall clock changes gradually"
+        saved = time_machine._local_ns, time_machine._updated_ns
+        monotonic = [time_machine._updated_ns]
+        wall = [1549305460 * 10**9]
+        def advance(seconds):
+            "Both clocks tick"
+            monotonic[0] += int(seconds * 10**9)
+            wall[0] += int(seconds * 10**9)
+
+        try:
+            with unittest.mock.patch.object(time_machine.time, 'monotonic_ns',
+                                            lambda: monotonic[0]), \
+                 unittest.mock.patch.object(time_machine.time, 'time_ns',
+                                            lambda: wall[0]):
+                # Large change (clock set) is applied at once
+                advance(1)
+                time_machine.local_now_ns()
+                self.assertEqual(time_machine.local_now_ns(), wall[0])
+
+                # NTP steps the clock back by 100ms - the time keeps going forward
+                wall[0] -= 100 * 10**6
+                previous = time_machine.local_now_ns()
+                for _ in range(10):
+                    advance(1)
+                    current = time_machine.local_now_ns()
+                    # 500ppm slower
+                    self.assertEqual(current - previous, 10**9 - 500000)
+                    previous = current
+                self.assertEqual(current - wall[0], 95 * 10**6)
+
+                # Until the mapping catches up
+                for _ in range(200):
+                    advance(1)
+                    time_machine.local_now_ns()
+                self.assertEqual(time_machine.local_now_ns(), wall[0])
+                self.assertEqual(time_machine.now_ns(), wall[0])
+        finally:
+            time_machine._local_ns, time_machine._updated_ns = saved
+
+    def test_clock_sync(self):
+        "Test the time request exchange and the offset estimation"
+        sync = exchange = clock_sync.ClockSync(Stats())
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.1', 0))
+        # Receiver's audio socket bound to the multicast group
+        rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rx_sock.bind(('224.0.0.57', 0))
+        rx_sock.settimeout(0.1)
+        packetizer = Packetizer(None, None, None)
+        packetizer.sock = sender
+        loop = asyncio.new_event_loop()
+        try:
+            # Unicast response never reaches the group-bound socket
+            rx_sock.sendto(sync.create_request(), sender.getsockname())
+            packetizer._handle_requests()
+            with self.assertRaises(socket.timeout):
+                rx_sock.recv(100)
+
+            # Real exchange over loopback on the ClockSync socket - clocks
+            # are the same
+            sync.open(loop)
+            sync.send_request(sender.getsockname())
+            packetizer._handle_requests()
+            select.select([sync.sock], [], [], 1)
+            sync._receive()
+            self.assertEqual(sync.responses, 1)
+            self.assertLess(abs(sync.offset), 0.001)
+            self.assertLess(sync.error, 0.001)
+            self.assertFalse(sync.handle_response(b'\x10\x00' + bytes(8)))
+
+            # Sender 2.5s ahead, asymmetric delays; the fastest exchange wins.
+            sync = clock_sync.ClockSync(Stats())
+            local = 1000.0
+            for up, down in [(0.0003, 0.0003), (0.004, 0.001), (0.002, 0.0001)]:
+                t2 = local + up + 2.5
+                data = clock_sync.RESPONSE.pack(clock_sync.FLAG_TIMESYNC,
+                                                clock_sync.KIND_RESPONSE,
+                                                local, t2, t2 + 0.0001)
+                local += up + 0.0001 + down
+                with unittest.mock.patch.object(time_machine, 'local_now',
+                                                return_value=local):
+                    self.assertTrue(sync.handle_response(data))
+                local += 0.5
+            self.assertAlmostEqual(sync.offset, 2.5, delta=0.00001)
+            self.assertAlmostEqual(sync.error, 0.0003, delta=0.00001)
+            self.assertAlmostEqual(time_machine.now() - time_machine.local_now(),
+                                   2.5, delta=0.01)
+        finally:
+            time_machine.set_offset(0.0)
+            if exchange.sock is not None:
+                exchange.close(loop)
+            loop.close()
+            sender.close()
+            rx_sock.close()
+
+    def test_time_request_sources(self):
+        "Test time requests are answered only to receivers, within a limit"
+        sync = clock_sync.ClockSync(Stats())
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.1', 0))
+        sender.setblocking(False)
+        packetizer = Packetizer(None, None, None)
+        packetizer.sock = sender
+        loop = asyncio.new_event_loop()
+
+        def exchange(requests):
+            for _ in range(requests):
+                sync.send_request(sender.getsockname())
+            select.select([sender], [], [], 1)
+            packetizer._handle_requests()
+            responses = sync.responses
+            while select.select([sync.sock], [], [], 0.1)[0]:
+                sync._receive()
+            return sync.responses - responses
+
+        try:
+            sync.open(loop)
+            # Unicast destinations - other hosts are ignored
+            packetizer.receiver_hosts = {'192.0.2.1'}
+            self.assertEqual(exchange(1), 0)
+            packetizer.receiver_hosts = {'127.0.0.1'}
+            self.assertEqual(exchange(1), 1)
+            self.assertEqual(packetizer.rejected_requests, 1)
+
+            # Multicast - any host, limited rate
+            packetizer.receiver_hosts = None
+            self.assertEqual(exchange(packetizer.MAX_REQUESTS + 5),
+                             packetizer.MAX_REQUESTS)
+            self.assertEqual(packetizer.rejected_requests, 6)
+        finally:
+            sync.close(loop)
+            loop.close()
+            sender.close()
+
+    def test_feedback(self):
+        "Test receiver reports collected by the sender"
+        stats = Stats()
+        stats.total_chunks = 1000
+        stats.total_delay_ns = 500 * 10**9
+        stats.network_drops = 3
+        stats.drift_ppm = 12.5
+        queue = ChunkQueue()
+        reporter = Reporter(stats, queue, name='living-room')
+
+        fleet = FleetTable()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.1', 0))
+        rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packetizer = Packetizer(None, None, None, fleet=fleet)
+        packetizer.sock = sender
+        try:
+            rx_sock.sendto(reporter.create_report(), sender.getsockname())
+            rx_sock.sendto(b'\x08garbage', sender.getsockname())
+            packetizer._handle_requests()
+        finally:
+            sender.close()
+            rx_sock.close()
+
+        self.assertEqual(fleet.invalid, 1)
+        now = time_machine.now()
+        snapshot = json.loads(json.dumps(fleet.snapshot(now)))
+        receiver, = snapshot['receivers']
+        self.assertEqual(receiver['name'], 'living-room')
+        self.assertEqual(receiver['chunks'], 1000)
+        self.assertEqual(receiver['network_drops'], 3)
+        self.assertEqual(receiver['avg_delay_ms'], 500.0)
+        self.assertEqual(receiver['drift_ppm'], 12.5)
+        self.assertIsNone(receiver['clock_error_ms'])
+        self.assertFalse(receiver['stale'])
+        self.assertIn('living-room', fleet.format(now)[2])
+
+        fleet.prune(now + FleetTable.FORGET_S + 1)
+        self.assertEqual(fleet.receivers, {})
+
+    @unittest.skipIf(batch_socket._sendmmsg is None, "requires sendmmsg")
+    def test_batch_sender(self):
+        "Test sendmmsg batches to real sockets"
+        sinks = []
+        for _ in range(10):
+            sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sink.bind(('127.0.0.1', 0))
+            sink.settimeout(1)
+            sinks.append(sink)
+        destinations = [sink.getsockname() for sink in sinks]
+        # Host names are resolved
+        destinations[3] = ('localhost', destinations[3][1])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sender = batch_socket.BatchSender(sock, destinations)
+            self.assertTrue(sender.batched)
+
+            ring = bytearray(b'.' * 100 + bytes(range(256)) * 4)
+            datagrams = [
+                ([b'\x00\x02', b'\x00\x01\x02\x03', b'\x00\x05', b'payload'],
+                 b'\x00\x02\x00\x01\x02\x03\x00\x05payload'),
+                # Writable view of a ring - sent without a copy
+                ([b'\x01\x01', b'\x12\x34', memoryview(ring)[100:]],
+                 b'\x01\x01\x12\x34' + bytes(range(256)) * 4),
+                ([b'\x08', b''], b'\x08'),
+            ]
+            for parts, expected in datagrams:
+                self.assertEqual(sender.send(parts), [])
+                for sink in sinks:
+                    self.assertEqual(sink.recv(2048), expected)
+        finally:
+            sock.close()
+            for sink in sinks:
+                sink.close()
+
+    def test_send_scheduler(self):
+        "Test one bad destination doesn't hold the others"
+        good = [('10.0.0.%d' % i, 45300) for i in range(1, 60)]
+        full = ('10.0.0.100', 45300)
+        down = ('10.0.0.101', 45300)
+        received = []
+        buffer_full = [True]
+
+        def sendmsg(parts, ancdata, flags, address):
+            if address == full and buffer_full[0]:
+                raise BlockingIOError(errno.EAGAIN, 'Resource temporarily unavailable')
+            if address == down:
+                raise OSError(errno.EHOSTUNREACH, 'No route to host')
+            received.append((address, b''.join(parts)))
+
+        sock = Mock()
+        sock.sendmsg = sendmsg
+        sock.sendto = lambda data, address: sendmsg([data], [], 0, address)
+        scheduler = SendScheduler(sock, good + [full, down], queue_size=3)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.add_writer = Mock()
+        loop.remove_writer = Mock()
+        try:
+            failures = scheduler.send([b'\x00\x01', b'chunk0'])
+            self.assertEqual([address for address, _ in failures], [down])
+            loop.add_writer.assert_called_once()
+
+            # Down destination is not tried during the backoff, the queue of
+            # the full one keeps the newest datagrams
+            received.clear()
+            for number in range(1, 5):
+                failures = scheduler.send([b'\x00\x01', b'chunk%d' % number])
+                self.assertEqual([address for address, _ in failures], [down])
+            self.assertEqual(len(received), 4 * len(good))
+            self.assertNotIn(down, [address for address, _ in received])
+            self.assertEqual(scheduler.queued(), 3)
+            self.assertEqual(scheduler.dropped(), 2)
+            self.assertEqual(scheduler.backing_off(), 1)
+
+            # Socket writable again - queued datagrams are sent in order
+            received.clear()
+            buffer_full[0] = False
+            scheduler.flush()
+            self.assertEqual(received, [(full, b'\x00\x01chunk%d' % number)
+                                        for number in range(2, 5)])
+            loop.remove_writer.assert_called_once()
+            self.assertEqual(scheduler.queued(), 0)
+            self.assertEqual(len(scheduler.problems()), 2)
+        finally:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            loop.close()
+
+    def test_packetizer_all_failing(self):
+        "Test the status line survives every destination failing"
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        audio_config.chunk_size = 400
+        packetizer = Packetizer(None, None, audio_config, compress=6, fec=4)
+
+        class Source:
+            position = 0
+            async def get_next_chunk(self):
+                self.position += 1
+                if self.position >= 250:
+                    packetizer.stop = True
+                return time_machine.now_ns(), bytes(400)
+        packetizer.reader = Source()
+
+        def sendmsg(parts, ancdata, flags, address):
+            raise OSError(errno.EHOSTUNREACH, 'No route to host')
+        packetizer.sock = Mock()
+        packetizer.sock.sendmsg = sendmsg
+        packetizer.destinations = [('10.0.0.1', 45300)]
+        packetizer.sender = SendScheduler(packetizer.sock, packetizer.destinations)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(packetizer.packetize())
+        finally:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            loop.close()
+        self.assertEqual(packetizer.chunks_sent, 250)
+        self.assertEqual(packetizer.bytes_sent, 0)
+        self.assertEqual(packetizer.bytes_raw, 0)
+
+    def test_relay(self):
+        "Test forwarding the stream and the replies through a relay"
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.1', 0))
+        sender.settimeout(1)
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sink.settimeout(1)
+        relays = [relay_module.Relay(('127.0.0.1', 0), [sink.getsockname()],
+                                     batch=4),
+                  relay_module.Relay(('224.0.0.57', 0), [sink.getsockname()])]
+        loop = asyncio.new_event_loop()
+        try:
+            relay = relays[0]
+            relay.create_sockets(ttl=1, multicast_loop=False)
+            status = bytes([Packetizer.FLAG_STATUS, 1]) + bytes(Packetizer.STATUS.size)
+            audio = b'\x00\x01\x12\x34\x00\x07' + bytes(range(200))
+            sender.sendto(status, relay.sock.getsockname())
+            sender.sendto(audio, relay.sock.getsockname())
+            relay._drain()
+            self.assertEqual(sink.recv(2048), status)
+            self.assertEqual(sink.recv(2048), audio)
+            self.assertEqual(relay.sender_address, sender.getsockname())
+            self.assertEqual(relay.forwarded, 2)
+
+            try:
+                relays[1].create_sockets(ttl=1, multicast_loop=False)
+            except OSError as ex:
+                print("Multicast unavailable, skipping its relay:", ex)
+                del relays[1]
+            else:
+                # Listening socket bound to the group, the stream would come
+                # from the sender
+                relays[1].sender_address = sender.getsockname()
+
+            for relay in relays:
+                # Receiver behind the relay asks for the time
+                sync = clock_sync.ClockSync(Stats())
+                request = sync.create_request()
+                relay_address = ('127.0.0.1', relay.out_sock.getsockname()[1])
+                sink.sendto(request, relay_address)
+                sink.sendto(b'\x08report', relay_address)
+                relay._handle_replies()
+                data, address = sender.recvfrom(256)
+                self.assertEqual(data, request)
+                self.assertEqual(sender.recv(256), b'\x08report')
+
+                # Response comes back to the relay's unicast socket and goes
+                # only to the requester
+                response = clock_sync.create_response(request, time_machine.now())
+                sender.sendto(response, address)
+                select.select([relay.up_sock], [], [], 1)
+                relay._handle_responses()
+                self.assertEqual(sink.recv(256), response)
+                self.assertEqual(relay.requests, {})
+            self.assertEqual(relays[0].forwarded, 2)
+        finally:
+            for relay in relays:
+                if relay.sock is not None:
+                    relay.close(loop)
+            loop.close()
+            sender.close()
+            sink.close()
+
+    def test_metrics(self):
+        "Test histograms and their export"
+        histogram = Histogram(highest=1000000, scale=1e-6)
+        for value in range(1, 10001):
+            histogram.record(value)
+        histogram.record(-5)
+        histogram.record(5000000)
+        self.assertEqual(histogram.count, 10002)
+        self.assertEqual(histogram.max, 1000000)
+        for percent, exact in [(50, 5000), (90, 9000), (99, 9900)]:
+            value = histogram.percentile(percent)
+            self.assertGreaterEqual(value, exact)
+            self.assertLess(value, exact * (1 + 1 / Histogram.SUB_BUCKETS))
+        # Small values are exact, negative ones counted as zero
+        self.assertEqual(histogram.buckets()[:3], [(1, 1), (2, 2), (3, 3)])
+
+        metrics = Metrics()
+        empty = Histogram(highest=1000000, scale=1e-6)
+        metrics.add_histogram('delay_seconds', 'Delay', empty)
+        layout = [line.split()[0] for line in metrics.prometheus().splitlines()
+                  if '_bucket' in line]
+        metrics.add_histogram('delay_seconds', 'Delay', histogram)
+        metrics.add_counter('chunks_total', 'Chunks', lambda: 42)
+        text = metrics.prometheus()
+        # Same bucket series whatever was recorded
+        self.assertEqual([line.split()[0] for line in text.splitlines()
+                          if '_bucket' in line], layout)
+        self.assertIn('wavesync_delay_seconds_bucket{le="0.008192"} 8192', text)
+        self.assertIn('# TYPE wavesync_delay_seconds histogram', text)
+        self.assertIn('wavesync_delay_seconds_bucket{le="+Inf"} 10002', text)
+        self.assertIn('wavesync_chunks_total 42.0', text)
+        self.assertEqual(metrics.snapshot()['delay_seconds']['p50'],
+                         histogram.percentile(50) * 1e-6)
+
+        async def scrape():
+            server = await metrics.serve(0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics.json HTTP/1.0\r\nHost: x\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(scrape())
+        finally:
+            loop.close()
+        header, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(header.startswith(b'HTTP/1.0 200'))
+        self.assertEqual(json.loads(body)['chunks_total'], 42)
+
+    def test_trace(self):
+        "Test the trace buffer, its dump and analysis"
+        self.assertIsNone(trace.tracer)
+        with tempfile.TemporaryDirectory() as tmp:
+            tracer = trace.Tracer(os.path.join(tmp, 'trace'), capacity=6)
+            ns = [1000 * 10**9]
+            def record(event, key, after_us):
+                ns[0] += after_us * 1000
+                tracer.record(event, key)
+
+            with unittest.mock.patch.object(time_machine, 'now_ns',
+                                            lambda: ns[0]):
+                for chunk in range(3):
+                    record(trace.RECEIVED, (1001 + chunk) * 10**9, 100)
+                    record(trace.DEQUEUED, (1001 + chunk) * 10**9, 200 * (chunk + 1))
+                # Buffer was full - dumped and cleared
+                self.assertEqual(tracer.count, 0)
+                record(trace.WRITTEN, 1001 * 10**9, 50)
+                second = tracer.dump()
+
+            records = trace.load(os.path.join(tmp, 'trace.0'))
+            records += trace.load(second)
+        self.assertEqual(len(records), 7)
+        self.assertEqual(records[0], (trace.RECEIVED, 1001000000, 1000000100000))
+
+        results = dict(trace.analyse(records))
+        dequeue = results['received -> dequeued']
+        self.assertEqual(dequeue.count, 3)
+        self.assertEqual(dequeue.max, 600)
+        self.assertEqual(results['dequeued -> written'].count, 1)
+        # First chunk received 1s - 100us before its play time
+        first = results['received -> play time'].percentile(0)
+        self.assertTrue(999900 <= first < 999900 * 1.125)
+
+        # Within the event loop a full buffer is written by a thread while
+        # recording continues in the spare one. Write errors are reported.
+        async def fill(tracer, times):
+            for _ in range(times):
+                for key in range(tracer.capacity):
+                    tracer.record(trace.RECEIVED, key * 1000)
+                if tracer.writing is not None:
+                    await tracer.writing
+
+        with tempfile.TemporaryDirectory() as tmp:
+            loop = asyncio.new_event_loop()
+            try:
+                tracer = trace.Tracer(os.path.join(tmp, 'trace'), capacity=4)
+                loop.run_until_complete(fill(tracer, 2))
+                self.assertEqual([len(trace.load(os.path.join(tmp, 'trace.%d' % i)))
+                                  for i in range(2)], [4, 4])
+
+                tracer = trace.Tracer(os.path.join(tmp, 'missing', 'trace'),
+                                      capacity=4)
+                loop.run_until_complete(fill(tracer, 2))
+                self.assertEqual(tracer.count, 0)
+                self.assertIsNone(tracer.dump())
+            finally:
+                loop.close()
+
+    def test_impairment(self):
+        "Test the impairment model, the proxy and a short scenario"
+        link = impair.Impairment(loss=0.1, burst=4, duplicate=0.1, seed=1)
+        schedules = [link.schedule() for _ in range(20000)]
+        lost = sum(1 for delays in schedules if not delays)
+        self.assertAlmostEqual(lost / len(schedules), 0.1, delta=0.02)
+        # Losses come in bursts
+        runs = sum(1 for previous, delays in zip(schedules, schedules[1:])
+                   if previous and not delays)
+        self.assertAlmostEqual(lost / runs, 4, delta=0.6)
+        copies = sum(len(delays) for delays in schedules)
+        self.assertAlmostEqual(copies / (len(schedules) - lost), 1.1, delta=0.02)
+
+        jitter = impair.Impairment(delay_ms=2, jitter_ms=3, jitter='pareto', seed=1)
+        delays = [jitter.schedule()[0] for _ in range(20000)]
+        self.assertTrue(min(delays) >= 0.002)
+        self.assertAlmostEqual(sum(delays) / len(delays), 0.005, delta=0.0005)
+
+        # Datagrams reach all receivers, replies the sender
+        async def forward():
+            loop = asyncio.get_event_loop()
+            sinks = []
+            for _ in range(2):
+                sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sink.bind(('127.0.0.1', 0))
+                sink.settimeout(1)
+                sinks.append(sink)
+            proxy = impair.ImpairmentProxy([sink.getsockname() for sink in sinks],
+                                           [impair.Impairment(), impair.Impairment()])
+            address = await proxy.start()
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.settimeout(1)
+            sender.sendto(b'chunk', address)
+            await asyncio.sleep(0.05)
+            received = [sink.recvfrom(100) for sink in sinks]
+            sinks[1].sendto(b'report', received[1][1])
+            await asyncio.sleep(0.05)
+            reply = sender.recv(100)
+            proxy.close()
+            for sock in sinks + [sender]:
+                sock.close()
+            return [data for data, _ in received], reply
+
+        loop = asyncio.new_event_loop()
+        try:
+            received, reply = loop.run_until_complete(forward())
+        finally:
+            loop.close()
+        self.assertEqual(received, [b'chunk', b'chunk'])
+        self.assertEqual(reply, b'report')
+
+        result = impair.run_scenario('clean', {}, receivers=2, duration=3,
+                                     warmup=2)
+        # Scenario closes its loop - leave a usable one to other tests
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.assertTrue(result['skew_us']['count'] > 0)
+        self.assertTrue(result['skew_us']['max'] < 10000)
+        for receiver in result['receivers']:
+            self.assertEqual(receiver['time_drops'], 0)
+            self.assertEqual(receiver['link']['lost'], 0)
+
     def test_pipelines(self):
         "Test TX-RX pipeline"
         mock_txrx()
+        mock_txrx(header_version=2)
+
+    def test_zones(self):
+        "Test zone specification and per-zone metrics"
+        zone = cli_args.parse_zone('input=/tmp/kitchen,channel=224.0.0.58:45300,'
+                                   'channel=10.0.0.2:45301,name=kitchen,'
+                                   'rate=48000,24bits', 1)
+        self.assertEqual(zone['name'], 'kitchen')
+        self.assertEqual(zone['tx'], '/tmp/kitchen')
+        self.assertEqual(zone['ip_list'], [('224.0.0.58', 45300),
+                                           ('10.0.0.2', 45301)])
+        self.assertEqual(zone['audio_rate'], 48000)
+        self.assertTrue(zone['audio_sample'])
+        self.assertNotIn('audio_channels', zone)
+        self.assertEqual(cli_args.parse_zone('input=/tmp/a,channel=h:1', 3)['name'],
+                         'zone3')
+        for spec in ['input=/tmp/a', 'channel=h:1', 'input=/tmp/a,channel=h',
+                     'input=/tmp/a,channel=h:1,name=a-b',
+                     'input=/tmp/a,channel=h:1,volume=3']:
+            with self.assertRaises(ValueError):
+                cli_args.parse_zone(spec, 1)
+
+        audio_config = AudioConfig(rate=44100, sample=16, channels=2,
+                                   latency_ms=1000, sink_latency_ms=0)
+        metrics = Metrics()
+        packetizer = Packetizer(None, None, audio_config, name='kitchen')
+        packetizer.register_metrics(metrics, prefix='zone_kitchen_')
+        self.assertIn('zone_kitchen_chunks_sent_total', metrics.prometheus())
 
     def test_arguments(self):
         "Test program argument parsing"
         with unittest.mock.patch.object(sys, 'argv', ['prog', '--rx']):
-            cli_args.parse()
+            args = cli_args.parse()
+        # Speedup of the encode pool wasn't measured yet - off unless asked
+        self.assertEqual(args.encode_workers, 0)
@@ -3,6 +3,13 @@ Handle small, millisecond precision, timestamps.
 
 `timemark' marks a time in future - certain number of milliseconds ahead of
 the current time.
+
+Header version 2 uses 32-bit microsecond marks with a wider range instead.
+
+Current time (`now()`) is derived from the monotonic clock, see below.
+
+Per-chunk paths use the `_ns` variants: times are integer nanoseconds and
+the marks are created and resolved without floating point math.
 """
 import time
 import struct
@@ -10,6 +17,13 @@ import struct
 # Max latency which can be recorded. Can be limited by cli.
 RANGE = 60
 
+MARK = struct.Struct('>H')
+
+# Microsecond marks (header version 2) - range fits in 32 bits
+RANGE_US = 3600
+
+MARK_US = struct.Struct('>I')
+
 
 def get_timemark(relative_ts, latency_s):
     """
@@ -25,7 +39,7 @@ def get_timemark(relative_ts, latency_s):
     #mark = int((relative - (relative  // RANGE) * RANGE ) * 1000)
     future_ts = relative_ts + latency_s
     stamp = int((future_ts % RANGE * 1000))
-    mark = struct.pack('>H', stamp)
+    mark = MARK.pack(stamp)
     return future_ts, mark
 
 
@@ -42,7 +56,7 @@ def to_absolute_timestamp(relative_ts, mark):
     Returns:
       timestamp relative to relative_ts.
     """
-    mark = struct.unpack('>H', mark)[0]
+    mark = MARK.unpack(mark)[0]
     base = relative_ts // RANGE * RANGE
     recovered = base + mark / 1000.0
     if recovered < relative_ts:
@@ -51,6 +65,145 @@ def to_absolute_timestamp(relative_ts, mark):
     return recovered
 
 
+def get_timemark_us(relative_ts, latency_s):
+    """
+    Create a 1-us resolution timemark equal to relative_ts + latency_s.
+
+    Returns:
+      future timestamp and its 32-bit binary mark.
+    """
+    future_ts = relative_ts + latency_s
+    stamp = int(future_ts % RANGE_US * 1000000)
+    return future_ts, MARK_US.pack(stamp)
+
+
+def to_absolute_timestamp_us(relative_ts, mark):
+    """
+    Interpret a microsecond timemark as a full timestamp.
+
+    Mark is assumed to be within half of the RANGE_US from relative_ts - in
+    future or in the past, so late chunks are recognised as such.
+    """
+    mark = MARK_US.unpack(mark)[0]
+    base = relative_ts // RANGE_US * RANGE_US
+    recovered = base + mark / 1000000.0
+    if recovered < relative_ts - RANGE_US / 2:
+        recovered += RANGE_US
+    elif recovered >= relative_ts + RANGE_US / 2:
+        recovered -= RANGE_US
+    return recovered
+
+
+def get_timemark_ns(relative_ns, latency_ns):
+    """
+    Create a 1-ms resolution timemark equal to relative_ns + latency_ns.
+
+    Returns:
+      future time (ns) and its 16-bit binary mark.
+    """
+    future_ns = relative_ns + latency_ns
+    stamp = future_ns // 1000000 % (RANGE * 1000)
+    return future_ns, MARK.pack(stamp)
+
+
+def to_absolute_ns(relative_ns, mark):
+    "Interpret a timemark as a full time (ns) relative to `relative_ns`"
+    range_ns = RANGE * 1000000000
+    recovered = (relative_ns - relative_ns % range_ns +
+                 MARK.unpack(mark)[0] * 1000000)
+    if recovered < relative_ns:
+        # We ended up in the past, assume next interval
+        recovered += range_ns
+    return recovered
+
+
+def get_timemark_us_ns(relative_ns, latency_ns):
+    """
+    Create a 1-us resolution timemark equal to relative_ns + latency_ns.
+
+    Returns:
+      future time (ns) and its 32-bit binary mark.
+    """
+    future_ns = relative_ns + latency_ns
+    stamp = future_ns // 1000 % (RANGE_US * 1000000)
+    return future_ns, MARK_US.pack(stamp)
+
+
+def to_absolute_us_ns(relative_ns, mark):
+    """
+    Interpret a microsecond timemark as a full time (ns). Mark is within half
+    of the RANGE_US from relative_ns.
+    """
+    range_ns = RANGE_US * 1000000000
+    recovered = (relative_ns - relative_ns % range_ns +
+                 MARK_US.unpack(mark)[0] * 1000)
+    if recovered < relative_ns - range_ns // 2:
+        recovered += range_ns
+    elif recovered >= relative_ns + range_ns // 2:
+        recovered -= range_ns
+    return recovered
+
+
+# Time is scheduled on the monotonic clock. Its mapping to the network time
+# (local UTC + the clock synchronisation offset) is kept in integer
+# nanoseconds and follows changes of the wall clock gradually - NTP stepping
+# the clock doesn't make the playback jump.
+
+# Mapping is checked against the wall clock this often
+UPDATE_NS = 100000000
+
+# Max change of the mapping (ns per second of the monotonic time) - 500ppm
+SLEW_NS = 500000
+
+# Wall clock changes larger than this are applied at once (eg. clock set
+# after boot)
+STEP_NS = 2000000000
+
+# Monotonic -> local UTC
+_local_ns = time.time_ns() - time.monotonic_ns()
+_updated_ns = time.monotonic_ns()
+
+# Offset of the sender's clock to the local one. Set on receivers by the clock
+# synchronisation (see clock_sync.py), zero on the sender.
+_sync_ns = 0
+
+
+def _update(monotonic_ns):
+    "Move the monotonic -> UTC mapping towards the wall clock"
+    global _local_ns, _updated_ns
+    diff = time.time_ns() - monotonic_ns - _local_ns
+    if abs(diff) > STEP_NS:
+        _local_ns += diff
+    else:
+        limit = (monotonic_ns - _updated_ns) * SLEW_NS // 1000000000
+        _local_ns += max(-limit, min(limit, diff))
+    _updated_ns = monotonic_ns
+
+
+def local_now_ns():
+    "Current local UTC time in nanoseconds - monotonic"
+    monotonic_ns = time.monotonic_ns()
+    if monotonic_ns - _updated_ns >= UPDATE_NS:
+        _update(monotonic_ns)
+    return monotonic_ns + _local_ns
+
+
+def now_ns():
+    "Current network time in nanoseconds - aligned to the sender's clock"
+    return local_now_ns() + _sync_ns
+
+
+def set_offset(value):
+    "Align now() with a reference clock - offset in seconds"
+    global _sync_ns
+    _sync_ns = int(value * 1000000000)
+
+
+def local_now():
+    "Current UTC timestamp of the local clock"
+    return local_now_ns() / 1000000000
+
+
 def now():
-    "Current UTC timestamp"
-    return time.time()
+    "Current UTC timestamp - aligned to the sender's clock"
+    return now_ns() / 1000000000
@@ -0,0 +1,232 @@
+"""
+Per-chunk trace of the pipeline stages.
+
+When enabled, each stage records (event, chunk key, time) into a fixed size
+buffer. Chunk key is the chunk play time in microseconds - it's known on
+all stages of both sides. Times are the network time in nanoseconds
+(time_machine.now_ns).
+
+  sender:   READ (SampleReader) -> MARKED -> SENT (Packetizer)
+  receiver: RECEIVED (Receiver) -> DEQUEUED -> WRITTEN (ChunkPlayer)
+
+The buffer is dumped to a binary file when full, on SIGUSR1 and on exit.
+A full buffer is swapped with a spare one and written by a thread, so the
+recording stages never wait for the disk:
+
+  [magic "WSTR"][version:1][count:4][events: count bytes][key, time: 2 x int64 each]
+
+Analyse the dumps with:
+
+  python3 -m libwavesync.trace DUMP [DUMP...]
+
+Disabled tracing costs a global lookup per stage: `if trace.tracer`.
+"""
+
+import sys
+import struct
+import asyncio
+from array import array
+
+from libwavesync import time_machine
+from libwavesync.metrics import Histogram
+
+
+READ = 1
+MARKED = 2
+SENT = 3
+RECEIVED = 4
+DEQUEUED = 5
+WRITTEN = 6
+
+EVENT_NAMES = {
+    READ: 'read',
+    MARKED: 'marked',
+    SENT: 'sent',
+    RECEIVED: 'received',
+    DEQUEUED: 'dequeued',
+    WRITTEN: 'written',
+}
+
+# Stages measured between consecutive events of a chunk
+STAGES = [
+    (READ, MARKED),
+    (MARKED, SENT),
+    (RECEIVED, DEQUEUED),
+    (DEQUEUED, WRITTEN),
+]
+
+HEADER = struct.Struct('<4sBI')
+MAGIC = b'WSTR'
+VERSION = 1
+
+# Active Tracer or None
+tracer = None
+
+
+def _write(path, events, values, count):
+    "Write records to a dump file. Returns the path or None on failure"
+    try:
+        with open(path, 'wb') as dump_file:
+            dump_file.write(HEADER.pack(MAGIC, VERSION, count))
+            dump_file.write(events[:count])
+            dump_file.write(values[:2 * count].tobytes())
+    except OSError as ex:
+        print("WARNING: Unable to write trace:", ex)
+        return None
+    print("Trace of %d events written to %s" % (count, path))
+    return path
+
+
+class Tracer:
+    "Fixed size, array backed trace buffer"
+
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.capacity = capacity
+        self.events = bytearray(capacity)
+        self.values = array('q', bytes(16 * capacity))
+        self.count = 0
+        self.dumps = 0
+
+        # Buffer to continue with while the full one is written
+        self._spare = (bytearray(capacity), array('q', bytes(16 * capacity)))
+        # Write in progress
+        self.writing = None
+        # Records lost because the writing didn't keep up
+        self.dropped = 0
+
+    def record(self, event, key_ns):
+        "Record event of the chunk played at key_ns (nanoseconds)"
+        position = self.count
+        self.events[position] = event
+        self.values[2 * position] = key_ns // 1000
+        self.values[2 * position + 1] = time_machine.now_ns()
+        self.count = position + 1
+        if self.count == self.capacity:
+            self._flush()
+
+    def _next_path(self):
+        path = '%s.%d' % (self.path, self.dumps)
+        self.dumps += 1
+        return path
+
+    def _flush(self):
+        "Buffer is full - write it in the background, continue in the spare"
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not within the event loop
+            self.dump()
+            return
+
+        if self._spare is None:
+            # Previous buffer is still being written - start over
+            self.dropped += self.count
+            self.count = 0
+            if self.dropped == self.capacity:
+                print("WARNING: Trace writing is too slow, dropping records")
+            return
+
+        full = (self.events, self.values)
+        self.events, self.values = self._spare
+        self._spare = None
+        count = self.count
+        self.count = 0
+
+        def written(future):
+            self._spare = full
+            self.writing = None
+
+        self.writing = loop.run_in_executor(None, _write, self._next_path(),
+                                            full[0], full[1], count)
+        self.writing.add_done_callback(written)
+
+    def dump(self):
+        """
+        Write the buffered records to the next file and start over.
+        Returns the path, or None if nothing was written.
+        """
+        if not self.count:
+            return None
+        count = self.count
+        self.count = 0
+        return _write(self._next_path(), self.events, self.values, count)
+
+
+def enable(path, capacity=65536):
+    "Start tracing"
+    global tracer
+    tracer = Tracer(path, capacity)
+    return tracer
+
+
+def load(path):
+    "Read a dump. Returns list of (event, key_us, time_ns)"
+    with open(path, 'rb') as dump_file:
+        data = dump_file.read()
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a trace dump" % path)
+    events = data[HEADER.size:HEADER.size + count]
+    values = array('q')
+    values.frombytes(data[HEADER.size + count:HEADER.size + count + 16 * count])
+    return [(events[i], values[2 * i], values[2 * i + 1]) for i in range(count)]
+
+
+def analyse(records):
+    """
+    Latency distributions of the stages.
+
+    Returns list of (description, Histogram in microseconds).
+    """
+    chunks = {}
+    for event, key, timestamp in records:
+        # First occurrence of the event wins (eg. duplicates)
+        chunks.setdefault(key, {}).setdefault(event, timestamp)
+
+    stages = [
+        ('%s -> %s' % (EVENT_NAMES[start], EVENT_NAMES[end]), start, end)
+        for start, end in STAGES
+    ]
+    results = {name: Histogram(highest=60000000, scale=1e-6)
+               for name, _, _ in stages}
+    # Time left to the play time - negative values are clamped to 0
+    ahead = [('%s -> play time' % EVENT_NAMES[event], event)
+             for event in (SENT, RECEIVED, WRITTEN)]
+    for name, _ in ahead:
+        results[name] = Histogram(highest=60000000, scale=1e-6)
+
+    for key, events in chunks.items():
+        for name, start, end in stages:
+            if start in events and end in events:
+                results[name].record((events[end] - events[start]) // 1000)
+        for name, event in ahead:
+            if event in events:
+                results[name].record(key - events[event] // 1000)
+
+    names = [name for name, _, _ in stages] + [name for name, _ in ahead]
+    return [(name, results[name]) for name in names if results[name].count]
+
+
+def main(argv=None):
+    "Print per-stage latency distributions of the dumps"
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print("Usage: python3 -m libwavesync.trace DUMP [DUMP...]")
+        return 1
+    records = []
+    for path in paths:
+        records += load(path)
+    print("%d events" % len(records))
+    print("%-26s %8s %9s %9s %9s %9s" % ('stage', 'chunks', 'p50 ms',
+                                         'p90 ms', 'p99 ms', 'max ms'))
+    for name, histogram in analyse(records):
+        print("%-26s %8d %9.3f %9.3f %9.3f %9.3f" % (
+            name, histogram.count,
+            histogram.percentile(50) / 1000, histogram.percentile(90) / 1000,
+            histogram.percentile(99) / 1000, histogram.max / 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())